@@ -52,7 +52,10 @@ class RosRobotSubscriberAndPublisher:
         :param data: ROS Things position message
         :return: nothing
         """
-        self.robot.blackboard.ball.position = np.array(data.ball_pos) / 100.0
+        # Speeds are computed with the time the frame was grabbed, not the time
+        # the message arrived
+        timestamp = data.timestamp
+        self.robot.blackboard.ball.set_position(np.array(data.ball_pos) / 100.0, timestamp)
 
         if self.robot.team_color == 1:  # yellow
             friends_position = np.array(data.yellow_team_pos).reshape((-1, 2)) / 100.0
@@ -68,13 +71,13 @@ class RosRobotSubscriberAndPublisher:
             enemies_orientation = np.array(data.yellow_team_orientation) / 10000.0
 
         self.robot.blackboard.set_robot_variables(friends_position[self.robot.tag],
-                                                  friends_orientation[self.robot.tag])
+                                                  friends_orientation[self.robot.tag], timestamp)
 
         self.robot.blackboard.home_team.set_team_variables(friends_position,
-                                                           friends_orientation, self.robot.tag)
+                                                           friends_orientation, self.robot.tag, timestamp)
 
         self.robot.blackboard.enemy_team.set_team_variables(enemies_position,
-                                                            enemies_orientation)
+                                                            enemies_orientation, timestamp=timestamp)
         self.robot.run()
 
     def debug_publish(self, _vector):
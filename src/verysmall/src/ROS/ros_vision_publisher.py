@@ -3,9 +3,34 @@ import rospy
 #!/usr/bin/env python
 PKG = 'verysmall'
 import numpy as np
+import time
 from verysmall.msg import things_position
 from verysmall.srv import vision_command
 
+# Layout of the vision state buffer. All the positions come first and then
+# all the orientations, every field is a float64 so the whole buffer is
+# converted to the message integers in one operation
+THINGS_STATE = np.dtype([("ball_pos", np.float64, (2,)),
+                         ("yellow_team_pos", np.float64, (5, 2)),
+                         ("blue_team_pos", np.float64, (5, 2)),
+                         ("yellow_team_orientation", np.float64, (5,)),
+                         ("blue_team_orientation", np.float64, (5,)),
+                         ("vision_fps", np.float64)])
+
+# Factors used to pack each field in the int16 fields of the message
+THINGS_STATE_SCALES = {"ball_pos": 100,
+                       "yellow_team_pos": 100,
+                       "blue_team_pos": 100,
+                       "yellow_team_orientation": 10000,
+                       "blue_team_orientation": 10000,
+                       "vision_fps": 100}
+
+
+def new_things_state() -> np.ndarray:
+    """ Returns a zeroed vision state buffer. Its fields are views, so
+        writing into them writes straight into the buffer """
+    return np.zeros((), THINGS_STATE)
+
 
 class RosVisionService:
     """
@@ -26,8 +51,23 @@ class RosVisionPublisher:
         # else is only a publisher
         self.pub = rospy.Publisher('things_position', things_position, queue_size=1)
 
+        # Everything publish_state needs is allocated only once. The message
+        # is serialized inside publish, so it can be reused between frames
+        self._msg = things_position()
+        self._scales = np.empty(THINGS_STATE.itemsize // 8)
+        self._scaled = np.empty_like(self._scales)
+        self._packed = np.empty(self._scales.size, np.int16)
+        self._fields = []
+
+        for name in THINGS_STATE.names:
+            offset = THINGS_STATE.fields[name][1] // 8
+            size = int(np.prod(THINGS_STATE[name].shape, dtype=int))
+            self._scales[offset:offset + size] = THINGS_STATE_SCALES[name]
+            if name != "vision_fps":
+                self._fields.append((name, self._packed[offset:offset + size]))
+
     def publish(self, ball_pos, yellow_pos, yellow_orient, blue_pos, 
-                blue_orientation, fps):
+                blue_orientation, fps, timestamp=None):
 
         """
             This function publishes in the things position topic
@@ -38,8 +78,11 @@ class RosVisionPublisher:
             :param blue_pos: int16[10]
             :param blue_orientation: int16[5]
             :param fps: utin16
+            :param timestamp: float64, grab time of the frame, now if None
             :return: returns nothing
         """
+        if timestamp is None:
+            timestamp = time.time()
 
         msg = things_position(
             np.int16(ball_pos * 100).tolist(),
@@ -47,7 +90,8 @@ class RosVisionPublisher:
             np.int16(yellow_orient.flatten() * 10000).tolist(),
             np.int16(blue_pos.flatten() * 100).tolist(),
             np.int16(blue_orientation.flatten() * 10000).tolist(),
-            int(fps * 100)
+            int(fps * 100),
+            timestamp
         )
 
         try:
@@ -56,6 +100,30 @@ class RosVisionPublisher:
             rospy.logfatal(e)
             rospy.logfatal(msg)
 
+    def publish_state(self, state: np.ndarray, timestamp: float) -> None:
+        """
+            Publishes a vision state buffer, created by new_things_state, in
+            the things position topic. The buffer is scaled and converted to
+            int16 at once and the message fields are views of the result
+
+            :param state: THINGS_STATE
+            :param timestamp: float64, grab time of the frame
+            :return: returns nothing
+        """
+        np.multiply(state.reshape(1).view(np.float64), self._scales, out=self._scaled)
+        np.copyto(self._packed, self._scaled, casting='unsafe')
+
+        for name, values in self._fields:
+            setattr(self._msg, name, values)
+        self._msg.vision_fps = int(self._scaled[-1])
+        self._msg.timestamp = timestamp
+
+        try:
+            self.pub.publish(self._msg)
+        except rospy.ROSException as e:
+            rospy.logfatal(e)
+            rospy.logfatal(self._msg)
+
 
 if __name__ == '__main__':
     try:
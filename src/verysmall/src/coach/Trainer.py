@@ -65,7 +65,7 @@ class Trainer:
     def things_position_topic_callback(self, topic: things_position) -> None:
         self._blackboard_locker.acquire()
 
-        self._blackboard.ball.position = np.array(topic.ball_pos) / 100.0
+        self._blackboard.ball.set_position(np.array(topic.ball_pos) / 100.0, topic.timestamp)
 
         if self._game_topic.team_color == 1:  # yellow
             friends_position = np.array(topic.yellow_team_pos).reshape((-1, 2)) / 100.0
@@ -82,10 +82,12 @@ class Trainer:
 
         
         self._blackboard.home_team.set_team_variables(friends_position,
-                                                      friends_orientation)
+                                                      friends_orientation,
+                                                      timestamp=topic.timestamp)
 
         self._blackboard.enemy_team.set_team_variables(enemies_position,
-                                                       enemies_orientation)
+                                                       enemies_orientation,
+                                                       timestamp=topic.timestamp)
         
         self._blackboard_locker.release()
 
@@ -360,6 +360,7 @@ class virtualField():
         """plots all contours from all robots of a designed color given as parameter"""
         index = 0
         length = len(robot_list)
+        path_starts = []
 
         while index < length:
             if robot_list[index][0] != 0 or robot_list[index][1] != 0:
@@ -391,10 +392,13 @@ class virtualField():
                                self.colors["yellow"], 1, cv.LINE_AA)
 
                     if self.draw_simulation_vectors and self.tag_debug_vector[index]:
-                        self.drawPath(robot_list[index], ball_center)
+                        path_starts.append(robot_list[index])
 
             index = index + 1
 
+        if path_starts:
+            self.drawPaths(path_starts, ball_center)
+
             ''' metodo unint(ico para unificar os plots), recebe todas as informacoes necessarias para plot de cada um dos times e
                 e da bola. tambem recebe informacoes de fps do topico e da visao
 
@@ -438,30 +442,34 @@ class virtualField():
             cv2.waitKey(1)
 
     def drawPath(self, start, end):
-        currentPos = np.array(start)
-        _currentPos = position_from_origin(unit_convert(start, self.width_conv, self.height_conv), self.field_origin)
+        self.drawPaths([start], end)
+
+    def drawPaths(self, starts, end):
+        """ Draws the univector path of each start to end. The paths advance
+            together, with one evaluation of the field for all of them in
+            each step """
+        currentPos = np.array(starts, dtype=np.float64).reshape(-1, 2)
         end = np.array(end)
 
-        newPos = None
         alpha = 2.0  # 3.5
         beta = 3.5
-        point_lines = []
+        points = [[] for _ in currentPos]
 
-        distance = np.linalg.norm(currentPos - end)
+        active = np.linalg.norm(currentPos - end, axis=1) >= beta
         it = 0
-        points = []
-        while (distance >= beta) and it < 120:
-            v = self.univetField.get_vec_with_ball(_robotPos=currentPos, _vRobot=[0, 0],
-                                                   _ball=end, _attack_goal=self.attack_goal)
-            newPos = currentPos + (alpha * v)
-            _newPos = position_from_origin(unit_convert(newPos, self.width_conv, self.height_conv), self.field_origin)
-            points.append(_newPos)
-            currentPos = newPos
-            _currentPos = _newPos
+        while np.any(active) and it < 120:
+            v = self.univetField.get_vecs_with_ball(currentPos[active], _vRobot=[0, 0],
+                                                    _ball=end, _attack_goal=self.attack_goal)
+            currentPos[active] += alpha * v
+            for index in np.flatnonzero(active):
+                points[index].append(position_from_origin(
+                    unit_convert(currentPos[index], self.width_conv, self.height_conv), self.field_origin))
             it += 1
-            distance = np.linalg.norm(currentPos - end)
+            active &= np.linalg.norm(currentPos - end, axis=1) >= beta
 
-        cv2.polylines(self.field,[np.array(points)], 0, self.colors['red'], 2)
+        paths = [np.array(path) for path in points if path]
+        if paths:
+            cv2.polylines(self.field, paths, 0, self.colors['red'], 2)
 
     def set_visible_vectors(self, robot_list, robot_params):
         faster_hash = ['robot_' + str(x) for x in range(1, 6)]
@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+""" Times the calls of the univector field a robot makes in each frame:
+    Move2Goal.update_axis, Move2Goal.fi_tuf and UnivectorField.get_angle_vec
+    with the goal kept or moved, for a few obstacles.
+
+    With --reference, the same calls are timed on another version of
+    un_field.py and the angles of both are compared. It must be run from
+    the src directory:
+
+        git show HEAD~1:./robot_module/movement/univector/un_field.py > /tmp/un_field.py
+        python3 -m robot_module.movement.univector.angle_benchmark --reference /tmp/un_field.py
+"""
+from argparse import ArgumentParser
+import importlib.util
+import time
+import numpy as np
+
+from robot_module.movement.univector import un_field
+
+
+def load_reference(path: str):
+    spec = importlib.util.spec_from_file_location("reference_un_field", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_field(module, args, obstacles, speeds):
+    field = module.UnivectorField()
+    field.update_constants(args.radius, args.kr, args.k0, args.dmin, args.ldelta)
+    field.update_obstacles(obstacles.tolist(), speeds.tolist())
+    return field
+
+
+def time_calls(function, inputs) -> (float, list):
+    """ Returns the mean time of a call, in us, and the results. The inputs
+        are copied before, since the older versions change them in place """
+    inputs = [[np.array(value) for value in values] for values in inputs]
+    t0 = time.perf_counter()
+    results = [function(*values) for values in inputs]
+    return 1e6 * (time.perf_counter() - t0) / len(inputs), results
+
+
+def run(field, inputs) -> dict:
+    goal, axis = inputs["goal"], inputs["axis"]
+    field.get_angle_vec(inputs["robots"][0], inputs["speeds"][0], goal, axis)
+
+    times = {}
+    times["update_axis"], _ = time_calls(field.mv2Goal.update_axis, [(goal, axis)] * len(inputs["robots"]))
+    times["fi_tuf"], _ = time_calls(field.mv2Goal.fi_tuf, [(robot,) for robot in inputs["robots"]])
+    times["same goal"], same = time_calls(field.get_angle_vec,
+                                          [(robot, speed, goal, axis)
+                                           for robot, speed in zip(inputs["robots"], inputs["speeds"])])
+    times["moving goal"], moving = time_calls(field.get_angle_vec,
+                                              [(robot, speed, moved, axis) for robot, speed, moved
+                                               in zip(inputs["robots"], inputs["speeds"], inputs["goals"])])
+    return {"times": times, "angles": np.array(same + moving)}
+
+
+def main():
+    parser = ArgumentParser(description="Univector field calls micro benchmark")
+    parser.add_argument("--reference", default="", help="un_field.py of the version to compare with")
+    parser.add_argument("--calls", type=int, default=20000)
+    parser.add_argument("--obstacles", type=int, default=5)
+    parser.add_argument("--radius", type=float, default=9.0)
+    parser.add_argument("--kr", type=float, default=25.38)
+    parser.add_argument("--k0", type=float, default=0.12)
+    parser.add_argument("--dmin", type=float, default=9.24)
+    parser.add_argument("--ldelta", type=float, default=1.94)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    arena = np.array([150., 130.])
+    obstacles = rng.uniform(0, arena, (args.obstacles, 2))
+    speeds = rng.normal(0, 20., (args.obstacles, 2))
+    goal = np.array([100., 60.])
+    inputs = {"robots": rng.uniform(0, arena, (args.calls, 2)),
+              "speeds": rng.normal(0, 20., (args.calls, 2)),
+              "goals": goal + rng.normal(0, 1., (args.calls, 2)),
+              "goal": goal, "axis": np.array([1., .2])}
+
+    versions = [("current", un_field)]
+    if args.reference:
+        versions.insert(0, ("reference", load_reference(args.reference)))
+    results = {name: run(make_field(module, args, obstacles, speeds), inputs) for name, module in versions}
+
+    names = list(results["current"]["times"])
+    print("%-10s" % "us/call" + "".join("%14s" % name for name in names))
+    for name, result in results.items():
+        print("%-10s" % name + "".join("%14.2f" % result["times"][call] for call in names))
+
+    if args.reference:
+        print("%-10s" % "speedup" + "".join("%13.1fx" % (results["reference"]["times"][call] /
+                                                         results["current"]["times"][call]) for call in names))
+        difference = results["current"]["angles"] - results["reference"]["angles"]
+        difference = np.abs((difference + np.pi) % (2 * np.pi) - np.pi)
+        print("largest angle difference: %.3g rad" % difference.max())
+
+
+if __name__ == "__main__":
+    main()
@@ -73,18 +73,19 @@ def drawObstacles(img, obstacles):
 def drawBall(img, ballPos):
     cv2.circle(img, (ballPos[0], -ballPos[1]), 9, ballColor, -1)
 
-def drawField(img, univetField):
-    for l in range(0, h, 3):
-        for c in range(0, w, 3):
-            pos = [c, -l]
-            v = univetField.get_vec(_robotPos=pos, _vRobot=[0, 0])
+def drawField(img, univetField, ball):
+    # The whole grid is evaluated in one call
+    ls, cs = np.mgrid[0:h:3, 0:w:3]
+    positions = np.stack([cs.ravel(), -ls.ravel()], axis=1)
+    vectors = univetField.get_vecs_with_ball(positions, _vRobot=[0, 0], _ball=ball)
 
-            s = cm2pixel(np.array([c, l]))
-            new = cm2pixel(np.array(pos)) + 10*v
+    for pos, v in zip(positions, vectors):
+        s = cm2pixel(np.array([pos[0], -pos[1]]))
+        new = cm2pixel(pos) + 10*v
 
-            new[1] = -new[1]
+        new[1] = -new[1]
 
-            cv2.arrowedLine(img, tuple(np.int0(s)), tuple(np.int0(new)), (50,50,50), 1)
+        cv2.arrowedLine(img, tuple(np.int0(s)), tuple(np.int0(new)), (50,50,50), 1)
 
 def drawPath(img, start, end, univetField):
     currentPos = start
@@ -97,7 +98,7 @@ def drawPath(img, start, end, univetField):
     t0 = time.time()
 
     while(np.linalg.norm(currentPos - end) >= beta):
-        v = univetField.get_vec(_robotPos=currentPos, _vRobot=[0, 0])
+        v = univetField.get_vec_with_ball(_robotPos=currentPos, _vRobot=[0, 0], _ball=end)
         newPos = currentPos + (alpha*np.array(v))
         _newPos = cm2pixel(newPos).astype(int)
 
@@ -139,7 +140,7 @@ def draw_field():
     drawObstacles(imgField2, obstacle)
     drawBall(imgField2, cm2pixel(ball))
 
-    drawField(imgField2, univetField)
+    drawField(imgField2, univetField, ball)
     #ret, pos = drawPath(imgField2, robot, ball, univetField)
 
     cv2.imshow('field', imgField2)
@@ -169,11 +170,10 @@ if __name__ == "__main__":
         # Creates the univector field
         univetField = UnivectorField()
         univetField.update_constants(RADIUS, KR, K0, DMIN, LDELTA)
-        univetField.update_ball(ball)
         univetField.update_obstacles(obstacle, vObstacle)
 
 
-        drawField(imgField2, univetField)
+        drawField(imgField2, univetField, ball)
         ret, pos = drawPath(imgField2, robot, ball, univetField)
 
         # display the path in the field
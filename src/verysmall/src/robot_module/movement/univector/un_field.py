@@ -20,6 +20,11 @@ def wrap2pi(theta: float) -> float:
         return theta
 
 
+def wrap2pi_batch(theta: np.ndarray) -> np.ndarray:
+    """ wrap2pi of each angle of theta """
+    return np.where(theta > pi, theta - 2 * pi, np.where(theta < -pi, 2 * pi + theta, theta))
+
+
 class HyperbolicSpiral:
 
     def __init__(self, _Kr, _radius):
@@ -37,9 +42,9 @@ class HyperbolicSpiral:
         else:
             r = radius
 
-        p = np.array(_p)
-        theta = atan2(p[1], p[0])
-        ro = np.linalg.norm(p)
+        x, y = float(_p[0]), float(_p[1])
+        theta = atan2(y, x)
+        ro = math.sqrt(x * x + y * y)
 
         if ro > r:
             a = (pi / 2.0) * (2.0 - (r + self.Kr) / (ro + self.Kr))
@@ -53,6 +58,21 @@ class HyperbolicSpiral:
 
         return atan2(sin(_theta), cos(_theta))
 
+    def fi_h_batch(self, p: np.ndarray, radius: float = None, cw: bool = True) -> np.ndarray:
+        """ fi_h of each row of the (N, 2) array p """
+        r = self.radius if radius is None else radius
+
+        theta = np.arctan2(p[:, 1], p[:, 0])
+        ro = np.sqrt(p[:, 0] * p[:, 0] + p[:, 1] * p[:, 1])
+
+        a = np.where(ro > r,
+                     (pi / 2.0) * (2.0 - (r + self.Kr) / (ro + self.Kr)),
+                     (pi / 2.0) * np.sqrt(ro / r))
+
+        _theta = wrap2pi_batch(theta + a if cw else theta - a)
+
+        return np.arctan2(np.sin(_theta), np.cos(_theta))
+
     def n_h(self, _p: np.ndarray, _radius: float = None, cw: bool = True) -> np.ndarray:
         p = np.array(_p)
         if _radius is None:
@@ -98,61 +118,103 @@ class Move2Goal:
         self.toUnivectorMatrix = None
         self.toCanonicalMatrix = None
 
+        # Origin and axes of the last update_axis, as floats
+        self.axis_key = None
+        self.rotation = None
+
     def update_params(self, _KR: float, _RADIUS: float) -> None:
         self.Kr = _KR
         self.radius = _RADIUS
         self.hyperSpiral.update_params(self.Kr, self.radius)
 
     def update_axis(self, new_origin: np.ndarray, new_u_axis: np.ndarray) -> None:
-        self.origin = np.array(new_origin)
-        self.u = new_u_axis
+        """ The axes are only built again when the origin or the axis change """
+        axis_key = (float(new_origin[0]), float(new_origin[1]), float(new_u_axis[0]), float(new_u_axis[1]))
+        if axis_key == self.axis_key:
+            return
+
+        self.axis_key = axis_key
+        self.origin = np.array(axis_key[:2])
+        self.u = axis_key[2:]
         self.build_axis()
 
     def build_axis(self) -> None:
-        self.u /= -np.linalg.norm(self.u)
-        theta = math.atan2(self.u[1], self.u[0])
-        self.v = np.array([-sin(theta), cos(theta)])
+        ux, uy = float(self.u[0]), float(self.u[1])
+        norm = -math.sqrt(ux * ux + uy * uy)
+        ux, uy = ux / norm, uy / norm
+        self.u = np.array([ux, uy])
+        self.v = np.array([-uy, ux])
 
-        self.toCanonicalMatrix = np.array([self.u, self.v]).T
-        self.toUnivectorMatrix = np.linalg.inv(self.toCanonicalMatrix)
+        # The axes are a rotation, so the inverse is the transpose
+        self.rotation = (ux, uy, -uy, ux)
+        self.toUnivectorMatrix = np.array([[ux, uy], [-uy, ux]])
+        self.toCanonicalMatrix = self.toUnivectorMatrix.T
 
     def fi_tuf(self, _p: np.ndarray) -> float:
-        n_h = self.hyperSpiral.n_h
+        fi_h = self.hyperSpiral.fi_h
 
-        p = np.array(_p) - self.origin
+        # The univector axes are the rows of the rotation
+        a, b, c, d = self.rotation
+        dx, dy = float(_p[0]) - self.axis_key[0], float(_p[1]) - self.axis_key[1]
         r = self.radius
 
-        p = np.dot(self.toUnivectorMatrix, p).reshape(2, )
-
-        x, y = p
+        x = a * dx + b * dy
+        y = c * dx + d * dy
         yl = y + r
         yr = y - r
 
         # Parece que houve algum erro de digitacao no artigo
         # Pois quando pl e pr sao definidos dessa maneira o campo gerado
         # se parece mais com o resultado obtido no artigo
-        pl = np.array([x, yr])
-        pr = np.array([x, yl])
+        pl = (x, yr)
+        pr = (x, yl)
 
         # Este caso eh para quando o robo esta dentro do "circulo" da bola
         if -r <= y < r:
-            nh_pl = n_h(pl, cw=False)
-            nh_pr = n_h(pr, cw=True)
+            fi_pl = fi_h(pl, cw=False)
+            fi_pr = fi_h(pr, cw=True)
 
             # Apesar de no artigo nao ser utilizado o modulo, quando utilizado
             # na implementacao o resultado foi mais condizente com o artigo
-            vec = (abs(yl) * nh_pl + abs(yr) * nh_pr) / (2.0 * r)
-            vec = np.dot(self.toCanonicalMatrix, vec).reshape(2, )
+            vx = (abs(yl) * cos(fi_pl) + abs(yr) * cos(fi_pr)) / (2.0 * r)
+            vy = (abs(yl) * sin(fi_pl) + abs(yr) * sin(fi_pr)) / (2.0 * r)
         else:
             if y < -r:
-                theta = self.hyperSpiral.fi_h(pl, cw=True)
+                theta = fi_h(pl, cw=True)
             else:  # y >= r
-                theta = self.hyperSpiral.fi_h(pr, cw=False)
+                theta = fi_h(pr, cw=False)
+
+            vx, vy = cos(theta), sin(theta)
+
+        # Back to the canonical axes, the columns of the rotation
+        return atan2(b * vx + d * vy, a * vx + c * vy)
+
+    def fi_tuf_batch(self, positions: np.ndarray) -> np.ndarray:
+        """ fi_tuf of each row of the (N, 2) array of positions """
+        fi_h = self.hyperSpiral.fi_h_batch
+
+        p = (np.asarray(positions, dtype=np.float64) - self.origin) @ self.toUnivectorMatrix.T
+        r = self.radius
+
+        x, y = p[:, 0], p[:, 1]
+        yl = y + r
+        yr = y - r
+
+        pl = np.stack([x, yr], axis=1)
+        pr = np.stack([x, yl], axis=1)
+
+        # Every case is evaluated for all the positions and then selected
+        fi_pl = fi_h(pl, cw=False)
+        fi_pr = fi_h(pr, cw=True)
+        inside = np.stack([abs(yl) * np.cos(fi_pl) + abs(yr) * np.cos(fi_pr),
+                           abs(yl) * np.sin(fi_pl) + abs(yr) * np.sin(fi_pr)], axis=1) / (2.0 * r)
 
-            vec = np.array([cos(theta), sin(theta)])
-            vec = np.dot(self.toCanonicalMatrix, vec).reshape(2, )
+        theta = np.where(y < -r, fi_h(pl, cw=True), fi_h(pr, cw=False))
+        outside = np.stack([np.cos(theta), np.sin(theta)], axis=1)
 
-        return atan2(vec[1], vec[0])
+        vec = np.where(((-r <= y) & (y < r))[:, np.newaxis], inside, outside) @ self.toCanonicalMatrix.T
+
+        return np.arctan2(vec[:, 1], vec[:, 0])
 
 
 class AvoidObstacle:
@@ -234,13 +296,31 @@ class UnivectorField:
         return np.array([attack_goal * 150, 65])
 
     def update_obstacles(self, _obstacles: np.ndarray, _obsSpeeds: np.ndarray) -> None:
-        self.obstacles = np.array(_obstacles)
-        self.obstaclesSpeed = np.array(_obsSpeeds)
+        self.obstacles = np.array(_obstacles, dtype=np.float64).reshape(-1, 2)
+        self.obstaclesSpeed = np.array(_obsSpeeds, dtype=np.float64).reshape(-1, 2)
 
     def update_robot(self, _robotPos: np.ndarray, _vRobot: np.ndarray) -> None:
-        self.robotPos = np.array(_robotPos)
-        self.vRobot = np.array(_vRobot)
-        self.avdObsField.update_robot(self.robotPos, self.vRobot)
+        self.robotPos = np.array(_robotPos, dtype=np.float64)
+        self.vRobot = np.array(_vRobot, dtype=np.float64)
+
+        # Shared with the obstacles field, none of them is changed in place
+        self.avdObsField.pRobot = self.robotPos
+        self.avdObsField.vRobot = self.vRobot
+
+    def get_virtual_centers(self, positions: np.ndarray, v_robot: np.ndarray) -> np.ndarray:
+        """ AvoidObstacle.get_virtual_pos of every obstacle for each row of
+            the (N, 2) array of positions, as an (N, M, 2) array. Without a
+            relative speed the centers are the obstacles and do not depend on
+            the position, so it is a (1, M, 2) array """
+        s = self.K0 * (self.obstaclesSpeed - v_robot)
+        if not s.any():
+            return self.obstacles[np.newaxis]
+
+        # The scale is 1 when d >= |s|, the floor only keeps a null s finite
+        s_norm = np.maximum(np.hypot(s[:, 0], s[:, 1]), 1e-12)
+        offsets = self.obstacles - positions[:, np.newaxis]
+        scale = np.minimum(np.hypot(offsets[..., 0], offsets[..., 1]) / s_norm, 1.0)
+        return self.obstacles + scale[..., np.newaxis] * s
 
     def update_constants(self, _RADIUS: float, _KR: float, _K0: float, _DMIN: float, _LDELTA: float) -> np.ndarray:
         self.RADIUS = _RADIUS
@@ -257,33 +337,23 @@ class UnivectorField:
 
         if _robotPos is not None and _vRobot is not None:
             # Just in case the user send lists
-            robot_pos = np.array(_robotPos)
-            v_robot = np.array(_vRobot)
-            self.update_robot(robot_pos, v_robot)
+            self.update_robot(_robotPos, _vRobot)
 
         if _goal_pos is not None and _goal_axis is not None:
-            goal_position = np.array(_goal_pos)
-            goal_axis = np.array(_goal_axis)
-            self.mv2Goal.update_axis(goal_position, goal_axis)
+            # The axes are only built again when the goal or its axis change
+            self.mv2Goal.update_axis(_goal_pos, _goal_axis)
 
-        closest_center = np.array([None, None])  # array to store the closest center
-        centers = []
         min_distance = self.DMIN + 1
 
         if self.obstacles.size:
-            # get the Repulsive field centers
-            for i in range(self.obstacles.shape[0]):
-                self.avdObsField.update_obstacle(self.obstacles[i], self.obstaclesSpeed[i])
-                center = self.avdObsField.get_virtual_pos()
-                centers.append(center)
-
-            centers = np.asarray(centers)
-            dist_vec = np.linalg.norm(np.subtract(centers, self.robotPos), axis=1)
-            index = np.argmin(dist_vec)  # index of closest center
-            closest_center = centers[index]
-            min_distance = dist_vec[index]
+            # get the Repulsive field centers, all at once
+            centers = self.get_virtual_centers(self.robotPos[np.newaxis], self.vRobot)[0]
+            offsets = self.robotPos - centers
+            dist_vec = np.hypot(offsets[:, 0], offsets[:, 1])
+            index = int(dist_vec.argmin())  # index of closest center
+            min_distance = float(dist_vec[index])
 
-            fi_auf = self.avdObsField.fi_auf(self.robotPos, _vPos=closest_center, _theta=True)
+            fi_auf = atan2(offsets[index, 1], offsets[index, 0])
 
         # the first case when the robot is to close from an obstacle
         if min_distance <= self.DMIN:
@@ -298,6 +368,36 @@ class UnivectorField:
             else:  # if there is no obstacles
                 return fi_tuf
 
+    def get_angle_vec_batch(self, positions: np.ndarray, _vRobot: np.ndarray = None,
+                            _goal_pos: np.ndarray = None, _goal_axis=None) -> np.ndarray:
+        """ get_angle_vec of each row of the (N, 2) array of positions, all of
+            them with the same speed. The robot kept by the field is not changed """
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+        v_robot = np.asarray(self.vRobot if _vRobot is None else _vRobot, dtype=np.float64)
+
+        if _goal_pos is not None and _goal_axis is not None:
+            self.mv2Goal.update_axis(_goal_pos, _goal_axis)
+
+        fi_tuf = self.mv2Goal.fi_tuf_batch(positions)
+        if not self.obstacles.size:
+            return fi_tuf
+
+        centers = np.broadcast_to(self.get_virtual_centers(positions, v_robot),
+                                  (len(positions),) + self.obstacles.shape)
+
+        dist_vec = np.linalg.norm(centers - positions[:, np.newaxis], axis=2)
+        index = np.argmin(dist_vec, axis=1)
+        rows = np.arange(len(positions))
+        closest_center = centers[rows, index]
+        min_distance = dist_vec[rows, index]
+
+        p = positions - closest_center
+        fi_auf = np.arctan2(p[:, 1], p[:, 0])
+
+        g = np.exp(-((min_distance - self.DMIN) ** 2) / (2 * (self.LDELTA ** 2)))
+        diff = wrap2pi_batch(fi_auf - fi_tuf)
+        return np.where(min_distance <= self.DMIN, fi_auf, wrap2pi_batch(g * diff + fi_tuf))
+
     def get_vec_with_ball(self, _robotPos: np.ndarray = None,
                           _vRobot: np.ndarray = None,
                           _ball: np.ndarray = None,
@@ -311,7 +411,28 @@ class UnivectorField:
                             _attack_goal: bool = RIGHT) -> float:
 
         section_num = univector_pos_section(_ball)
+        correct_axis = self.get_ball_axis(_ball, section_num, _attack_goal)
 
+        offset = self.get_correct_offset(_ball, section_num)
+
+        return self.get_angle_vec(_robotPos, _vRobot, _ball, correct_axis)
+
+    def get_angles_with_ball(self, positions: np.ndarray, _vRobot: np.ndarray = None,
+                             _ball: np.ndarray = None, _attack_goal: bool = RIGHT) -> np.ndarray:
+        """ get_angle_with_ball of each row of the (N, 2) array of positions """
+        correct_axis = self.get_ball_axis(_ball, univector_pos_section(_ball), _attack_goal)
+
+        return self.get_angle_vec_batch(positions, _vRobot, _ball, correct_axis)
+
+    def get_vecs_with_ball(self, positions: np.ndarray, _vRobot: np.ndarray = None,
+                           _ball: np.ndarray = None, _attack_goal: bool = RIGHT) -> np.ndarray:
+        """ get_vec_with_ball of each row of the (N, 2) array of positions, as
+            an (N, 2) array """
+        angles = self.get_angles_with_ball(positions, _vRobot, _ball, _attack_goal)
+        return np.stack([np.cos(angles), np.sin(angles)], axis=1)
+
+    def get_ball_axis(self, _ball: np.ndarray, section_num: ArenaSections,
+                      _attack_goal: bool = RIGHT) -> np.ndarray:
         if section_num == ArenaSections.CENTER:
             correct_axis = np.array(self.get_attack_goal_position(_attack_goal) - _ball, dtype=np.float32)
         else:
@@ -324,12 +445,9 @@ class UnivectorField:
                 if section_num == ArenaSections.LEFT_DOWN_CORNER or section_num == ArenaSections.LEFT_UP_CORNER:
                     correct_axis = np.array([-1.0, 0.0])
                 else:
-                    correct_axis = self.get_correct_axis(_ball, section_num, _attack_goal)                 
-                
+                    correct_axis = self.get_correct_axis(_ball, section_num, _attack_goal)
 
-        offset = self.get_correct_offset(_ball, section_num)
-
-        return self.get_angle_vec(_robotPos, _vRobot, _ball, correct_axis)
+        return correct_axis
 
     def get_correct_axis(self, position: np.ndarray, section_num: ArenaSections,
                          attack_goal: bool = RIGHT) -> np.ndarray:
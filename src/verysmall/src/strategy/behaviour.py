@@ -42,8 +42,8 @@ class BlackBoard:
         self.home_team = HomeTeam()
         self.enemy_team = EnemyTeam()
 
-    def set_robot_variables(self, robot_position, robot_orientation):
-        self.robot.position = robot_position
+    def set_robot_variables(self, robot_position, robot_orientation, timestamp=None):
+        self.robot.set_position(robot_position, timestamp)
         self.robot.orientation = robot_orientation
 
     def __repr__(self):
@@ -120,6 +120,11 @@ class FriendlyRobot(physics.MovingBody):
             self.last_know_location = value
         super().__setattr__(key, value)
 
+    def set_position(self, position, timestamp=None):
+        if position[0] or position[1]:
+            self.last_know_location = position
+        super().set_position(position, timestamp)
+
 
 class Goal:
     def __init__(self):
@@ -169,7 +174,7 @@ class Team(ABC):
         self._speeds = np.append(self._speeds, [[0, 0]], axis=0)
         self._orientations = np.append(self._orientations, [0], axis=0)
 
-    def set_team_variables(self, robot_positions, robot_orientations, robot_tag_index=-1):
+    def set_team_variables(self, robot_positions, robot_orientations, robot_tag_index=-1, timestamp=None):
 
         self.number_of_robots = 0
 
@@ -178,7 +183,7 @@ class Team(ABC):
                 self._positions[self.number_of_robots] = robot_position
                 self._orientations[self.number_of_robots] = robot_orientation
 
-                self.robots[self.number_of_robots].position = robot_position
+                self.robots[self.number_of_robots].set_position(robot_position, timestamp)
                 self.robots[self.number_of_robots].orientation = robot_orientation
 
                 self.number_of_robots += 1
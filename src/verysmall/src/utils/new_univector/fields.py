@@ -6,6 +6,8 @@ import math_utils
 import measures
 import numpy as np
 import univector
+from robot_module.movement.univector.un_field import UnivectorField
+from utils.json_handler import JsonHandler
 
 ball = measures.ball
 obstacles = list([(10, 20), (50, 10)])
@@ -59,6 +61,16 @@ def composition(r_x, r_y, ball_pos, obs_pos):
 
     return univector.Nh(phi_composed)
 
+def univectorField(positions, ball_pos, obs_pos):
+    """ The field the robots follow, for all the positions in one call """
+    constants = JsonHandler().read("parameters/univector_constants.json")
+    field = UnivectorField()
+    field.update_constants(constants['RADIUS'], constants['KR'], constants['K0'],
+                           constants['DMIN'], constants['LDELTA'])
+    field.update_obstacles(obs_pos, np.zeros((len(obs_pos), 2)))
+
+    return field.get_vecs_with_ball(positions, _vRobot=[0, 0], _ball=np.array(ball_pos, np.float64))
+
 
 
 
@@ -68,7 +80,7 @@ img_w, img_h = measures.getImageSize()
 step = measures.step
 
 field = np.zeros((img_h, img_w, 3))
-vectors = getVectors(w, h, step, composition, ball, obstacles)
+vectors = getVectors(w, h, step, univectorField, ball, obstacles)
 vectorField = draw.drawVectorField(copy(field), vectors, w, h, step, ball, obstacles)
 
 cv2.imshow('field', vectorField)
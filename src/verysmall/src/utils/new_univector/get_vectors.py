@@ -1,9 +1,12 @@
-def getVectors(w, h, step, get_vec, ball, obstacles):
-    vectors = []
+import numpy as np
 
-    for x in range(0, w, step):
-        for y in range(0, h, step):
-            vector = get_vec(x, y, ball, obstacles)
-            vectors.append(vector)
 
-    return vectors
\ No newline at end of file
+def getVectors(w, h, step, get_vecs, ball, obstacles):
+    """ get_vecs takes the (N, 2) array of the positions of the grid and
+        returns their (N, 2) vectors in one call, like the batch calls of
+        UnivectorField. The vectors go column by column, as drawVectorField
+        draws them """
+    xs, ys = np.mgrid[0:w:step, 0:h:step]
+    positions = np.stack([xs.ravel(), ys.ravel()], axis=1).astype(np.float64)
+
+    return list(get_vecs(positions, ball, obstacles))
@@ -52,16 +52,24 @@ class MovingBody:
     
     @position.setter
     def position(self, position: np.ndarray) -> None:
-        t = time.time()
+        self.set_position(position)
+
+    def set_position(self, position: np.ndarray, timestamp: float = None) -> None:
+        """ Updates the position measured at timestamp, which is the time the
+            vision grabbed the frame. When it is None the current time is used """
+        t = time.time() if timestamp is None else timestamp
         dt = t - self._last_update
-        last_pos = self.position
-        self._speed = 0.1 * (position - last_pos) / dt + 0.9 * self._speed
+
+        # Repeated or out of order measurements carry no speed information
+        if dt > 0:
+            last_pos = self.position
+            self._speed = 0.1 * (position - last_pos) / dt + 0.9 * self._speed
+            self._last_update = t
 
         self.position_buffer_x.append(position[0])
         self.position_buffer_y.append(position[1])
-        self.time_buffer.append(float(time.time()))
-        
-        self._last_update = t
+        self.time_buffer.append(float(t))
+
         self._position = position
 
     def __repr__(self):
@@ -1,21 +1,41 @@
 from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import Union
 import cv2
 import numpy as np
 from threading import Thread, Semaphore
 import rospy
 import pickle
+import time
 import os
 
 from utils.json_handler import JsonHandler
+from vision_module.camera_module.frame_source import FrameSource
 
 # @author Wellington Castro <wvmcastro>
 
-class Camera:
+# imdecode flags for each supported decode scale
+DECODE_FLAGS = {1: cv2.IMREAD_COLOR,
+                2: cv2.IMREAD_REDUCED_COLOR_2,
+                4: cv2.IMREAD_REDUCED_COLOR_4,
+                8: cv2.IMREAD_REDUCED_COLOR_8}
+
+class Camera(FrameSource):
     def __init__(self, device_id: Union[int, str] = 0,
                  params_file_name: str = "",
                  lens_correction: bool = True,
-                 threading: bool = False):
+                 threading: bool = False,
+                 raw_mjpeg: bool = False,
+                 decode_scale: int = 1,
+                 decoder_threads: int = 0,
+                 fixed_point_maps: bool = True):
+        """ In the raw_mjpeg mode the device delivers the compressed MJPEG
+            buffers and the camera decodes them itself, at 1/decode_scale of
+            the resolution. With the threading mode and decoder_threads > 0
+            consecutive frames are decoded in parallel by a pool of threads.
+            The lens correction remaps with the fixed point maps unless
+            fixed_point_maps is off, then it uses the float maps """
+        super().__init__()
 
         self.id = device_id
         self.lens_correction = lens_correction
@@ -26,19 +46,43 @@ class Camera:
 
         self.json_handler = JsonHandler()
         self.frame = None
+        self._grab_time = None
+        self._encoded = None
+
+        if decode_scale not in DECODE_FLAGS:
+            raise ValueError("decode_scale must be one of %s" % sorted(DECODE_FLAGS))
+
+        self.raw_mjpeg = raw_mjpeg
+        self.decode_scale = decode_scale if raw_mjpeg else 1
+        self._scale = self.decode_scale
+        self._lens_maps = {}
+        self.fixed_point_maps = fixed_point_maps
+        self._fixed_maps = {}
+        self._decoder = None
 
         if self.params_file_name != "":
             self._load_params()
             self.set_device(self.frame_width, self.frame_height)
-            self.capture_frame = self._capture_and_correct_frame
+            self.set_lens_correction(self.lens_correction)
         else:
             self.capture_frame = self._capture_frame
 
+        if self.raw_mjpeg:
+            self._set_raw_capture()
+
         self._calibrate_sensors()
 
         if self.threading == True:
             self._buffer_semaphore = Semaphore(0)
-            self.buffer = deque(maxlen=1)
+
+            # Only the frames decoded with the lens correction go to the pool,
+            # which is what capture_frame delivers when there is a params file
+            buffer_size = 1
+            if self.raw_mjpeg and decoder_threads > 0 and self.params_file_name != "":
+                self._decoder = ThreadPoolExecutor(max_workers=decoder_threads)
+                buffer_size = decoder_threads
+
+            self.buffer = deque(maxlen=buffer_size)
             self._start_reading_process()
             self._read = self._threaded_read
         else:
@@ -61,23 +105,144 @@ class Camera:
         if not self.thread_stopped:
             self.thread_stopped = True
 
+        if self._decoder is not None:
+            self._decoder.shutdown(wait=False)
+
+    def release(self) -> None:
+        self.capture.release()
+
     def _update(self) -> None:
         while not self.thread_stopped:
-            frame = self.capture_frame()
-            bufferFull = len(self.buffer)
-            self.buffer.append(frame)
+            if self._decoder is not None:
+                # The frame is a future here, read waits for its decoding. A
+                # full buffer drops the oldest frame
+                ret, data = self._grab_and_retrieve()
+                if not ret:
+                    continue
+                frame = self._decoder.submit(self._decode_and_correct, data.copy())
+                self._encoded = None
+            else:
+                frame = self.capture_frame()
+            bufferFull = len(self.buffer) == self.buffer.maxlen
+            self.buffer.append((frame, self._grab_time, self._encoded))
             if not bufferFull:
                 self._buffer_semaphore.release()
 
+    def _grab_and_retrieve(self):
+        grabbed = self.capture.grab()
+        self._grab_time = time.time()
+        if not grabbed:
+            return False, None
+        return self.capture.retrieve()
+
+    def _read_device(self):
+        """ Same as capture.read, but the frame is stamped right after the
+            grab, before the time spent decoding it """
+        ret, frame = self._grab_and_retrieve()
+        self._encoded = None
+        if ret and self.raw_mjpeg:
+            # The device may reuse the buffer for the next frame
+            if self._scale == 1:
+                self._encoded = frame.copy()
+            frame = self._decode(frame)
+        return ret, frame
+
+    def _decode(self, data: np.ndarray) -> np.ndarray:
+        return cv2.imdecode(data, DECODE_FLAGS[self._scale])
+
+    def _decode_and_correct(self, data: np.ndarray) -> np.ndarray:
+        frame = self._decode(data)
+        if self.lens_correction and self.mapx is not None:
+            map1, map2 = self._get_remap_maps()
+            frame = cv2.remap(frame, map1, map2, cv2.INTER_LINEAR)
+        return frame
+
+    def _set_raw_capture(self) -> None:
+        """ Asks the device for the compressed buffers. Not all backends can
+            deliver them, in that case the camera goes back to the normal mode """
+        self.capture.set(cv2.CAP_PROP_FORMAT, -1)
+        self.capture.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+
+        ret, data = self._grab_and_retrieve()
+        if ret and (data.ndim != 2 or data.shape[0] != 1):
+            rospy.logwarn("Camera: the device does not deliver raw MJPEG buffers, "
+                          "decoding inside the capture instead")
+            self.capture.set(cv2.CAP_PROP_CONVERT_RGB, 1)
+            self.raw_mjpeg = False
+            self.decode_scale = self._scale = 1
+
+    def get_lens_maps(self):
+        """ Returns the lens correction maps for the frames decoded at the
+            decode scale """
+        return self._get_maps(self.decode_scale)
+
+    def _get_active_maps(self):
+        return self._get_maps(self._scale)
+
+    def _get_remap_maps(self):
+        """ Returns the maps the frames of the active scale are remapped with,
+            the fixed point ones unless they are turned off """
+        if not self.fixed_point_maps:
+            return self._get_active_maps()
+
+        if self._scale not in self._fixed_maps:
+            mapx, mapy = self._get_active_maps()
+            self._fixed_maps[self._scale] = cv2.convertMaps(mapx, mapy, cv2.CV_16SC2)
+
+        return self._fixed_maps[self._scale]
+
+    def _get_maps(self, scale: int):
+        if scale == 1 or self.mapx is None:
+            return self.mapx, self.mapy
+
+        if scale not in self._lens_maps:
+            # A reduced frame pixel (u, v) is the full frame pixel
+            # (s * u + (s - 1) / 2, s * v + (s - 1) / 2). The resize samples
+            # the maps at these points and the values are brought to the
+            # reduced frame coordinates the same way
+            h, w = self.mapx.shape[:2]
+            size = (-(-w // scale), -(-h // scale))
+            offset = (scale - 1) / 2.
+            self._lens_maps[scale] = tuple(
+                ((cv2.resize(np.float32(m), size, interpolation=cv2.INTER_LINEAR) - offset) / scale)
+                for m in (self.mapx, self.mapy))
+
+        return self._lens_maps[scale]
+
+    def set_reduced_decode(self, reduced: bool) -> None:
+        """ Switches between the decode scale and the full resolution. The
+            calibration tools work over the full resolution frames """
+        self._scale = self.decode_scale if reduced else 1
+
     def _capture_frame(self) -> np.ndarray:
-        ret, frame = self.capture.read()
+        ret, frame = self._read_device()
         return ret, frame
 
     def _capture_and_correct_frame(self) -> np.ndarray:
-        _, frame = self.capture.read()
-        frame = cv2.remap(frame, self.mapx, self.mapy, cv2.INTER_LINEAR)
+        _, frame = self._read_device()
+        map1, map2 = self._get_remap_maps()
+        frame = cv2.remap(frame, map1, map2, cv2.INTER_LINEAR)
+        self._encoded = None
+        return frame
+
+    def _capture_raw_frame(self) -> np.ndarray:
+        _, frame = self._read_device()
         return frame
 
+    def set_lens_correction(self, lens_correction: bool) -> None:
+        """ Turns the per frame lens correction on or off. When it is off the
+            frames are delivered as they come from the sensor, which is what
+            Vision wants when it applies the lens correction itself """
+        self.lens_correction = lens_correction
+
+        if self.mapx is None:
+            return
+
+        if self.lens_correction:
+            self.capture_frame = self._capture_and_correct_frame
+        else:
+            self.capture_frame = self._capture_raw_frame
+
     def read(self) -> np.ndarray:
         try:
             return self._read()
@@ -88,11 +253,27 @@ class Camera:
 
     def _threaded_read(self) -> np.ndarray:
         self._buffer_semaphore.acquire()
-        frame =  self.buffer.popleft()
+        item = self.buffer.popleft()
+        if isinstance(item[0], Future):
+            # Waits for the oldest frame, then takes the newest one already
+            # decoded and drops the older ones, so a slow reader gets the
+            # latest frame as with a single frame buffer
+            item[0].result()
+            decoded = [i for i, (frame, *_) in enumerate(list(self.buffer)) if frame.done()]
+            for _ in range(decoded[-1] + 1 if decoded else 0):
+                if not self._buffer_semaphore.acquire(blocking=False):
+                    break
+                item = self.buffer.popleft()
+
+        frame, self.timestamp, self.encoded = item
+        if isinstance(frame, Future):
+            frame = frame.result()
         return frame
 
     def _sequential_read(self) -> np.ndarray:
         frame = self.capture_frame()
+        self.timestamp = self._grab_time
+        self.encoded = self._encoded
         return frame
 
     def _load_params(self) -> None:
@@ -109,7 +290,13 @@ class Camera:
         """ mapx and mapy are the matrix with the lens correction map """
         self.mapx = params['matrix_x']
         self.mapy = params['matrix_y']
-        # self.mapx, self.mapy = cv2.convertMaps(mapx, mapy, cv2.CV_16SC2)
+
+        # The float maps are still needed to compose them with other maps
+        # and to scale them. The fixed point maps of the full resolution are
+        # cached in the params file by get_camera_matrices, the older files
+        # only have the float maps
+        if 'fixed_map1' in params:
+            self._fixed_maps[1] = (params['fixed_map1'], params['fixed_map2'])
 
         """ The frame width and height """
         self.frame_width = params['default_frame_width']
@@ -126,5 +313,7 @@ class Camera:
 
     def __repr__(self) -> str:
         return "Camera(device_id=%r, params_file_name=%r, lens_correction=%r, " \
-               "threading=%r)" % (self.id, self.params_file_name,
-                                  self.lens_correction, self.threading)
+               "threading=%r, raw_mjpeg=%r, decode_scale=%r, " \
+               "fixed_point_maps=%r)" % (self.id, self.params_file_name, self.lens_correction,
+                                         self.threading, self.raw_mjpeg, self.decode_scale,
+                                         self.fixed_point_maps)
@@ -0,0 +1,159 @@
+from abc import ABC, abstractmethod
+from typing import List, Optional
+import os
+import time
+import cv2
+import numpy as np
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tiff")
+
+
+class FrameSource(ABC):
+    """ Everything Vision needs from a camera. Camera is the live source,
+        the other sources feed Vision with recorded or rendered frames so the
+        vision loop can run and be profiled without the camera """
+
+    def __init__(self):
+        # Time when the last frame returned by read was grabbed
+        self.timestamp = None
+
+        # Lens correction maps, None when the frames need no correction
+        self.mapx = None
+        self.mapy = None
+
+        # Intrinsics used by the aruco seeker
+        self.camera_matrix = None
+        self.dist_vector = None
+
+        # The frames may be decoded at a fraction of the sensor resolution
+        self.decode_scale = 1
+
+        # JPEG buffer of the last frame returned by read, when the frame is
+        # exactly its decoding, so it can be stored without encoding it again
+        self.encoded = None
+
+    @abstractmethod
+    def read(self) -> Optional[np.ndarray]:
+        """ Returns the next frame, or None when there is none """
+
+    def set_lens_correction(self, lens_correction: bool) -> None:
+        pass
+
+    def set_reduced_decode(self, reduced: bool) -> None:
+        pass
+
+    def get_lens_maps(self):
+        """ Returns the lens correction maps for the delivered frames """
+        return self.mapx, self.mapy
+
+    def get_scale_matrix(self) -> np.ndarray:
+        """ Returns the homography from the frames decoded at the decode scale
+            to the full resolution frames, where the arena params are set """
+        s = self.decode_scale
+        offset = (s - 1) / 2.
+        return np.array([[s, 0., offset], [0., s, offset], [0., 0., 1.]])
+
+    def stop(self) -> None:
+        pass
+
+    def release(self) -> None:
+        pass
+
+
+class ReplaySource(FrameSource):
+    """ Replays a video file or a directory of images. In the directory the
+        frames are read in the names order and, when all the names are numbers,
+        these numbers are the frames timestamps in seconds. Otherwise, and for
+        videos without timestamps, the frames are spaced by 1 / fps.
+
+        In the realtime mode each frame is delivered only when its original
+        time arrives, relative to the first frame. Otherwise the frames are
+        delivered as fast as they are read and stamped at that moment, like a
+        camera that runs at the speed of the consumer """
+
+    def __init__(self, path: str, realtime: bool = True, loop: bool = False,
+                 fps: float = 30.0):
+        super().__init__()
+
+        self.path = path
+        self.realtime = realtime
+        self.loop = loop
+        self.fps = fps
+        self.finished = False
+
+        self._files = None
+        self._file_times = None
+        self._capture = None
+
+        if os.path.isdir(path):
+            names = sorted(n for n in os.listdir(path) if n.lower().endswith(IMAGE_EXTENSIONS))
+            self._files = [os.path.join(path, n) for n in names]
+            self._file_times = self._times_from_names(names)
+        else:
+            self._capture = cv2.VideoCapture(path)
+
+        self._index = 0
+        self._first_time = None
+        self._start = None
+
+    def _times_from_names(self, names: List[str]) -> List[float]:
+        try:
+            return [float(os.path.splitext(n)[0]) for n in names]
+        except ValueError:
+            return [i / self.fps for i in range(len(names))]
+
+    def _next_frame(self):
+        """ Returns the next frame and its original time, or (None, None) at
+            the end of the recording """
+        if self._files is not None:
+            if self._index >= len(self._files):
+                return None, None
+            frame = cv2.imread(self._files[self._index])
+            frame_time = self._file_times[self._index]
+        else:
+            ret, frame = self._capture.read()
+            if not ret:
+                return None, None
+            # Videos without timestamps report zero for all the frames
+            frame_time = self._capture.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+            if self._index > 0 and frame_time == 0:
+                frame_time = self._index / self.fps
+
+        self._index += 1
+        return frame, frame_time
+
+    def rewind(self) -> None:
+        self._index = 0
+        self._first_time = None
+        self.finished = False
+        if self._capture is not None:
+            self._capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+
+    def read(self) -> Optional[np.ndarray]:
+        """ Returns the next frame, or None when the recording is over """
+        frame, frame_time = self._next_frame()
+        if frame is None and self.loop and self._index > 0:
+            self.rewind()
+            frame, frame_time = self._next_frame()
+
+        if frame is None:
+            self.finished = True
+            return None
+
+        if self._first_time is None:
+            self._first_time = frame_time
+            self._start = time.time()
+
+        if self.realtime:
+            self.timestamp = self._start + (frame_time - self._first_time)
+            delay = self.timestamp - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        else:
+            self.timestamp = time.time()
+
+        return frame
+
+    def release(self) -> None:
+        if self._capture is not None:
+            self._capture.release()
@@ -0,0 +1,272 @@
+from functools import partial
+from multiprocessing import shared_memory
+from typing import Callable, Optional
+import multiprocessing
+import queue
+import numpy as np
+
+from vision_module.camera_module.frame_source import FrameSource
+
+# Commands sent to the capture process
+LENS_CORRECTION = "lens_correction"
+REDUCED_DECODE = "reduced_decode"
+STOP = "stop"
+
+# Slots are aligned to cache lines
+ALIGNMENT = 64
+
+
+def ring_header(slots: int, readers: int) -> np.dtype:
+    """ Layout of the ring header. seq is the number of each frame, counted
+        from 0, and held is the slot each reader is using, -1 for none """
+    return np.dtype([("latest", np.int64),
+                     ("seq", np.int64, (slots,)),
+                     ("timestamp", np.float64, (slots,)),
+                     ("shape", np.int64, (slots, 3)),
+                     ("held", np.int64, (readers,))])
+
+
+class SharedFrameRing:
+    """ A ring of uint8 frame slots in shared memory, written by one process
+        and read by many.
+
+        The writer always fills a slot that is neither the latest frame nor
+        held by a reader, and only then makes it the latest frame, so the
+        frames never change under the readers. Taking a frame is only a swap
+        of slot indexes under the condition lock and the reader gets a view
+        of the slot, no copy. Each reader holds one slot until its next take,
+        so the ring needs at least readers + 2 slots """
+
+    def __init__(self, condition, slot_bytes: int, slots: int = 4, readers: int = 1,
+                 name: str = None):
+        """ Without name a new ring is created, otherwise the ring with that
+            name is opened. condition is a multiprocessing Condition shared by
+            the writer and all the readers """
+        if slots < readers + 2:
+            raise ValueError("the ring needs at least readers + 2 slots")
+
+        self.condition = condition
+        self.slots = slots
+        self.readers = readers
+        self.slot_bytes = -(-slot_bytes // ALIGNMENT) * ALIGNMENT
+
+        header = ring_header(slots, readers)
+        self.header_bytes = -(-header.itemsize // ALIGNMENT) * ALIGNMENT
+        self.owner = name is None
+
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True,
+                                                  size=self.header_bytes + slots * self.slot_bytes)
+        else:
+            # The readers run in processes spawned from the same parent of the
+            # capture process, which share its resource tracker, so opening
+            # the memory again does not make it tracked twice
+            self.shm = shared_memory.SharedMemory(name=name)
+
+        self.name = self.shm.name
+        self.header = np.ndarray((), header, buffer=self.shm.buf)
+        if self.owner:
+            self.header["latest"] = -1
+            self.header["seq"][:] = -1
+            self.header["held"][:] = -1
+
+        self._count = 0
+
+    def slot_view(self, slot: int, shape) -> np.ndarray:
+        shape = tuple(int(d) for d in shape if d > 0)
+        return np.ndarray(shape, np.uint8, buffer=self.shm.buf,
+                          offset=self.header_bytes + slot * self.slot_bytes)
+
+    def write(self, frame: np.ndarray, timestamp: float) -> None:
+        """ Copies the frame to a free slot and makes it the latest frame """
+        if frame.nbytes > self.slot_bytes:
+            raise ValueError("frame of %d bytes in a ring of %d bytes slots"
+                             % (frame.nbytes, self.slot_bytes))
+
+        header = self.header
+        with self.condition:
+            busy = set(header["held"].tolist())
+            busy.add(int(header["latest"]))
+            slot = next(s for s in range(self.slots) if s not in busy)
+
+        # No reader can take the slot before it is the latest one
+        np.copyto(self.slot_view(slot, frame.shape), frame)
+
+        with self.condition:
+            header["seq"][slot] = self._count
+            header["timestamp"][slot] = timestamp
+            header["shape"][slot] = frame.shape + (0,) * (3 - frame.ndim)
+            header["latest"] = slot
+            self.condition.notify_all()
+        self._count += 1
+
+    def take(self, reader: int, after: int = -1, timeout: float = None):
+        """ Waits for a frame newer than the frame number after and holds it
+            for the reader. Returns the frame view, its number and timestamp,
+            or None after the timeout. The view stays valid until the next
+            take of the same reader """
+        header = self.header
+
+        def new_frame():
+            latest = header["latest"]
+            return latest >= 0 and header["seq"][latest] > after
+
+        with self.condition:
+            if not self.condition.wait_for(new_frame, timeout):
+                return None
+            slot = int(header["latest"])
+            header["held"][reader] = slot
+            seq = int(header["seq"][slot])
+            timestamp = float(header["timestamp"][slot])
+            shape = header["shape"][slot].copy()
+
+        return self.slot_view(slot, shape), seq, timestamp
+
+    def release(self, reader: int) -> None:
+        with self.condition:
+            self.header["held"][reader] = -1
+
+    def close(self) -> None:
+        self.header = None
+        try:
+            self.shm.close()
+        except BufferError:
+            # Some frame views are still alive, the memory is unmapped when
+            # the process exits
+            pass
+        if self.owner:
+            self.shm.unlink()
+
+
+def run_capture(make_source: Callable[[], FrameSource], condition, commands, info,
+                slots: int, readers: int) -> None:
+    """ Capture loop, run in its own process. Reads the frames of the source,
+        decoded and corrected there, and writes them into a new ring. Sends
+        the ring and the source description through info once, on start """
+    source = make_source()
+    frame = source.read()
+
+    # The calibration tools turn the reduced decode off, so each slot has
+    # room for a full resolution frame
+    ring = SharedFrameRing(condition, frame.nbytes * source.decode_scale ** 2, slots, readers)
+    mapx, mapy = source.get_lens_maps()
+    info.put({"name": ring.name, "slot_bytes": ring.slot_bytes, "slots": slots,
+              "readers": readers, "decode_scale": source.decode_scale,
+              "camera_matrix": source.camera_matrix, "dist_vector": source.dist_vector,
+              "mapx": mapx, "mapy": mapy})
+
+    running = True
+    while running:
+        if frame is not None:
+            ring.write(frame, source.timestamp)
+
+        while True:
+            try:
+                command, value = commands.get_nowait()
+            except queue.Empty:
+                break
+            if command == STOP:
+                running = False
+            elif command == LENS_CORRECTION:
+                source.set_lens_correction(value)
+            elif command == REDUCED_DECODE:
+                source.set_reduced_decode(value)
+
+        if running:
+            frame = source.read()
+            running = frame is not None or not getattr(source, "finished", False)
+
+    source.stop()
+    source.release()
+    ring.close()
+
+
+class CaptureProcess:
+    """ Runs a frame source in its own process, so the capture and the
+        decoding never wait for the GIL of the processes that use the frames.
+        The frames go through a SharedFrameRing and each reader, in this
+        process or in others, gets them with a SharedFrameSource """
+
+    def __init__(self, make_source: Callable[[], FrameSource], slots: int = 4, readers: int = 1):
+        """ make_source builds the source inside the capture process, so it
+            must be picklable, like a partial of the Camera class """
+        # Spawned, not forked, so the capture does not inherit the OpenCV
+        # and ROS threads of this process
+        context = multiprocessing.get_context("spawn")
+        self.condition = context.Condition()
+        self.commands = context.Queue()
+        self._info = context.Queue()
+        self.info = None
+        self.process = context.Process(target=run_capture,
+                                       args=(make_source, self.condition, self.commands,
+                                             self._info, slots, readers),
+                                       daemon=True)
+
+    def start(self, timeout: float = 30.0) -> None:
+        """ Returns when the capture delivered its first frame """
+        self.process.start()
+        self.info = self._info.get(timeout=timeout)
+
+    def source_factory(self, reader: int = 0) -> Callable[[], "SharedFrameSource"]:
+        """ Returns a picklable builder of the source of a reader, for the
+            readers in other processes. Only the reader 0 controls the
+            capture settings """
+        return partial(SharedFrameSource, self.info, self.condition, self.commands, reader)
+
+    def get_source(self, reader: int = 0) -> "SharedFrameSource":
+        return self.source_factory(reader)()
+
+    def stop(self) -> None:
+        self.commands.put((STOP, None))
+        self.process.join(timeout=2.0)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+class SharedFrameSource(FrameSource):
+    """ Delivers the frames of a CaptureProcess. read returns a read only view
+        of the newest frame not delivered yet, valid until the next read. With
+        the reduced decode off, which is when the calibration tools run and
+        draw over the frames, read returns copies instead """
+
+    def __init__(self, info: dict, condition, commands, reader: int = 0, timeout: float = 1.0):
+        super().__init__()
+
+        self.ring = SharedFrameRing(condition, info["slot_bytes"], info["slots"],
+                                    info["readers"], name=info["name"])
+        self.commands = commands
+        self.reader = reader
+        self.timeout = timeout
+        self.copy_frames = False
+        self.seq = -1
+
+        self.decode_scale = info["decode_scale"]
+        self.camera_matrix = info["camera_matrix"]
+        self.dist_vector = info["dist_vector"]
+        self.mapx = info["mapx"]
+        self.mapy = info["mapy"]
+
+    def read(self) -> Optional[np.ndarray]:
+        """ Returns None when no new frame comes within the timeout """
+        taken = self.ring.take(self.reader, self.seq, self.timeout)
+        if taken is None:
+            return None
+
+        frame, self.seq, self.timestamp = taken
+        if self.copy_frames:
+            return frame.copy()
+        frame.flags.writeable = False
+        return frame
+
+    def set_lens_correction(self, lens_correction: bool) -> None:
+        if self.reader == 0:
+            self.commands.put((LENS_CORRECTION, lens_correction))
+
+    def set_reduced_decode(self, reduced: bool) -> None:
+        self.copy_frames = not reduced
+        if self.reader == 0:
+            self.commands.put((REDUCED_DECODE, reduced))
+
+    def release(self) -> None:
+        self.ring.release(self.reader)
+        self.ring.close()
@@ -0,0 +1,180 @@
+from typing import Dict, List, Optional
+import math
+import time
+import cv2
+import cv2.aruco as aruco
+import numpy as np
+
+from vision_module.camera_module.frame_source import FrameSource
+from vision_module.vision import get_origin_and_factor, get_region_origin_and_factor
+from vision_module.seekers.things_seeker import ARUCO_TAGS
+from vision_module import COLORS
+
+ROBOT_SIZE = 7.5
+BALL_RADIUS = 2.1
+
+# Fractional bits of the drawing coordinates, the things are drawn at their
+# sub-pixel poses
+SHIFT = 4
+
+
+def fixed_point(values) -> np.ndarray:
+    return np.int32(np.round(np.asarray(values) * (1 << SHIFT)))
+
+
+class SyntheticArenaSource(FrameSource):
+    """ Renders camera frames of an arena with the ball and the robots of both
+        teams at known poses, so the vision output can be compared with the
+        ground truth. Each team is drawn with the tags its seeker looks for:
+        a team color square for kmeans, a team color circle and an id color
+        circle for color, and a team color aruco marker for aruco.
+
+        The arena is drawn straight in the arena image coordinates and then
+        unwarped with the warp matrix of the arena params, so Vision gets back
+        the same image after its warp. The things move around the field a
+        little in each frame and the poses of the last frame read are in the
+        ground_truth dict, in centimeters and radians """
+
+    def __init__(self, arena_params: dict, colors_thresholds: Dict[str, dict],
+                 seekers: Dict[str, str], num_yellow_robots: int, num_blue_robots: int,
+                 frame_size=(640, 480), fps: float = 120.0, num_frames: int = None,
+                 aruco_tags: List[int] = ARUCO_TAGS, field_region=None):
+        """ aruco_tags has the marker id drawn on each robot slot. With a
+            field_region the frames show only that part of the field, like one
+            of the cameras of the fused vision """
+        super().__init__()
+
+        self.seekers = seekers
+        self.num_yellow_robots = num_yellow_robots
+        self.num_blue_robots = num_blue_robots
+        self.frame_size = frame_size
+        self.fps = fps
+        self.num_frames = num_frames
+        self.aruco_tags = aruco_tags
+        self.frame_count = 0
+        self.finished = False
+
+        self.arena_size = tuple(arena_params["arena_size"])
+        self.arena_vertices = np.array(arena_params["arena_vertices"])
+        self.warp_matrix = np.asarray(arena_params["warp_matrix"], np.float64)
+        if field_region is not None:
+            self.origin, self.factor_x, self.factor_y = \
+                get_region_origin_and_factor(field_region, self.arena_size)
+        else:
+            self.origin, self.factor_x, self.factor_y = get_origin_and_factor(self.arena_vertices)
+
+        # Pixels per centimeter, for the sizes
+        self.scale = 2.0 / (self.factor_x + self.factor_y)
+
+        # Each color is drawn with the center of its thresholds
+        self.colors = {c: self._bgr_from_thresholds(t) for c, t in colors_thresholds.items()}
+        primary_colors = {"blue", "yellow", "orange"}
+        self.id_colors = sorted(set(colors_thresholds.keys()) - primary_colors)
+
+        # Same dictionary of the ArucoSeeker
+        self.aruco_dict = aruco.Dictionary_create(68, 3)
+
+        # An ideal pinhole camera looking down at the arena, for the aruco pose
+        w, h = frame_size
+        self.camera_matrix = np.array([[w, 0., w / 2.], [0., w, h / 2.], [0., 0., 1.]])
+        self.dist_vector = np.zeros(5)
+
+        self.background = np.zeros((self.arena_size[1], self.arena_size[0], 3), np.uint8)
+        cv2.fillConvexPoly(self.background, self.arena_vertices.astype(np.int32), (40, 40, 40))
+        self.arena_image = np.empty_like(self.background)
+
+        self.ground_truth = {}
+
+    @staticmethod
+    def _bgr_from_thresholds(thresholds: dict) -> tuple:
+        hsv = ((thresholds["min"].astype(int) + thresholds["max"]) // 2).astype(np.uint8)
+        bgr = cv2.cvtColor(hsv.reshape(1, 1, 3), cv2.COLOR_HSV2BGR)[0, 0]
+        return tuple(int(c) for c in bgr)
+
+    def to_pixel(self, pos) -> np.ndarray:
+        return self.origin + np.array([pos[0] / self.factor_x, -pos[1] / self.factor_y])
+
+    def get_poses(self, t: float) -> dict:
+        """ Returns the poses of all things at the time t, in seconds. Each
+            thing runs its own ellipse around the field with a different phase
+            and the robots face the direction they move """
+        def ellipse(k, n, speed, rx, ry):
+            phase = 2 * math.pi * k / max(n, 1)
+            a = speed * t + phase
+            pos = np.array([75. + rx * math.cos(a), 65. + ry * math.sin(a)])
+            orientation = math.atan2(ry * math.cos(a), -rx * math.sin(a))
+            return pos, orientation
+
+        yellow = [ellipse(k, self.num_yellow_robots, .4, 55., 45.) for k in range(self.num_yellow_robots)]
+        blue = [ellipse(k + .5, self.num_blue_robots, -.3, 35., 25.) for k in range(self.num_blue_robots)]
+        ball, _ = ellipse(0, 1, .9, 20., 50.)
+
+        return {"ball": ball, "yellow": yellow, "blue": blue}
+
+    def draw_robot(self, img: np.ndarray, seeker: str, team_color: str, slot: int,
+                   pos: np.ndarray, orientation: float) -> None:
+        center = self.to_pixel(pos)
+        size = ROBOT_SIZE * self.scale
+
+        # Robot body, a square facing the orientation
+        body = cv2.boxPoints(((center[0], center[1]), (size, size), -math.degrees(orientation)))
+        body_color = self.colors[team_color] if seeker == "kmeans" else COLORS.WHITE
+        cv2.fillConvexPoly(img, fixed_point(body), body_color, cv2.LINE_AA, SHIFT)
+
+        if seeker == "color":
+            # The seeker takes the middle of the two circles as the robot
+            # position and their direction minus 45 degrees as its orientation
+            radius = .22 * size
+            direction = orientation + math.pi / 4
+            offset = .75 * radius * np.array([math.cos(direction), -math.sin(direction)])
+            id_color = self.colors[self.id_colors[slot % len(self.id_colors)]]
+            cv2.circle(img, tuple(fixed_point(center - offset).tolist()), int(fixed_point(radius)),
+                       self.colors[team_color], -1, cv2.LINE_AA, SHIFT)
+            cv2.circle(img, tuple(fixed_point(center + offset).tolist()), int(fixed_point(.45 * radius)),
+                       id_color, -1, cv2.LINE_AA, SHIFT)
+
+        elif seeker == "aruco":
+            # The black cells of the marker are painted with the team color,
+            # because the seeker looks for the marker in the inverted team mask
+            side = int(round(.75 * size))
+            marker = aruco.drawMarker(self.aruco_dict, self.aruco_tags[slot], side)
+            patch = np.full((side, side, 3), COLORS.WHITE, np.uint8)
+            patch[marker == 0] = self.colors[team_color]
+
+            rotation = cv2.getRotationMatrix2D((side / 2., side / 2.), math.degrees(orientation), 1.)
+            rotation[:, 2] += center - side / 2.
+            cv2.warpAffine(patch, rotation, (img.shape[1], img.shape[0]), dst=img,
+                           flags=cv2.INTER_NEAREST, borderMode=cv2.BORDER_TRANSPARENT)
+
+    def render(self, poses: dict) -> np.ndarray:
+        """ Draws the arena image of the poses and returns the camera frame """
+        img = self.arena_image
+        np.copyto(img, self.background)
+
+        for team_color, num_robots in (("yellow", self.num_yellow_robots), ("blue", self.num_blue_robots)):
+            for slot in range(num_robots):
+                pos, orientation = poses[team_color][slot]
+                self.draw_robot(img, self.seekers[team_color], team_color, slot, pos, orientation)
+
+        ball = self.to_pixel(poses["ball"])
+        cv2.circle(img, tuple(fixed_point(ball).tolist()), int(fixed_point(BALL_RADIUS * self.scale)),
+                   self.colors["orange"], -1, cv2.LINE_AA, SHIFT)
+
+        # The warp matrix goes from the camera frame to the arena image
+        return cv2.warpPerspective(img, self.warp_matrix, self.frame_size,
+                                   flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP)
+
+    def read(self) -> Optional[np.ndarray]:
+        """ Returns the next frame, or None after num_frames frames. The frames
+            are stamped when rendered, but the things move as if they were
+            filmed at the fps rate """
+        if self.num_frames is not None and self.frame_count >= self.num_frames:
+            self.finished = True
+            return None
+
+        self.ground_truth = self.get_poses(self.frame_count / self.fps)
+        frame = self.render(self.ground_truth)
+
+        self.frame_count += 1
+        self.timestamp = time.time()
+        return frame
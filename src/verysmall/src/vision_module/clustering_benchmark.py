@@ -0,0 +1,122 @@
+#!/usr/bin/python3
+""" Compares the numpy clustering of the GeneralMultObjSeeker with the
+    scikit-learn KMeans it replaced, which clustered all the contour points
+    of the team mask. Both run warm started over the same rendered team masks,
+    where the robots run crossing ellipses, so they touch now and then, and
+    the masks have salt noise. It reports the time per frame and the distance
+    from each true robot to the closest center.
+
+    It must be run from the src directory, scikit-learn is only needed for
+    the comparison:
+
+        python3 -m vision_module.clustering_benchmark --robots 5 --noise 50
+"""
+from argparse import ArgumentParser
+import math
+import time
+import cv2
+import numpy as np
+
+from vision_module.seekers.general_mult_obj_seeker import GeneralMultObjSeeker
+
+IMAGE_SIZE = (525, 406)
+ROBOT_SIZE = 16
+
+
+class ContourKMeansSeeker:
+    """ The GeneralMultObjSeeker clustering before the numpy clusterer """
+
+    def __init__(self, num_objects: int):
+        from sklearn.cluster import KMeans
+
+        self.num_objects = num_objects
+        self.kmeans = KMeans(n_clusters=num_objects, n_init=1, max_iter=30)
+        self.objects = None
+
+    def seek(self, img: np.ndarray) -> np.ndarray:
+        cnts, _ = cv2.findContours(img, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+        if len(cnts) > 0:
+            points = np.vstack([c.reshape(-1, 2) for c in cnts])
+            if points.shape[0] > self.num_objects:
+                warm = self.objects is not None
+                if warm:
+                    self.kmeans.init = self.objects
+                self.kmeans.fit(points)
+
+                if warm:
+                    changes = np.linalg.norm(self.kmeans.cluster_centers_ - self.objects, axis=1) > 2.5
+                    self.objects[changes] = self.kmeans.cluster_centers_[changes]
+                else:
+                    self.objects = self.kmeans.cluster_centers_
+
+        return self.objects
+
+
+def render_masks(num_robots: int, num_frames: int, noise: int, seed: int = 0):
+    """ Yields the team mask and the (num_robots, 2) true positions of each
+        frame. Half of the robots run each way, so they meet on the way """
+    rng = np.random.default_rng(seed)
+    w, h = IMAGE_SIZE
+    mask = np.zeros((h, w), np.uint8)
+
+    for frame in range(num_frames):
+        t = frame / 120.
+        truth = np.empty((num_robots, 2))
+        mask[:] = 0
+        for k in range(num_robots):
+            direction = 1 if k % 2 == 0 else -1
+            a = direction * .8 * t + 2 * math.pi * k / num_robots
+            truth[k] = (w / 2 + .35 * w * math.cos(a), h / 2 + .35 * h * math.sin(a))
+            angle = math.degrees(a)
+            body = cv2.boxPoints(((truth[k, 0], truth[k, 1]), (ROBOT_SIZE, ROBOT_SIZE), angle))
+            cv2.fillConvexPoly(mask, np.int32(np.round(body)), 255)
+
+        if noise > 0:
+            mask[rng.integers(0, h, noise), rng.integers(0, w, noise)] = 255
+
+        yield mask, truth
+
+
+def run(seeker, num_robots: int, num_frames: int, noise: int, warmup: int = 10) -> dict:
+    times, errors = [], []
+    for frame, (mask, truth) in enumerate(render_masks(num_robots, num_frames + warmup, noise)):
+        t0 = time.perf_counter()
+        centers = seeker.seek(mask)
+        elapsed = time.perf_counter() - t0
+
+        if frame < warmup or centers is None:
+            continue
+        times.append(elapsed)
+        distances = np.linalg.norm(truth[:, np.newaxis] - centers[np.newaxis], axis=2)
+        errors.extend(distances.min(axis=1))
+
+    return {"time": 1000 * np.mean(times), "p99": 1000 * np.percentile(times, 99),
+            "error": np.mean(errors), "max_error": np.max(errors)}
+
+
+def main():
+    parser = ArgumentParser(description="Team clustering benchmark")
+    parser.add_argument("--robots", type=int, default=5)
+    parser.add_argument("--frames", type=int, default=1000)
+    parser.add_argument("--noise", type=int, default=50, help="noise pixels in each mask")
+    args = parser.parse_args()
+
+    seekers = [("numpy blobs", GeneralMultObjSeeker)]
+
+    t0 = time.perf_counter()
+    try:
+        import sklearn.cluster
+        print("scikit-learn import: %.0f ms" % (1000 * (time.perf_counter() - t0)))
+        seekers.append(("sklearn contours", ContourKMeansSeeker))
+    except ImportError:
+        print("scikit-learn is not installed, running only the numpy clustering")
+
+    print("%-18s %10s %10s %12s %12s" % ("clustering", "mean ms", "p99 ms", "error px", "max error"))
+    for name, seeker_class in seekers:
+        results = run(seeker_class(args.robots), args.robots, args.frames, args.noise)
+        print("%-18s %10.3f %10.3f %12.2f %12.2f" % (name, results["time"], results["p99"],
+                                                    results["error"], results["max_error"]))
+
+
+if __name__ == "__main__":
+    main()
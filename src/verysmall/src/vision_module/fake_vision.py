@@ -1,6 +1,7 @@
 import rospy
 import sys
 import cv2
+from time import time
 
 import os
 from enum import Enum
@@ -61,6 +62,7 @@ class VisionNode:
 
         self.msg.ball_pos[0] = self.ball_pos[0]*100
         self.msg.ball_pos[1] = self.ball_pos[1]*100
+        self.msg.timestamp = time()
 
         self.mercury.pub.publish(self.msg)
 
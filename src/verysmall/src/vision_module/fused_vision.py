@@ -0,0 +1,487 @@
+#!/usr/bin/python3
+""" Runs one Vision for each camera, each in its own process, and fuses their
+    detections in a single things_position stream, in centimeters of the
+    whole field. Each camera has its own arena params file, set with its own
+    ParamsSetter, where field_region tells which part of the field its arena
+    image spans.
+
+    It must be run from the src directory, with one device:arena_params pair
+    for each camera:
+
+        python3 -m vision_module.fused_vision 0:parameters/ARENA_LEFT.json 1:parameters/ARENA_RIGHT.json
+"""
+from argparse import ArgumentParser
+from functools import partial
+from typing import Callable, List
+import multiprocessing
+import queue
+import math
+import time
+import numpy as np
+import rospy
+
+from vision_module.camera_module.camera import Camera
+from vision_module.camera_module.frame_source import FrameSource
+from vision_module.vision import Vision
+from verysmall.msg import game_topic
+from utils.json_handler import JsonHandler
+from ROS.ros_vision_publisher import RosVisionPublisher, RosVisionService, new_things_state
+
+# Commands sent by the fused vision to the camera workers
+RESET = "reset"
+CROPPER = "cropper"
+COLOR_CALIBRATION = "color_calibration"
+LATENCY_REPORT = "latency_report"
+STOP = "stop"
+
+# Slots of the ball and of the robots in the fuser arrays, the same order of
+# the positions in the things state
+NUM_SLOTS = 11
+TEAM_SLOTS = {"yellow": 1, "blue": 6}
+
+FIELD_REGION = (0., 0., 150., 130.)
+
+
+def get_state_views(state: np.ndarray):
+    """ Returns the (11, 2) positions of all the slots of a things state and
+        their orientations, the ball orientation is always nan """
+    flat_state = state.reshape(1).view(np.float64)
+    orientation = np.empty(NUM_SLOTS)
+    orientation[0] = np.nan
+    orientation[1:] = flat_state[22:32]
+    return flat_state[:22].reshape(NUM_SLOTS, 2), orientation
+
+
+def has_pixels(mask, x: int, y: int, radius: int) -> bool:
+    """ Whether the binary mask has pixels in the window around (x, y). The
+        mask is a full image or, with the detection pyramid, a list of
+        (patch, offset) pairs """
+    if isinstance(mask, np.ndarray):
+        mask = [(mask, (0, 0))]
+
+    for patch, (x0, y0) in mask:
+        window = patch[max(y - y0 - radius, 0):max(y - y0 + radius + 1, 0),
+                       max(x - x0 - radius, 0):max(x - x0 + radius + 1, 0)]
+        if window.any():
+            return True
+    return False
+
+
+def get_seen(vision: Vision, radius: int = 3) -> np.ndarray:
+    """ Returns which slots of the vision state were found in its last frame.
+        The others hold a prediction of the filters or nothing at all. The
+        kmeans seeker keeps its last centers when the team leaves the view of
+        the camera, so its robots only count when their team mask has pixels
+        around them """
+    seen = np.zeros(NUM_SLOTS, bool)
+    for team, base, things in (("ball", 0, [vision.ball]),
+                               ("yellow", TEAM_SLOTS["yellow"], vision.yellow_team),
+                               ("blue", TEAM_SLOTS["blue"], vision.blue_team)):
+        mask = None
+        if team != "ball" and vision.seekers[team] == "kmeans":
+            mask = vision.yellow_seg if team == "yellow" else vision.blue_seg
+
+        for thing in things:
+            if thing.id < 0 or thing.lost_counter != 0 or thing.pos[0] is None:
+                continue
+            if mask is not None:
+                x, y = np.int32(np.round(vision.hawk_eye.real_world_to_pixel(thing.pos)))
+                if not has_pixels(mask, x, y, radius):
+                    continue
+            seen[base + thing.id] = True
+
+    return seen
+
+
+def run_camera_worker(index: int, make_source: Callable[[], FrameSource], vision_kwargs: dict,
+                      detections: multiprocessing.Queue, commands: multiprocessing.Queue) -> None:
+    """ Frame loop of one camera, run in its own process. The detections of
+        each frame go to the fuser, and are dropped when it falls behind """
+    vision = Vision(make_source(), ros_node=False, **vision_kwargs)
+    vision.last_time = time.time()
+
+    while True:
+        try:
+            command = commands.get_nowait()
+        except queue.Empty:
+            command = None
+
+        if command == STOP:
+            break
+        elif command == RESET:
+            vision.hawk_eye.reset(vision.hawk_eye_extra_params)
+            vision.reset_all_things()
+        elif command == CROPPER:
+            vision.toggle_calibration(True)
+            vision.params_setter.run()
+            vision.load_params()
+            vision.update_field_conversion()
+            vision.toggle_calibration(False)
+        elif command == COLOR_CALIBRATION:
+            vision.toggle_calibration(True)
+            vision.color_calibrator.run()
+            vision.load_colors_params()
+            vision.toggle_calibration(False)
+        elif command == LATENCY_REPORT:
+            rospy.loginfo("Camera %d vision latency (ms)\n%s" % (index, vision.latency.report()))
+            vision.latency.reset()
+
+        frame = vision.preprocess()
+        if frame is None:
+            continue
+        vision.process_frame(frame)
+
+        try:
+            detections.put_nowait((index, vision.frame_timestamp, vision.things_state.copy(),
+                                   get_seen(vision), vision.field_region))
+        except queue.Full:
+            pass
+
+    vision.camera.stop()
+    vision.camera.release()
+
+
+class CameraDetections:
+    """ The newest detections of one camera and the speed of each slot in it """
+
+    def __init__(self):
+        self.timestamp = None
+        self.pos = np.full((NUM_SLOTS, 2), np.nan)
+        self.orientation = np.full(NUM_SLOTS, np.nan)
+        self.velocity = np.zeros((NUM_SLOTS, 2))
+        self.seen = np.zeros(NUM_SLOTS, bool)
+        self.field_region = FIELD_REGION
+
+
+class VisionFuser:
+    """ Fuses the detections of cameras that see different parts of the field.
+
+        The cameras are not synchronized, so the detections of each camera
+        are first brought to the fusion time with their speed, and the ones
+        older than max_age are ignored. The same thing seen by two cameras,
+        where their views overlap, is averaged, weighted by how far it is from
+        the border of each view, where it may be cut. The ball and the robots
+        of the aruco and color seekers are matched by their slot. The kmeans
+        slots mean nothing across cameras, so its robots closer than
+        merge_distance are taken as the same robot and keep the slot of the
+        nearest fused robot of the last fusion.
+
+        A slot that no camera sees keeps moving with its last speed for
+        hold_time and is then cleared """
+
+    def __init__(self, num_cameras: int, seekers: dict, num_yellow_robots: int,
+                 num_blue_robots: int, merge_distance: float = 6., max_age: float = .05,
+                 hold_time: float = .5, velocity_smoothing: float = .5):
+        """ merge_distance is in centimeters and must be smaller than a robot,
+            the times are in seconds """
+        self.seekers = seekers
+        self.num_robots = {"yellow": num_yellow_robots, "blue": num_blue_robots}
+        self.merge_distance = merge_distance
+        self.max_age = max_age
+        self.hold_time = hold_time
+        self.velocity_smoothing = velocity_smoothing
+
+        self.cameras = [CameraDetections() for _ in range(num_cameras)]
+
+        # Time of the last fusion
+        self.timestamp = 0.
+
+        self.state = new_things_state()
+        flat_state = self.state.reshape(1).view(np.float64)
+        self._state_pos = flat_state[:22].reshape(NUM_SLOTS, 2)
+        self._state_orientation = flat_state[22:32]
+
+        self.reset()
+
+    def reset(self) -> None:
+        for camera in self.cameras:
+            camera.timestamp = None
+            camera.seen[:] = False
+        self.pos = np.full((NUM_SLOTS, 2), np.nan)
+        self.orientation = np.full(NUM_SLOTS, np.nan)
+        self.velocity = np.zeros((NUM_SLOTS, 2))
+        self.last_seen = np.full(NUM_SLOTS, -np.inf)
+
+    def update(self, camera: int, timestamp: float, state: np.ndarray, seen: np.ndarray,
+               field_region=None) -> None:
+        """ Stores the detections of a camera frame. state is its things
+            state and seen tells which of its slots were found in the frame """
+        detections = self.cameras[camera]
+        pos, orientation = get_state_views(state)
+
+        if detections.timestamp is not None and timestamp > detections.timestamp:
+            dt = timestamp - detections.timestamp
+            moving = seen & detections.seen
+            s = self.velocity_smoothing
+            detections.velocity[moving] = s * detections.velocity[moving] + \
+                (1 - s) * (pos[moving] - detections.pos[moving]) / dt
+        detections.velocity[~(seen & detections.seen)] = 0.
+
+        detections.timestamp = timestamp
+        detections.pos[:] = pos
+        detections.orientation[:] = orientation
+        detections.seen[:] = seen
+        detections.field_region = FIELD_REGION if field_region is None else field_region
+
+    def get_candidates(self, now: float):
+        """ Returns the positions, brought to now, the orientations, speeds,
+            weights and slots of all the fresh detections of all cameras """
+        pos, orientation, velocity, weights, slots = [], [], [], [], []
+        for detections in self.cameras:
+            if detections.timestamp is None or abs(now - detections.timestamp) > self.max_age:
+                continue
+
+            slot = np.flatnonzero(detections.seen)
+            aligned = detections.pos[slot] + detections.velocity[slot] * (now - detections.timestamp)
+
+            # Distance to the border of the camera view
+            x_min, y_min, x_max, y_max = detections.field_region
+            border = np.minimum.reduce([aligned[:, 0] - x_min, x_max - aligned[:, 0],
+                                        aligned[:, 1] - y_min, y_max - aligned[:, 1]])
+
+            pos.append(aligned)
+            orientation.append(detections.orientation[slot])
+            velocity.append(detections.velocity[slot])
+            weights.append(np.maximum(border, 1.))
+            slots.append(slot)
+
+        if not pos:
+            return np.empty((0, 2)), np.empty(0), np.empty((0, 2)), np.empty(0), np.empty(0, int)
+        return (np.concatenate(pos), np.concatenate(orientation), np.concatenate(velocity),
+                np.concatenate(weights), np.concatenate(slots))
+
+    def group(self, pos: np.ndarray, weights: np.ndarray) -> List[np.ndarray]:
+        """ Groups the detections closer than merge_distance to the heaviest
+            detection of the group. Returns the indexes of each group, the
+            heaviest groups first """
+        groups = []
+        free = np.ones(weights.size, bool)
+        for i in np.argsort(-weights, kind="stable"):
+            if not free[i]:
+                continue
+            members = np.flatnonzero(free & (np.linalg.norm(pos - pos[i], axis=1) < self.merge_distance))
+            free[members] = False
+            groups.append(members)
+
+        groups.sort(key=lambda members: -weights[members].sum())
+        return groups
+
+    def fuse(self, now: float = None) -> np.ndarray:
+        """ Fuses the detections of all cameras at the time now, by default
+            the time of the newest camera frame, and returns the fused things
+            state. The returned buffer is reused by the next fusion """
+        if now is None:
+            now = max([d.timestamp for d in self.cameras if d.timestamp is not None], default=0.)
+        self.timestamp = now
+
+        pos, orientation, velocity, weights, slots = self.get_candidates(now)
+        fused = np.zeros(NUM_SLOTS, bool)
+
+        def merge(slot, members):
+            w = weights[members]
+            self.pos[slot] = np.average(pos[members], axis=0, weights=w)
+            self.velocity[slot] = np.average(velocity[members], axis=0, weights=w)
+            oriented = members[~np.isnan(orientation[members])]
+            if oriented.size:
+                w = weights[oriented]
+                self.orientation[slot] = math.atan2(np.dot(w, np.sin(orientation[oriented])),
+                                                    np.dot(w, np.cos(orientation[oriented])))
+            fused[slot] = True
+
+        # The ball and the robots with ids. Each slot only merges the
+        # detections around its heaviest one, which drops the wrong ones
+        id_slots = [0] + [TEAM_SLOTS[team] + i for team in ("yellow", "blue")
+                          if self.seekers[team] != "kmeans" for i in range(self.num_robots[team])]
+        for slot in id_slots:
+            candidates = np.flatnonzero(slots == slot)
+            if candidates.size:
+                merge(slot, candidates[self.group(pos[candidates], weights[candidates])[0]])
+
+        for team in ("yellow", "blue"):
+            if self.seekers[team] == "kmeans":
+                self.fuse_unidentified(team, pos, weights, slots, merge)
+
+        # The slots not seen by any camera
+        self.last_seen[fused] = now
+        held = ~fused & (now - self.last_seen <= self.hold_time)
+        lost = ~fused & ~held
+        self._state_pos[fused] = self.pos[fused]
+        self._state_pos[held] = self.pos[held] + self.velocity[held] * (now - self.last_seen[held, np.newaxis])
+        self.pos[lost] = np.nan
+        self.orientation[lost] = np.nan
+
+        # The published state holds 0 for what was not found, like the single
+        # camera Vision, since a nan has no int16 in the message
+        self._state_pos[lost] = 0.
+        self._state_orientation[:] = self.orientation[1:]
+        np.nan_to_num(self._state_orientation, copy=False)
+
+        return self.state
+
+    def fuse_unidentified(self, team: str, pos: np.ndarray, weights: np.ndarray,
+                          slots: np.ndarray, merge: Callable) -> None:
+        """ Merges the robots of a team without ids and gives each merged robot
+            the slot of the nearest robot of the last fusion """
+        base = TEAM_SLOTS[team]
+        num_robots = self.num_robots[team]
+        candidates = np.flatnonzero((slots >= base) & (slots < base + num_robots))
+        groups = [candidates[g] for g in self.group(pos[candidates], weights[candidates])[:num_robots]]
+        if not groups:
+            return
+
+        centers = np.array([np.average(pos[g], axis=0, weights=weights[g]) for g in groups])
+        last = self.pos[base:base + num_robots]
+
+        # Greedy matching by distance, the slots without a last position are
+        # taken by the groups left
+        distances = np.linalg.norm(centers[:, np.newaxis] - last[np.newaxis], axis=2)
+        distances[np.isnan(distances)] = np.inf
+        group_slots = np.full(len(groups), -1)
+        taken = np.zeros(num_robots, bool)
+        for g, s in zip(*np.unravel_index(np.argsort(distances, axis=None), distances.shape)):
+            if np.isinf(distances[g, s]):
+                break
+            if group_slots[g] < 0 and not taken[s]:
+                group_slots[g] = s
+                taken[s] = True
+
+        free_slots = iter(np.flatnonzero(~taken))
+        for g, members in enumerate(groups):
+            slot = group_slots[g] if group_slots[g] >= 0 else next(free_slots)
+            merge(base + slot, members)
+
+
+class FusedVision:
+    """ Runs one camera worker process for each camera and publishes the
+        fusion of their detections. The workers do not start ROS nodes, this
+        is the only vision node """
+
+    def __init__(self, sources: List[Callable[[], FrameSource]], params_files: List[str],
+                 num_blue_robots: int, num_yellow_robots: int, colors_params: str = "",
+                 method: str = "", vision_owner: str = 'Player_One', seekers: dict = None,
+                 merge_distance: float = 6., max_age: float = .05, **vision_kwargs):
+        """ sources builds the frame source of each camera inside its worker,
+            so it must be picklable, like a partial of the Camera class.
+            params_files has the arena params file of each camera, the other
+            keyword arguments go to the Vision of each camera """
+        if seekers is None:
+            seekers = JsonHandler.read("parameters/game.json")["seekers"]
+
+        self.fuser = VisionFuser(len(sources), seekers, num_yellow_robots, num_blue_robots,
+                                 merge_distance=merge_distance, max_age=max_age)
+
+        # The workers are spawned, not forked, so they do not inherit the
+        # OpenCV and ROS threads of this process
+        context = multiprocessing.get_context("spawn")
+        self.detections = context.Queue(maxsize=4 * len(sources))
+        self.commands = [context.Queue() for _ in sources]
+        self.workers = []
+        for index, (make_source, params_file) in enumerate(zip(sources, params_files)):
+            kwargs = dict(vision_kwargs, num_blue_robots=num_blue_robots,
+                          num_yellow_robots=num_yellow_robots, params_file_name=params_file,
+                          colors_params=colors_params, method=method, seekers=seekers)
+            self.workers.append(context.Process(target=run_camera_worker,
+                                                args=(index, make_source, kwargs, self.detections,
+                                                      self.commands[index]),
+                                                daemon=True))
+
+        self.mercury = RosVisionPublisher(True)
+        rospy.Subscriber(vision_owner, game_topic, self.on_game_state_change)
+
+        self.game_state = None
+        self.fps = 0
+        self.last_time = None
+        self.finish = False
+
+    def on_game_state_change(self, data):
+        self.game_state = data.game_state
+        if self.game_state:
+            self.send_command(RESET)
+            self.fuser.reset()
+
+    def send_command(self, command: str, camera: int = None) -> None:
+        """ Sends a command to one camera worker, or to all of them """
+        for index, commands in enumerate(self.commands):
+            if camera is None or camera == index:
+                commands.put(command)
+
+    def start(self) -> None:
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self) -> None:
+        self.finish = True
+        self.send_command(STOP)
+        for worker in self.workers:
+            worker.join(timeout=2.0)
+            if worker.is_alive():
+                worker.terminate()
+
+    def update_fps(self):
+        new_time = time.time()
+        self.fps = 0.9*self.fps + 0.1 / (new_time - self.last_time)
+        self.last_time = new_time
+
+    def run(self):
+        """ Fuses and publishes on every new camera frame """
+        self.last_time = time.time()
+        while not self.finish and not rospy.is_shutdown():
+            try:
+                message = self.detections.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+            self.fuser.update(*message)
+            fused_state = self.fuser.fuse()
+
+            self.update_fps()
+            fused_state["vision_fps"] = self.fps
+            self.mercury.publish_state(fused_state, self.fuser.timestamp)
+
+
+def parse_camera(arg: str):
+    """ Splits a device:arena_params argument """
+    device, params_file = arg.rsplit(":", 1)
+    try:
+        device = int(device)
+    except ValueError:
+        pass
+    return device, params_file
+
+
+if __name__ == "__main__":
+    from vision_module.vision_node import VisionOperations
+
+    parser = ArgumentParser(description="Vision fused from several cameras")
+    parser.add_argument("cameras", nargs="+", type=parse_camera,
+                        help="device:arena_params_file of each camera")
+    parser.add_argument("--camera_params", default="parameters/CAMERA_ELP-USBFHD01M-SFV.bin")
+    parser.add_argument("--colors_params", default="parameters/COLORS.bin")
+    parser.add_argument("--method", default="color_segmentation",
+                        choices=["color_segmentation", "lut_segmentation"])
+    parser.add_argument("--owner", default="Player_One")
+    parser.add_argument("--yellow", type=int, default=4, help="number of yellow robots")
+    parser.add_argument("--blue", type=int, default=3, help="number of blue robots")
+    args = parser.parse_args()
+
+    sources = [partial(Camera, device, args.camera_params, threading=True) for device, _ in args.cameras]
+    fused_vision = FusedVision(sources, [params for _, params in args.cameras], args.blue, args.yellow,
+                               args.colors_params, method=args.method, vision_owner=args.owner)
+    fused_vision.start()
+
+    # The calibrations run in the worker of each camera, in its own windows
+    commands = {VisionOperations.CROPPER.value: CROPPER,
+                VisionOperations.COLOR_CALIBRATION.value: COLOR_CALIBRATION,
+                VisionOperations.LATENCY_REPORT.value: LATENCY_REPORT}
+
+    def vision_management(req):
+        if req.operation in commands:
+            fused_vision.send_command(commands[req.operation])
+        return True
+
+    service = RosVisionService(vision_management)
+
+    try:
+        fused_vision.run()
+    finally:
+        fused_vision.stop()
@@ -0,0 +1,139 @@
+#!/usr/bin/python3
+""" Compares the ball seeker with and without the reacquisition map when the
+    ball goes under the robots. In each episode the ball rolls from a random
+    place to a robot, which holds it hidden for up to --hold seconds, and
+    then goes on in the same direction, or with --kick of the episodes in a
+    random direction, as if the robot had kicked it. The frames are given to the seeker at the fps rate,
+    so the speeds it measures are the rendered ones.
+
+    It reports the seek time of the frames while the ball is lost, how many
+    frames after coming out the ball is found again and the seek time spent
+    from the loss to that frame. It must be run from the src directory:
+
+        python3 -m vision_module.reacquisition_benchmark --episodes 40
+"""
+from argparse import ArgumentParser
+import time
+import cv2
+import numpy as np
+
+from vision_module.seekers.ball_seeker import BallSeeker
+
+BALL_COLOR = (0, 128, 255)
+THRESHOLDS = (np.array([0, 100, 200], np.uint8), np.array([40, 160, 255], np.uint8))
+
+
+def render(background, ball, ball_radius, robots, robot_size):
+    """ The robots are drawn over the ball """
+    img = background.copy()
+    cv2.circle(img, tuple(int(round(v)) for v in ball), ball_radius, BALL_COLOR, -1)
+    half = robot_size // 2
+    for x, y in robots.astype(int):
+        cv2.rectangle(img, (x - half, y - half), (x + half, y + half), (230, 230, 230), -1)
+    return img
+
+
+def run_episodes(reacquisition: bool, args) -> dict:
+    rng = np.random.default_rng(args.seed)
+    h, w = args.height, args.width
+    background = rng.integers(20, 80, (h, w, 3), dtype=np.uint8)
+
+    seeker = BallSeeker((h, w), THRESHOLDS, reacquisition=reacquisition)
+    if reacquisition:
+        seeker.reacquisition.full_scan_period = args.full_scan_period
+    dt = 1. / args.fps
+
+    lost_times, delays, recovery_times = [], [], []
+    for _ in range(args.episodes):
+        seeker.reset()
+        margin = 60
+        ball = rng.uniform((margin, margin), (w - margin, h - margin))
+        direction = rng.normal(size=2)
+        speed = args.speed * direction / np.linalg.norm(direction)
+
+        # The robot stands on the ball path and does not move
+        robots = np.array([ball + speed * .15] + [rng.uniform((0, 0), (w, h)) for _ in range(4)])
+        robots = np.clip(robots, margin, (w - margin, h - margin))
+        seeker.occluders = robots
+        seeker.occluder_radius = args.robot_size / 2 ** .5
+        kick = rng.random() < args.kick
+
+        hold = int(rng.uniform(.1, 1.) * args.hold * args.fps)
+
+        hidden_before = tracked = False
+        recovery = 0.
+        out_frame = None
+        for frame in range(int(args.fps * (1. + args.hold))):
+            # Once fully under the robot the ball stays there while held
+            under = np.all(np.abs(ball - robots[0]) < args.robot_size / 2 - args.ball_radius)
+            if under and hold > 0:
+                hold -= 1
+                if hold == 0 and kick:
+                    direction = rng.normal(size=2)
+                    speed = 1.5 * args.speed * direction / np.linalg.norm(direction)
+            else:
+                ball = ball + speed * dt
+
+            # The ball bounces on the arena walls
+            for k, limit in ((0, w), (1, h)):
+                if not args.ball_radius <= ball[k] <= limit - args.ball_radius:
+                    speed[k] = -speed[k]
+                    ball[k] = np.clip(ball[k], args.ball_radius, limit - args.ball_radius)
+
+            hidden = np.any(np.abs(ball - robots[0]) < args.robot_size / 2 + args.ball_radius)
+            if hidden_before and not hidden:
+                out_frame = frame
+            hidden_before = hidden
+
+            img = render(background, ball, args.ball_radius, robots, args.robot_size)
+            lost = seeker.last_pos is None
+            t0 = time.perf_counter()
+            pos = seeker.seek(img)
+            elapsed = time.perf_counter() - t0
+
+            if lost and tracked:
+                lost_times.append(elapsed)
+                recovery += elapsed
+            found = pos is not None
+            tracked = tracked or found
+            if out_frame is not None and found:
+                delays.append(frame - out_frame)
+                recovery_times.append(recovery)
+                break
+
+            # Paced at the fps rate
+            time.sleep(max(dt - elapsed, 0.))
+
+    return {"lost_time": 1000 * np.mean(lost_times) if lost_times else 0.,
+            "delay": np.mean(delays) if delays else float("nan"),
+            "max_delay": max(delays) if delays else 0,
+            "recovery": 1000 * np.mean(recovery_times) if recovery_times else 0.,
+            "found": len(delays)}
+
+
+def main():
+    parser = ArgumentParser(description="Ball reacquisition after occlusions benchmark")
+    parser.add_argument("--episodes", type=int, default=40)
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=480)
+    parser.add_argument("--fps", type=float, default=120.)
+    parser.add_argument("--speed", type=float, default=300., help="ball speed, in pixels per second")
+    parser.add_argument("--ball_radius", type=int, default=8)
+    parser.add_argument("--robot_size", type=int, default=32)
+    parser.add_argument("--hold", type=float, default=.3, help="longest time the robot holds the ball, in seconds")
+    parser.add_argument("--kick", type=float, default=.25, help="part of the episodes with a kick")
+    parser.add_argument("--full_scan_period", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print("%-14s %14s %14s %12s %16s %8s" % ("seeker", "lost frame ms", "delay frames",
+                                               "max delay", "recovery ms", "found"))
+    for name, reacquisition in (("full scan", False), ("reacquisition", True)):
+        results = run_episodes(reacquisition, args)
+        print("%-14s %14.3f %14.2f %12d %16.3f %5d/%d"
+              % (name, results["lost_time"], results["delay"], results["max_delay"],
+                 results["recovery"], results["found"], args.episodes))
+
+
+if __name__ == "__main__":
+    main()
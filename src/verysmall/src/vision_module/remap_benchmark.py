@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+""" Compares the lens correction remap with the float maps and with their
+    fixed point CV_16SC2 version, which the camera uses by default. It reports
+    the size of the maps, the time per frame, how far the fixed point source
+    coordinates are from the float ones and the difference between the
+    corrected images.
+
+    The maps come from a camera params file made by get_camera_matrices or,
+    without it, from a synthetic barrel distortion. It must be run from the
+    src directory:
+
+        python3 -m vision_module.remap_benchmark --camera_params parameters/CAMERA_ELP-USBFHD01M-SFV.bin
+"""
+from argparse import ArgumentParser
+import pickle
+import time
+import cv2
+import numpy as np
+
+
+def synthetic_maps(width: int, height: int):
+    """ Float maps of a camera with a strong barrel distortion """
+    f = .8 * width
+    camera_matrix = np.array([[f, 0., width / 2.], [0., f, height / 2.], [0., 0., 1.]])
+    dist_vector = np.array([-.3, .1, 0., 0., 0.])
+    new_matrix, _ = cv2.getOptimalNewCameraMatrix(camera_matrix, dist_vector, (width, height), 1)
+    return cv2.initUndistortRectifyMap(camera_matrix, dist_vector, None, new_matrix,
+                                       (width, height), cv2.CV_32FC1)
+
+
+def test_frame(width: int, height: int, seed: int = 0) -> np.ndarray:
+    """ Smooth random texture with sharp edges, like an arena with robots """
+    rng = np.random.default_rng(seed)
+    frame = cv2.resize(rng.integers(0, 256, (height // 8, width // 8, 3), dtype=np.uint8),
+                       (width, height), interpolation=cv2.INTER_CUBIC)
+    for _ in range(200):
+        center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        cv2.circle(frame, center, int(rng.integers(3, 20)), color, -1, cv2.LINE_AA)
+    return frame
+
+
+def time_remap(frame: np.ndarray, map1: np.ndarray, map2: np.ndarray, repeats: int) -> float:
+    """ Returns the mean time of a remap, in ms """
+    dst = cv2.remap(frame, map1, map2, cv2.INTER_LINEAR)
+    t0 = time.perf_counter()
+    for _ in range(repeats):
+        cv2.remap(frame, map1, map2, cv2.INTER_LINEAR, dst=dst)
+    return 1000 * (time.perf_counter() - t0) / repeats
+
+
+def main():
+    parser = ArgumentParser(description="Float and fixed point lens correction maps benchmark")
+    parser.add_argument("--camera_params", default="", help="camera params file with the float maps")
+    parser.add_argument("--width", type=int, default=1280, help="frame width of the synthetic maps")
+    parser.add_argument("--height", type=int, default=720, help="frame height of the synthetic maps")
+    parser.add_argument("--repeats", type=int, default=200)
+    args = parser.parse_args()
+
+    if args.camera_params:
+        with open(args.camera_params, "rb") as fp:
+            params = pickle.load(fp)
+        mapx = np.asarray(params["matrix_x"], np.float32)
+        mapy = np.asarray(params["matrix_y"], np.float32)
+    else:
+        mapx, mapy = synthetic_maps(args.width, args.height)
+
+    height, width = mapx.shape[:2]
+    map1, map2 = cv2.convertMaps(mapx, mapy, cv2.CV_16SC2)
+    frame = test_frame(width, height)
+
+    # The fixed point maps keep 1/32 of a pixel, INTER_TAB_SIZE, of the
+    # source coordinates. Outside the frame both give the border
+    inside = (mapx >= 0) & (mapx <= width - 1) & (mapy >= 0) & (mapy <= height - 1)
+    back_x, back_y = cv2.convertMaps(map1, map2, cv2.CV_32FC1)
+    coordinate_error = np.hypot(back_x - mapx, back_y - mapy)[inside]
+
+    float_image = cv2.remap(frame, mapx, mapy, cv2.INTER_LINEAR)
+    fixed_image = cv2.remap(frame, map1, map2, cv2.INTER_LINEAR)
+    image_error = np.abs(float_image.astype(np.int16) - fixed_image)[inside]
+
+    print("frame: %dx%d" % (width, height))
+    print("%-8s %10s %10s" % ("maps", "MB", "ms/frame"))
+    print("%-8s %10.2f %10.3f" % ("float", (mapx.nbytes + mapy.nbytes) / 2 ** 20,
+                                  time_remap(frame, mapx, mapy, args.repeats)))
+    print("%-8s %10.2f %10.3f" % ("fixed", (map1.nbytes + map2.nbytes) / 2 ** 20,
+                                  time_remap(frame, map1, map2, args.repeats)))
+    print("source coordinates error: mean %.4f px, max %.4f px" % (coordinate_error.mean(),
+                                                                    coordinate_error.max()))
+    print("image difference: mean %.3f, max %d levels, %.2f%% of the values differ"
+          % (image_error.mean(), image_error.max(), 100 * np.count_nonzero(image_error) / image_error.size))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,30 @@
+from typing import List
 import numpy as np
 import cv2
 import rospy
 import cv2.aruco as aruco
-import math
 
 from vision_module.seekers.seeker import Seeker
+from vision_module.vision_utils.detection_pyramid import merge_boxes
 
 # @author Wellington Castro <wvmcastro>
 
 class ArucoSeeker(Seeker):
 
-    def __init__(self, cam_mtx, dist_vec, num_tags, num_bits=3, num_markers=5):
+    def __init__(self, cam_mtx, dist_vec, num_tags, num_bits=3, num_markers=5,
+                 pose_3d: bool = False, tracking: bool = False, tags: List[int] = None):
         """ Initializes the objects necessary to perform the detection
-            of the aruco tags """
+            of the aruco tags.
+
+            By default the center and the orientation of each marker come
+            straight from its four corners in the image. With pose_3d they
+            come from the projection of the marker pose estimated with the
+            camera intrinsics. In the tracking mode the markers are first
+            searched only around where they were in the last frame, and the
+            whole image is scanned every rescan_period frames while some
+            marker is missing.
+
+            When tags is given, the markers with other ids are ignored """
 
         # Hyper params to create the aruco markers dictionary
         # self.num_markers = num_markers
@@ -31,69 +43,158 @@ class ArucoSeeker(Seeker):
         self.camera_matrix = cam_mtx
         self.distortion_vector = dist_vec
 
-    def get_aruco_state(self, img, rvec, tvec, degree=False):
-        # x axis
-        x_axis = np.float32([[0,0,0],[1.0,0,0]]).reshape(-1,3)
-
-        # Do not know what is jac (sorry again). Imgpts are the start and end points
-        # of each vector of the base
-        imgpts, jac = cv2.projectPoints(x_axis, rvec, tvec, self.camera_matrix, self.distortion_vector)
-
-        # takes the tail and nose of the orientation vector
-        t, n = imgpts[0][0], imgpts[1][0]
-
-        # calculates the orientation vector
-        orientation_vec = (n-t)
-        orientation_vec[1] *= -1
-        orientation_angle = math.atan2(orientation_vec[1], orientation_vec[0])
-
-        if degree == True:
-            orientation_angle *= self.rad_to_degree_factor
-
-        # returns the center of the aruco marker and its x axis orientation
-        return t, orientation_angle
-
-    def seek(self, img, degree=False):
-
-        # Try to locate all markers in the img
+        self.tags = None if tags is None else np.asarray(tags)
+
+        self.pose_3d = pose_3d
+
+        self.tracking = tracking
+        self.full_scans = 0
+
+        # Corners of the markers found in the last frame, (n, 4, 2)
+        self.last_corners = None
+
+        # Margin of the search windows, in multiples of the marker side
+        self._window_scale = 1.0
+
+        # The markers not found in the last frame, like the ones that left
+        # the field, are only looked for by a full scan every rescan_period
+        # frames
+        self.rescan_period = 8
+        self._tracked_frames = 0
+
+    def get_planar_states(self, corners: np.ndarray):
+        """ Returns the centers and the x axis orientations of all the markers
+            from their (n, 4, 2) corners. The corners go clockwise from the
+            top left one of the marker, so its x axis goes from the left side
+            to the right side """
+        centers = corners.mean(axis=1)
+        x_axis = corners[:, 1] + corners[:, 2] - corners[:, 0] - corners[:, 3]
+        return centers, np.arctan2(-x_axis[:, 1], x_axis[:, 0])
+
+    def get_3d_states(self, corners: np.ndarray):
+        """ Same as get_planar_states, but projecting the origin and the x axis
+            of the estimated pose of each marker. The poses of all markers are
+            estimated in one call and all the points projected in another """
+        rvecs, tvecs, _ = aruco.estimatePoseSingleMarkers(corners.astype(np.float32), 0.075,
+                                                          self.camera_matrix,
+                                                          self.distortion_vector)
+        rvecs = rvecs.reshape(-1, 3)
+        tvecs = tvecs.reshape(-1, 3)
+
+        # First column of the rotation matrix of each rvec, by the Rodrigues
+        # formula, that is the marker x axis in the camera frame
+        theta = np.linalg.norm(rvecs, axis=1)
+        safe_theta = np.where(theta > 0, theta, 1.)
+        k = rvecs / safe_theta[:, np.newaxis]
+        cos, sin = np.cos(theta), np.sin(theta)
+        x_axis = np.empty_like(rvecs)
+        x_axis[:, 0] = cos + (1 - cos) * k[:, 0] * k[:, 0]
+        x_axis[:, 1] = (1 - cos) * k[:, 0] * k[:, 1] + sin * k[:, 2]
+        x_axis[:, 2] = (1 - cos) * k[:, 0] * k[:, 2] - sin * k[:, 1]
+
+        # The tail and the nose of each orientation vector
+        points = np.concatenate([tvecs, tvecs + x_axis])
+        imgpts, _ = cv2.projectPoints(points, np.zeros(3), np.zeros(3),
+                                      self.camera_matrix, self.distortion_vector)
+        imgpts = imgpts.reshape(2, -1, 2)
+        tails, noses = imgpts[0], imgpts[1]
+
+        orientation_vecs = noses - tails
+        return tails, np.arctan2(-orientation_vecs[:, 1], orientation_vecs[:, 0])
+
+    def detect(self, img):
+        """ Returns the (n, 4, 2) corners and the (n,) ids of the markers in
+            the image """
         corners, ids, _ = aruco.detectMarkers(img, self.aruco_dict, parameters=self.aruco_params)
+        if ids is None:
+            return np.empty((0, 4, 2)), np.empty(0, np.int32)
+
+        corners = np.array(corners, np.float64).reshape(-1, 4, 2)
+        ids = ids.reshape(-1)
+        if self.tags is not None:
+            known = np.isin(ids, self.tags)
+            corners, ids = corners[known], ids[known]
+
+        return corners, ids
+
+    def detect_in_windows(self, img):
+        """ Looks for the markers only in windows around their corners in the
+            last frame. The markers that are not inside their windows are
+            left out """
+        h, w = img.shape[:2]
+        sides = np.linalg.norm(self.last_corners - np.roll(self.last_corners, 1, axis=1),
+                               axis=2).mean(axis=1)
+        margins = self._window_scale * sides
+        top_lefts = np.floor(self.last_corners.min(axis=1) - margins[:, np.newaxis])
+        bottom_rights = np.ceil(self.last_corners.max(axis=1) + margins[:, np.newaxis])
+        boxes = np.concatenate([np.maximum(top_lefts, 0), np.minimum(bottom_rights, (w, h))],
+                               axis=1).astype(int).tolist()
+
+        all_corners, all_ids = [], []
+        for x0, y0, x1, y1 in merge_boxes(boxes):
+            corners, ids = self.detect(np.ascontiguousarray(img[y0:y1, x0:x1]))
+            all_corners.append(corners + (x0, y0))
+            all_ids.append(ids)
+
+        return np.concatenate(all_corners), np.concatenate(all_ids)
 
-        identified_markers = []
-
-        if np.any(ids != None):
-            # That means at least one Aruco marker was recognized
-
-            # Reshapes the ids matrix to an ids vector for indexing simplicity
-            ids = ids.reshape(ids.shape[0] * ids.shape[1])
-
-            # Sort the ids vector, that way the same marker will be always in the
-            # same pos in the things_list
-            sorted_ids = np.sort(ids)
-
-            i = 0
-            # rospy.logfatal('ids.size: '+str(ids.size))
-            # rospy.logfatal('sorted[i]: ' + str(sorted_ids[i]))
-
-            while(i < ids.size and i < self.num_tags):
-
-                # Finds the original index of the marker before sorting
-                index = np.argwhere(ids == sorted_ids[i])[0,0]
-
-                # Estimate the marker's pose
-                rvec, tvec, _ = aruco.estimatePoseSingleMarkers(corners[ index ], 0.075,
-                                self.camera_matrix, self.distortion_vector)
-
-                # Gets the marker state, ie: its center and x axis orientation
-                center, orientation = self.get_aruco_state(img, rvec, tvec, degree)
+    def seek(self, img, degree=False):
 
-                identified_markers.append([sorted_ids[i], center, orientation])
+        # Try to locate the markers seen in the last frame inside their
+        # windows. The whole img is still scanned from time to time while
+        # some marker is missing, so a marker that shows up again is found
+        found = None
+        if self.tracking and self.last_corners is not None and self.last_corners.shape[0] > 0:
+            rescan = self.last_corners.shape[0] < self.num_tags and \
+                self._tracked_frames >= self.rescan_period - 1
+            if not rescan:
+                found = self.detect_in_windows(img)
+
+        if found is None:
+            self.full_scans += 1
+            self._tracked_frames = 0
+            found = self.detect(img)
+        else:
+            self._tracked_frames += 1
+
+        return self.get_states(*found, degree=degree)
+
+    def seek_patches(self, patches, degree=False):
+        """ Same as seek, but only in the (patch, offset) pairs of the
+            detection pyramid, which already play the part of the windows """
+        all_corners, all_ids = [np.empty((0, 4, 2))], [np.empty(0, np.int32)]
+        for patch, offset in patches:
+            corners, ids = self.detect(patch)
+            all_corners.append(corners + offset)
+            all_ids.append(ids)
+
+        return self.get_states(np.concatenate(all_corners), np.concatenate(all_ids), degree=degree)
+
+    def get_states(self, corners, ids, degree=False):
+        """ Returns the [id, center, orientation] of the markers, sorted by id """
+        # Sort the ids vector, that way the same marker will be always in the
+        # same pos in the things_list
+        order = np.argsort(ids, kind="stable")[:self.num_tags]
+        corners = corners[order]
+        ids = ids[order]
+        self.last_corners = corners
+
+        if ids.size == 0:
+            return []
+
+        # Gets the markers states, ie: their centers and x axis orientations
+        if self.pose_3d:
+            centers, orientations = self.get_3d_states(corners)
+        else:
+            centers, orientations = self.get_planar_states(corners)
 
-                i += 1
+        if degree == True:
+            orientations = np.degrees(orientations)
 
-        return identified_markers
+        return [[marker_id, center, orientation]
+                for marker_id, center, orientation in zip(ids.tolist(), centers, orientations.tolist())]
 
     def reset(self, opt=None):
-        # In the case fo the aruco seeker this function is unecessary
-        # But was left here to mantain the minimum structure of a seeker
-        # all seekers must have a reset method
-        pass
+        # Forgets the last markers, so the next seek scans the whole image
+        self.last_corners = None
+        self._tracked_frames = 0
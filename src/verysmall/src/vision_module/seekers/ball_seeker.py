@@ -4,6 +4,9 @@ import cv2
 import time
 
 from vision_module.seekers.seeker import Seeker
+from vision_module.vision_utils.blobs import get_blobs
+from vision_module.vision_utils.subpixel import refine_centroid
+from vision_module.vision_utils.reacquisition import ReacquisitionMap
 
 # @author Wellington Castro <wvmcastro>
 
@@ -12,7 +15,10 @@ class BallSeeker(Seeker):
         It also uses the temporal information to predict a search window in the
         picture."""
 
-    def __init__(self, img_shape, color_thrs: Tuple[np.uint8, np.uint8]):
+    def __init__(self, img_shape, color_thrs: Tuple[np.uint8, np.uint8], reacquisition: bool = False):
+        """ With reacquisition a lost obj is first looked for where it can be,
+            given its last speed and the robots that may be hiding it, and
+            only from time to time in the whole image """
 
         # Stores the frame shape
         self.img_shape = img_shape
@@ -26,11 +32,21 @@ class BallSeeker(Seeker):
 
         self.obj_size = None
 
+        # (x, y) variance of the last position found, in pixels
+        self.variance = None
+
         # This speed is in the image world
         self.speed = None
 
         self.lost = 0
 
+        self.reacquisition = ReacquisitionMap(img_shape) if reacquisition else None
+
+        # Pixel centers and radius of the robots that may hide the obj, given
+        # by the hawk eye
+        self.occluders = None
+        self.occluder_radius = 0.
+
     def update_time(self, t=None):
         if t is None:
             self.last_time = time.time()
@@ -83,58 +99,118 @@ class BallSeeker(Seeker):
         # is the line coord
         return np.array([start_col, start_line]), img[start_line:end_line, start_col:end_col]
 
-    def get_obj_pos(self, img):
-        if cv2.__version__[0] == '4':
-            cnts, *_ = cv2.findContours(img, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
-        else:
-            _, cnts, *_ = cv2.findContours(img, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
-        
-        pos = np.array([None, None])
-        c_x, c_y = None, None
-
-        for cnt in cnts:
-            # Compute the contour moment to extract its center
-            M = cv2.moments(cnt)
-
-            # Calculates the contour center
-            if M['m00'] != 0:
-                c_x = int(M['m10'] / M['m00'])
-                c_y = int(M['m01'] / M['m00'])
+    def get_obj_pos(self, img, color_img=None, blobs=None):
+        """ img is the binary mask of the ball color and color_img the image
+            it was segmented from, which refines the position below the pixel.
+            blobs are the blobs of img, when they are already known """
+        if blobs is None:
+            blobs = get_blobs(img)
+        if len(blobs) == 0:
+            self.variance = None
+            return np.array([None, None])
+
+        # The largest blob is the ball, the others are noise of the mask
+        k = np.argmax(blobs.areas)
+
+        # If it is the first time the obj is detected.
+        # Calculates its size
+        if self.obj_size is None:
+            self.obj_size = max(blobs.boxes[k, 2], blobs.boxes[k, 3])
+
+        pos, self.variance = refine_centroid(img, blobs.boxes[k], color_img, self._color_thrs,
+                                             expected_size=self.obj_size)
+        return pos
+
+
+    def find(self, region, origin):
+        """ Returns the obj pos in the image or [None, None] """
+        mask = cv2.inRange(region, self._color_thrs[0], self._color_thrs[1])
+        pos = self.get_obj_pos(mask, region)
+        if np.all(pos != None):
+            pos += origin
+        return pos
 
-                # If it is the first time the obj is detected.
-                # Calculates its size
-                if  self.obj_size is None:
-                    # Rect is a list that has the [(x,y)center, (width, height), angle of rotation]
-                    rect = cv2.minAreaRect(cnt)
-                    self.obj_size = max(rect[1][0], rect[1][1])
+    def reacquire(self, img, now):
+        """ Looks for the lost obj in the regions of the reacquisition map,
+            the most probable first. Returns its pos and whether the whole
+            image must still be scanned in this frame """
+        reacquisition = self.reacquisition
+        if reacquisition.expired(now):
+            reacquisition.clear()
+            return np.array([None, None]), True
 
-        return np.array([c_x, c_y])
+        for rows, cols in reacquisition.get_regions(now, self.occluders, self.occluder_radius):
+            pos = self.find(img[rows, cols], np.array([cols.start, rows.start]))
+            if np.all(pos != None):
+                return pos, False
 
+        return np.array([None, None]), reacquisition.full_scan_due()
 
     def seek(self, img):
         if np.all(self.last_pos != None) and np.all(self.speed != None):
             origin, region = self.get_search_region(img)
+            pos = self.find(region, origin)
         else:
-            self.update_time()
-            origin = np.array([0,0])
-            region = img
-            self.lost += 1
-
-        region = cv2.inRange(region, self._color_thrs[0], self._color_thrs[1])
-        pos = self.get_obj_pos(region)
+            now = time.time()
+            self.update_time(now)
+            pos, full_scan = np.array([None, None]), True
+            if self.reacquisition is not None and self.reacquisition.active:
+                pos, full_scan = self.reacquire(img, now)
+            if full_scan:
+                self.lost += 1
+                pos = self.find(img, np.array([0, 0]))
 
         if np.all(pos != None):
-            pos += origin
             self.update_state(pos)
+            if self.reacquisition is not None:
+                self.reacquisition.clear()
         else:
-            self.reset()
+            lost_pos, lost_speed, lost_size = self.last_pos, self.speed, self.obj_size
+            self.forget()
+            # The map starts when a tracked obj is lost, not on each frame
+            # it is still missing
+            if self.reacquisition is not None and np.all(lost_pos != None):
+                self.reacquisition.lose(lost_pos, lost_speed, lost_size, time.time())
 
         return self.last_pos
 
-    def reset(self, color_thrs=None) -> None:
-        if color_thrs is not None:
-            self._color_thrs = color_thrs
+    def seek_patches(self, patches):
+        """ Same as seek, but only in the (patch, offset) pairs of the
+            detection pyramid. The patches already hold every place where the
+            obj may be, so there is no search window nor reacquisition """
+        best = None
+        for patch, offset in patches:
+            mask = cv2.inRange(patch, self._color_thrs[0], self._color_thrs[1])
+            blobs = get_blobs(mask)
+            if len(blobs) > 0 and (best is None or blobs.areas.max() > best[0].areas.max()):
+                best = (blobs, mask, patch, offset)
+
+        if best is None:
+            self.forget()
+            return self.last_pos
+
+        blobs, mask, patch, offset = best
+        self.update_state(self.get_obj_pos(mask, patch, blobs) + offset)
+        if self.reacquisition is not None:
+            self.reacquisition.clear()
+
+        return self.last_pos
+
+    def set_color_thresholds(self, color_thrs) -> None:
+        """ Swaps the thresholds keeping the tracking state """
+        self._color_thrs = color_thrs
+
+    def forget(self) -> None:
+        """ Drops the obj state, but not the reacquisition map """
         self.last_pos = None
         self.last_time = None
         self.obj_size = None
         self.obj_speed = None
+        self.variance = None
+
+    def reset(self, color_thrs=None) -> None:
+        if color_thrs is not None:
+            self._color_thrs = color_thrs
+        self.forget()
+        if self.reacquisition is not None:
+            self.reacquisition.clear()
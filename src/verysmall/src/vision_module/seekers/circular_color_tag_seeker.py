@@ -1,18 +1,37 @@
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 import cv2
 import numpy as np
 import math
 import rospy
 
 from vision_module.seekers.seeker import Seeker
+from vision_module.vision_utils.blobs import get_blobs, get_patches_blobs
+from vision_module.vision_utils.subpixel import refine_centroid
 
 IMAGE = np.ndarray
-ROBOT_STATE = Tuple[int, np.array, float]
+ROBOT_STATE = Tuple[int, np.array, float, np.ndarray]
 
 class CircularColorTagSeeker(Seeker):
-    def __init__(self, color_thresholds: List[Tuple[np.ndarray, np.ndarray]]):
+    def __init__(self, color_thresholds: List[Tuple[np.ndarray, np.ndarray]],
+                 tracking: bool = False, main_color: Tuple[np.ndarray, np.ndarray] = None):
+        """ main_color has the thresholds of the team color mask, which weight
+            the pixels of its blobs when their centroids are refined """
         self._colors = color_thresholds
-        
+        self._main_color = main_color
+
+        # In the tracking mode the main color is first searched only in windows
+        # around the predicted robots positions
+        self.tracking = tracking
+        self.full_scans = 0
+
+        # Robots without a prediction, like the ones not on the field, are
+        # only looked for by a full scan every rescan_period frames
+        self.rescan_period = 8
+        self._tracked_frames = 0
+
+        # Half size of the search window, in multiples of the radius threshold
+        self._window_scale = 2.0
+
         self._radius_thresh = -1
         self._l_thresh = 0
         self._r_thresh = 0
@@ -21,80 +40,163 @@ class CircularColorTagSeeker(Seeker):
 
         self._theta = math.pi / 4
     
-    def seek(self, binary_img: IMAGE, color_img: IMAGE):
+    def seek(self, binary_img: IMAGE, color_img: IMAGE,
+             predictions: List[Optional[np.ndarray]] = None):
+        """ predictions has the expected pixel position of each robot, or None
+            for the robots that are lost. It is only used in the tracking mode """
         if self._h == 0:
             self._h, self._w, *_ = binary_img.shape
 
-        first_centroids = self.get_main_color_centroids(binary_img)
+        first_centroids = None
+        if self.tracking and predictions and self._radius_thresh > 0:
+            tracked = [prediction for prediction in predictions if prediction is not None]
+            rescan = len(tracked) < len(predictions) and self._tracked_frames >= self.rescan_period - 1
+            if tracked and not rescan:
+                first_centroids = self.get_tracked_centroids(binary_img, tracked)
+
+        if first_centroids is None:
+            self.full_scans += 1
+            self._tracked_frames = 0
+            first_centroids = self.get_main_color_centroids(binary_img)
+        else:
+            self._tracked_frames += 1
         slices = self.get_crop_areas(first_centroids)
 
         patches = []
+        masks = []
         top_lefts = []
         for k, s in enumerate(slices):
             patches.append((k, color_img[s[0], s[1], ...]))
+            masks.append(binary_img[s[0], s[1]])
             top_lefts.append(np.array([s[1].start, s[0].start]))
         
-        ids, second_centroids = self.segment_and_get_second_centroids(patches, top_lefts)
-        robots = self.compute_robot_states(ids, first_centroids, second_centroids)
+        return self.get_robots(first_centroids, patches, masks, top_lefts)
+
+    def seek_patches(self, binary_patches: List[Tuple[IMAGE, np.ndarray]],
+                     color_patches: List[Tuple[IMAGE, np.ndarray]]):
+        """ Same as seek, but only in the (patch, offset) pairs of the
+            detection pyramid. The second color of each robot is looked for
+            in the color patch where its main color blob is """
+        blobs, owners = get_patches_blobs(binary_patches)
+        main = self.select_main_blobs(blobs)
+        first_centroids = list(blobs.centroids[main])
+
+        patches = []
+        masks = []
+        top_lefts = []
+        for k, i in enumerate(main):
+            color_img, offset = color_patches[owners[i]]
+            binary_img, _ = binary_patches[owners[i]]
+            rows, cols = self.get_crop_area(blobs.centroids[i] - offset, color_img.shape[:2])
+            patches.append((k, color_img[rows, cols, ...]))
+            masks.append(binary_img[rows, cols])
+            top_lefts.append(offset + (cols.start, rows.start))
+
+        return self.get_robots(first_centroids, patches, masks, top_lefts)
+
+    def get_robots(self, first_centroids: List[np.ndarray], patches: List[Tuple[int, IMAGE]],
+                   masks: List[IMAGE], top_lefts: List[np.ndarray]) -> List[ROBOT_STATE]:
+        """ patches and masks are the crops of the color image and of the main
+            color mask around each first centroid """
+        first = [self.refine_main_centroid(centroid, mask, patch, top_left)
+                 for centroid, mask, (_, patch), top_left in zip(first_centroids, masks, patches, top_lefts)]
+        ids, second = self.segment_and_get_second_centroids(patches, top_lefts)
+        robots = self.compute_robot_states(ids, first, second)
         robots.sort(key = lambda r: r[0])
         return robots
+
+    def refine_main_centroid(self, centroid: np.ndarray, mask: IMAGE, patch: IMAGE,
+                             top_left: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """ Returns the refined centroid of the main color blob nearest to
+            centroid, in the crop of the mask and the color image whose top
+            left corner is top_left, and its (x, y) variance """
+        blobs = get_blobs(np.ascontiguousarray(mask))
+        if len(blobs) == 0:
+            return centroid, None
+
+        k = np.argmin(np.linalg.norm(top_left + blobs.centroids - centroid, axis=1))
+        pos, variance = refine_centroid(mask, blobs.boxes[k], patch, self._main_color,
+                                        expected_size=self._radius_thresh)
+        return top_left + pos, variance
     
     def get_main_color_centroids(self, img) -> List[np.ndarray]:
-        cnts = self.get_contours(img)
-        
-        centroids = []
-        # compute all areas and centroids
-        for cnt in cnts:
-            m = cv2.moments(cnt)
-            a = m["m00"]
-            if a != 0:    
-                cx = m["m10"] / a
-                cy = m["m01"] / a
-                centroids.append((a, np.array([cx, cy])))
-        
-        centroids.sort(key = lambda x: x[0], reverse=True)
+        blobs = get_blobs(img)
+        return list(blobs.centroids[self.select_main_blobs(blobs)])
 
-        if len(centroids) < 2:
-            n = len(centroids)
-        else:
-            self.l_thresh = 0.7 * centroids[0][0]
-            self.r_thresh = 1.3 * centroids[0][0]
+    def select_main_blobs(self, blobs) -> np.ndarray:
+        """ Returns the indices of the main color blobs, the largest first """
+        order = np.argsort(-blobs.areas, kind="stable")
+
+        n = len(order)
+        if n >= 2:
+            self._l_thresh = 0.7 * blobs.areas[order[0]]
+            self._r_thresh = 1.3 * blobs.areas[order[0]]
+
+            # The areas are sorted and none is above the largest one, so the
+            # blobs inside the thresholds are the first ones
+            n = np.count_nonzero(blobs.areas >= self._l_thresh)
 
-            n = 1
-            for c in centroids[1:]:
-                if self.l_thresh <= c[0] <= self.r_thresh:
-                    n += 1
-        
         if self._radius_thresh < 0 and n != 0:
-            *_, radius = cv2.minEnclosingCircle(cnts[0])
-            self._radius_thresh = 2 * radius
+            self._radius_thresh = 2 * blobs.radii()[order[0]]
 
-        return [centroids[i][1] for i in range (n)]
+        return order[:n]
     
-    def get_contours(self, img: IMAGE):
-        if cv2.__version__[0] == '4':
-            cnts, _ = cv2.findContours(img, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
-        else:
-            _, cnts, *_ = cv2.findContours(img, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
-        
-        return cnts
+    def get_tracked_centroids(self, img: IMAGE,
+                              predictions: List[np.ndarray]) -> Optional[List[np.ndarray]]:
+        """ Looks for the main color blob of each predicted robot only inside a
+            window around its position. Returns None when a robot is not inside
+            its window, so the caller falls back to the full scan """
+        half_size = self._window_scale * self._radius_thresh
+
+        centroids = []
+        for prediction in predictions:
+            x_min = int(max(0, prediction[0] - half_size))
+            x_max = int(min(self._w, prediction[0] + half_size))
+            y_min = int(max(0, prediction[1] - half_size))
+            y_max = int(min(self._h, prediction[1] + half_size))
+            if x_min >= x_max or y_min >= y_max:
+                return None
+
+            top_left = np.array([x_min, y_min])
+            blobs = get_blobs(np.ascontiguousarray(img[y_min:y_max, x_min:x_max]))
+
+            # Among the blobs with the expected area takes the closest one
+            if self._r_thresh > 0:
+                blobs = blobs.select((blobs.areas >= self._l_thresh) & (blobs.areas <= self._r_thresh))
+            if len(blobs) == 0:
+                return None
+
+            candidates = top_left + blobs.centroids
+            best = candidates[np.argmin(np.linalg.norm(candidates - prediction, axis=1))]
+
+            # Two robots too close may end up with the same blob
+            for c in centroids:
+                if np.linalg.norm(best - c) < self._radius_thresh:
+                    return None
+
+            centroids.append(best)
+
+        return centroids
 
     def get_crop_areas(self, centroids) -> List[Tuple[slice, slice]]:
-        
-        slices = []
-        for centroid in centroids:
-            x_min = int(max(0, centroid[0] - self._radius_thresh))
-            x_max = int(min(self._w, centroid[0] + self._radius_thresh))
-            y_min = int(max(0, centroid[1] - self._radius_thresh))
-            y_max = int(min(self._h, centroid[1] + self._radius_thresh))
-
-            slices.append((slice(y_min, y_max, 1), slice(x_min, x_max, 1)))
-        
-        return slices
+        return [self.get_crop_area(centroid, (self._h, self._w)) for centroid in centroids]
+
+    def get_crop_area(self, centroid, shape) -> Tuple[slice, slice]:
+        """ Window around the centroid, clipped to an image of that shape """
+        h, w = shape
+        x_min = int(max(0, centroid[0] - self._radius_thresh))
+        x_max = int(min(w, centroid[0] + self._radius_thresh))
+        y_min = int(max(0, centroid[1] - self._radius_thresh))
+        y_max = int(min(h, centroid[1] + self._radius_thresh))
+
+        return slice(y_min, y_max, 1), slice(x_min, x_max, 1)
 
     def segment_and_get_second_centroids(self, patches: List[Tuple[int, IMAGE]],
                                                top_lefts: List[np.ndarray]) -> \
-                                    Tuple[List[int], List[np.ndarray]]:
+                                    Tuple[List[int], List[Tuple[np.ndarray, np.ndarray]]]:
+        """ Returns the id of each robot and the refined centroid of its
+            second color, with its (x, y) variance, or None when no second
+            color was found """
         n = len(patches)
         centroids = [None] * n
         ids = [None] * n
@@ -102,37 +204,44 @@ class CircularColorTagSeeker(Seeker):
             for j, (k, patch) in enumerate(patches):
                 thresholded = cv2.inRange(patch, color[0], color[1])
                 if np.any(thresholded):
-                    cnts = self.get_contours(thresholded)
-                    cnt = cnts[0]
-                    m = cv2.moments(cnt)
-                    a = m["m00"]
-                    if a != 0:
-                        cx = m["m10"] / a
-                        cy = m["m01"] / a
-                        centroids[k] = top_lefts[j] + np.array([cx, cy])
-                        ids[k] = i
-                        del patches[j]
-                        del top_lefts[j]
-                        break
+                    blobs = get_blobs(thresholded)
+                    pos, variance = refine_centroid(thresholded, blobs.boxes[np.argmax(blobs.areas)],
+                                                    patch, color)
+                    centroids[k] = (top_lefts[j] + pos, variance)
+                    ids[k] = i
+                    del patches[j]
+                    del top_lefts[j]
+                    break
         
         return ids, centroids
     
     def compute_robot_states(self, ids: List[int], 
-                             first_centroids: List[np.ndarray], 
-                             second_centroids: List[np.ndarray]) -> \
+                             first_centroids: List[Tuple[np.ndarray, np.ndarray]],
+                             second_centroids: List[Tuple[np.ndarray, np.ndarray]]) -> \
                              List[ROBOT_STATE]:
+        """ The centroids come with their (x, y) variances. The robot is in
+            the middle of both, so its variance is a quarter of their sum """
         robots = []
         i = 0
-        for c1, c2 in zip(first_centroids, second_centroids):
-            if c2 is not None:
+        for (c1, v1), second in zip(first_centroids, second_centroids):
+            if second is not None:
+                c2, v2 = second
                 c = (c1 + c2) / 2
                 vec = c2 - c1
                 angle = math.atan2(-vec[1], vec[0])  - self._theta
-                robots.append((ids[i], c, angle))
+                variance = (v1 + v2) / 4 if v1 is not None else None
+                robots.append((ids[i], c, angle, variance))
 
             i += 1
         return robots
     
+    def set_color_thresholds(self, color_thresholds: List[Tuple[np.ndarray, np.ndarray]],
+                             main_color: Tuple[np.ndarray, np.ndarray] = None) -> None:
+        """ Swaps the colors thresholds keeping the tracking state """
+        self._colors = color_thresholds
+        if main_color is not None:
+            self._main_color = main_color
+
     def reset(self, opt = None) -> None:
         if opt is not None:
             self._colors = opt
@@ -142,6 +251,7 @@ class CircularColorTagSeeker(Seeker):
         self._r_thresh = 0
         self._h = 0
         self._w = 0
+        self._tracked_frames = 0
 
 
             
@@ -1,10 +1,11 @@
 import numpy as np
 import cv2
-from sklearn.cluster import KMeans
 import rospy
 import time
 
 from vision_module.seekers.seeker import Seeker
+from vision_module.vision_utils.blobs import get_blobs, get_patches_blobs
+from vision_module.vision_utils.weighted_kmeans import WeightedKMeans
 
 
 # @author Wellington Castro <wvmcastro>
@@ -13,7 +14,7 @@ class GeneralMultObjSeeker(Seeker):
 
     def __init__(self, num_objects):
         self.num_objects = num_objects
-        self.kmeans = KMeans(n_clusters=self.num_objects, n_init=1, max_iter=30)
+        self.kmeans = WeightedKMeans(self.num_objects, max_iter=30)
         self.objects = None
 
     def seek(self, img):
@@ -25,38 +26,58 @@ class GeneralMultObjSeeker(Seeker):
            :return: objecs: np.array([float, float]).shape([k, 2])
            object has the position of the center of each object in img
         """
-        if cv2.__version__[0] == '4':
-            cnts, _ = cv2.findContours(img, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
-        else:
-            _, cnts, *_ = cv2.findContours(img, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
-        
-        centroids_list = []
-        num_cnts = len(cnts)
-        if num_cnts > 0:
-            cnts_array = np.array(cnts[0]).reshape(-1, 2)
-
-            for i in range(1, num_cnts):
-                cnts_array = np.vstack([cnts_array, np.array(cnts[i]).reshape(-1, 2)])
-
-            if cnts_array.shape[0] > self.num_objects:
-                first_iteration = 1
-                if np.all(self.objects != None):
-                    first_iteration = 0
-                    self.kmeans.init = self.objects
-
-                self.kmeans.fit(cnts_array)
-                newObjects= self.kmeans.cluster_centers_
-
-                if not first_iteration and np.all(self.objects != None):
-                    diff = newObjects - self.objects
-                    distances = np.linalg.norm(diff, axis=1)
-                    changes = np.where(distances > 2.5)[0]
-                    self.objects[changes,:] = self.kmeans.cluster_centers_[changes,:]
-                else:
-                    self.objects = newObjects
+        blobs = self.drop_noise(get_blobs(img))
+
+        # Each robot is one blob of the mask, weighted by its area. When some
+        # robots touch there are fewer blobs than robots and the pixels of the
+        # mask are clustered instead, so the merged blobs are split again
+        if len(blobs) >= self.num_objects:
+            return self.fit(blobs.centroids, blobs.areas)
+
+        return self.fit(self.get_points(img), None)
+
+    def seek_patches(self, patches):
+        """ Same as seek, but only in the (patch, offset) pairs of the
+            detection pyramid """
+        blobs = self.drop_noise(get_patches_blobs(patches)[0])
+        if len(blobs) >= self.num_objects:
+            return self.fit(blobs.centroids, blobs.areas)
+
+        points = [self.get_points(patch) + offset for patch, offset in patches]
+        return self.fit(np.concatenate(points) if points else np.empty((0, 2)), None)
+
+    def drop_noise(self, blobs):
+        """ The specks of noise of the mask are dropped """
+        if len(blobs) > 0:
+            blobs = blobs.select(blobs.areas >= 0.1 * blobs.areas.max())
+        return blobs
+
+    def get_points(self, img):
+        """ Pixels of the mask to be clustered. One of each 2x2 block is enough """
+        points = cv2.findNonZero(np.ascontiguousarray(img[::2, ::2]))
+        return 2. * points.reshape(-1, 2) if points is not None else np.empty((0, 2))
+
+    def fit(self, points, weights):
+        """ Moves the objects to the clusters of the points """
+        if points.shape[0] >= self.num_objects and points.shape[0] > 0:
+            first_iteration = 1
+            init = None
+            if np.all(self.objects != None):
+                first_iteration = 0
+                init = self.objects
+
+            self.kmeans.fit(points, weights, init=init)
+            newObjects= self.kmeans.cluster_centers_
+
+            if not first_iteration and np.all(self.objects != None):
+                diff = newObjects - self.objects
+                distances = np.linalg.norm(diff, axis=1)
+                changes = np.where(distances > 2.5)[0]
+                self.objects[changes,:] = self.kmeans.cluster_centers_[changes,:]
+            else:
+                self.objects = newObjects
 
         return self.objects
 
     def reset(self, opt=None):
-        self.kmeans.init = 'k-means++'
         self.objects = None
@@ -1,4 +1,5 @@
 from typing import List
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import cv2
 import time
@@ -17,8 +18,15 @@ from vision_module.seekers.circular_color_tag_seeker import CircularColorTagSeek
 ID = 0
 POS = 1
 ANGLE = 2
+VARIANCE = 3
 SPEED_QUEUE_SIZE = 60.0
 
+# Aruco marker id of each robot slot, used when the game.json has no aruco_tags
+ARUCO_TAGS = [9, 14, 18, 23, 28]
+
+# Radius, in cm, of the circle around a robot that may hide the ball
+ROBOT_RADIUS = 5.5
+
 
 class Things:
     # This is an auxiliary class to hold the variables from the things identified
@@ -42,6 +50,16 @@ class Things:
 
         self.angular_kalman = None
 
+        # Last position and orientation given to update, before the filters.
+        # Kept for the vision recorder
+        self.measured_pos = None
+        self.measured_orientation = None
+
+        # When a ThingsTracker owns this thing, the filters run batched there
+        # and update only stores the measurement
+        self.tracker = None
+        self.index = -1
+
         self.init_kalman()
 
     def init_angular_kalman(self):
@@ -85,7 +103,17 @@ class Things:
         self.kalman.transitionMatrix[0, 2] = dt
         self.kalman.transitionMatrix[1, 3] = dt
 
-    def update(self, id, pos, orientation=None):
+    def update(self, id, pos, orientation=None, variance=None):
+        """ variance is the (x, y) variance of pos, given by the seekers that
+            know how precise each position is. It replaces the fixed
+            measurement noise of the filter """
+        self.measured_pos = pos
+        self.measured_orientation = orientation
+
+        if self.tracker is not None:
+            self.tracker.measure(self.index, id, pos, orientation, variance)
+            return
+
         now = time.time()
         if self.last_update is None and np.all(pos is not None):  # first run
             self.init_kalman()
@@ -103,6 +131,10 @@ class Things:
 
             # updates the kalman filter
             if np.all(pos is not None) and self.lost_counter < 60:
+                if variance is not None:
+                    self.kalman.measurementNoiseCov = np.diag(variance)
+                else:
+                    self.kalman.measurementNoiseCov = 1e-1 * np.ones((2, 2))
                 self.kalman.correct(pos.reshape(2, 1))
                 if orientation is not None:
                     self.angular_kalman.correct(np.array([orientation]).reshape(1, 1))
@@ -130,6 +162,9 @@ class Things:
             self.orientation = orientation
 
     def reset(self):
+        if self.tracker is not None:
+            self.tracker.reset(self.index)
+
         self.pos = np.array([None, None])
         self.last_update = None
         self.orientation = None
@@ -142,7 +177,11 @@ class HawkEye:
     # https://docs.opencv.org/master/d9/d8b/tutorial_py_contours_hierarchy.html#gsc.tab=0
 
     def __init__(self, field_origin, conversion_factor_x, conversion_factor_y, seekers, num_robots_yellow_team,
-                 num_robots_blue_team, img_shape, aux_params):
+                 num_robots_blue_team, img_shape, aux_params, parallel: bool = False,
+                 patches: bool = False):
+        """ With patches the images given to seek_all are the lists of
+            (patch, offset) pairs of the detection pyramid instead of full
+            images, and each seeker looks only inside them """
 
         self.team_seekers = seekers
 
@@ -153,33 +192,92 @@ class HawkEye:
         self.num_robots_yellow_team = num_robots_yellow_team
         self.num_robots_blue_team = num_robots_blue_team
 
+        # Robot slot of each aruco marker id
+        self.aruco_tags = list(aux_params.get("aruco_tags", ARUCO_TAGS))
+        self.aruco_slots = {tag: slot for slot, tag in enumerate(self.aruco_tags)}
+
         self.yellow_team_seeker, self.seek_yellow_team = self.get_seeker(
             self.team_seekers["yellow"], 
             self.num_robots_yellow_team, 
-            aux_params)
+            aux_params,
+            "yellow")
 
         self.blue_team_seeker, self.seek_blue_team = self.get_seeker(
             self.team_seekers["blue"],
             self.num_robots_blue_team,
-            aux_params)
+            aux_params,
+            "blue")
+
+        self.ball_seeker = BallSeeker(img_shape, aux_params["ball"],
+                                      reacquisition=aux_params.get("ball_reacquisition", False))
 
-        self.ball_seeker = BallSeeker(img_shape, aux_params["ball"])
+        # The three seekers work over different masks and update different
+        # Things, so they can run at the same time. One worker for each
+        self.parallel = parallel
+        self.executor = ThreadPoolExecutor(max_workers=3) if parallel else None
+
+        self.patches = patches
     
-    def get_seeker(self, seeker_name: str, num_robots: int = 0, aux_params: dict = None):
+    def get_seeker(self, seeker_name: str, num_robots: int = 0, aux_params: dict = None,
+                   team: str = None):
+        """ team is the color of the team, whose thresholds may be in aux_params """
         if seeker_name == "aruco":
             camera_matrix = aux_params["aruco"][0]
             distortion_vector = aux_params["aruco"][1]
             seeker = ArucoSeeker(camera_matrix, 
                                        distortion_vector,
-                                       num_robots)
+                                       num_robots,
+                                       pose_3d=aux_params.get("aruco_pose_3d", False),
+                                       tracking=aux_params.get("aruco_tracking", False),
+                                       tags=self.aruco_tags[:num_robots])
             return seeker, self.aruco_seek
         elif seeker_name == "color":
-            return CircularColorTagSeeker(aux_params["color"]), self.color_seek
+            seeker = CircularColorTagSeeker(aux_params["color"],
+                                            aux_params.get("color_tracking", False),
+                                            main_color=aux_params.get(team))
+            return seeker, self.color_seek
         elif seeker_name == "kmeans":
             seeker = GeneralMultObjSeeker(num_robots)
             return seeker, self.kmeans_seek
 
 
+    def seek_all(self, seek_image: np.ndarray,
+                       yellow_seg: np.ndarray,
+                       blue_seg: np.ndarray,
+                       yellow_team: List[Things],
+                       blue_team: List[Things],
+                       ball: Things) -> None:
+        """ Seeks both teams and the ball. In the parallel mode the seekers
+            run in the thread pool and this function only returns after all of
+            them are done, so the Things are complete when the message is sent """
+        # The robots hiding a lost ball are where they were in the last frame
+        if self.ball_seeker.reacquisition is not None and self.ball_seeker.reacquisition.active:
+            self.update_occluders(yellow_team + blue_team)
+
+        if not self.parallel:
+            self.seek_yellow_team(yellow_seg, yellow_team, self.yellow_team_seeker, opt=seek_image)
+            self.seek_blue_team(blue_seg, blue_team, self.blue_team_seeker, opt=seek_image)
+            self.seek_ball(seek_image, ball)
+            return
+
+        futures = [self.executor.submit(self.seek_yellow_team, yellow_seg, yellow_team,
+                                        self.yellow_team_seeker, seek_image),
+                   self.executor.submit(self.seek_blue_team, blue_seg, blue_team,
+                                        self.blue_team_seeker, seek_image),
+                   self.executor.submit(self.seek_ball, seek_image, ball)]
+
+        # Always waited in the same order, so an exception from any seeker
+        # reaches the caller the same way it would in the sequential mode
+        for future in futures:
+            future.result()
+
+    def update_occluders(self, robots: List[Things]) -> None:
+        """ Gives the ball seeker the pixel position of the robots found """
+        centers = [self.real_world_to_pixel(robot.pos) for robot in robots if robot.pos[0] is not None]
+        self.ball_seeker.occluders = np.array(centers, np.float64).reshape(-1, 2)
+        self.ball_seeker.occluder_radius = ROBOT_RADIUS / min(self.conversion_factor_x,
+                                                              self.conversion_factor_y)
+
     def pixel_to_real_world(self, pos):
         # This function expects that pos is a 1D numpy array
         pos = pos - self.field_origin
@@ -187,48 +285,57 @@ class HawkEye:
         pos[1] *= -self.conversion_factor_y
         return pos
 
+    def real_world_to_pixel(self, pos):
+        # Inverse of the pixel_to_real_world function
+        pos = np.array([pos[0] / self.conversion_factor_x,
+                        -pos[1] / self.conversion_factor_y])
+        return pos + self.field_origin
+
     def aruco_seek(self, img: np.ndarray, 
                          robots_list: List[Things], 
                          seeker: ArucoSeeker, 
                          opt=None):
         """ This function expects a binary image with the team robots and a list
                     of Things objects to store the info """
-        img = 255 - img
-        robots = seeker.seek(img, degree=False)
-        # TODO: ISSO AQUI UM DIA VAI DAR MERDA
-        # EXPLODIU, O DIA CHEGOU 14/08/2019, a casa caiu
-        # é a nova era, petista
-        tags = [9, 14, 18, 23, 28]
-        # tags_in_game = []
-        k = 0
+        if self.patches:
+            robots = seeker.seek_patches([(255 - patch, offset) for patch, offset in img], degree=False)
+        else:
+            robots = seeker.seek(255 - img, degree=False)
+
+        # Each marker goes straight to the slot of its id, so a missing or
+        # unknown marker does not move the others
+        found = [None] * len(robots_list)
+        for marker_id, center, orientation in robots:
+            slot = self.aruco_slots.get(marker_id)
+            if slot is not None and slot < len(found) and found[slot] is None:
+                found[slot] = (center, orientation)
 
-        len_robots = len(robots)
         for i in range(len(robots_list)):
-            id = None if k >= len_robots else robots[k][ID]
-            if tags[i] == id:
-                pos = self.pixel_to_real_world(robots[k][POS])
-                _orientation = robots[k][ANGLE]
-                k += 1
+            if found[i] is not None:
+                pos = self.pixel_to_real_world(found[i][0])
+                _orientation = found[i][1]
             else:
                 pos, _orientation = None, None
 
-            # if tags[i] in tags_in_game:
             robots_list[i].update(i, pos, orientation=_orientation)
 
     def seek_ball(self, img: np.ndarray, 
                         ball: Things, 
                         opt=None):
-        pos = self.ball_seeker.seek(img)
+        pos = self.ball_seeker.seek_patches(img) if self.patches else self.ball_seeker.seek(img)
+        variance = None
         if np.all(pos is not None):
             pos = self.pixel_to_real_world(pos)
+            variance = self.ball_seeker.variance * np.array([self.conversion_factor_x ** 2,
+                                                             self.conversion_factor_y ** 2])
 
-        ball.update(0, pos)
+        ball.update(0, pos, variance=variance)
 
     def kmeans_seek(self, img: np.ndarray, 
                           robots_list: List[Things], 
                           seeker: GeneralMultObjSeeker, 
                           opt=None):
-        adv_centers = seeker.seek(img)
+        adv_centers = seeker.seek_patches(img) if self.patches else seeker.seek(img)
 
         if not (adv_centers is None) and adv_centers.size:
             for i in range(len(robots_list)):
@@ -240,20 +347,43 @@ class HawkEye:
                          seeker: CircularColorTagSeeker,
                          opt = None) -> None:
         color_img = opt
-        robots = seeker.seek(binary_img, color_img)
+
+        predictions = None
+        if seeker.tracking and not self.patches:
+            # Only the robots seen in the last frame have a reliable prediction
+            predictions = [self.real_world_to_pixel(robot.pos)
+                           if robot.pos[0] is not None and robot.lost_counter == 0 else None
+                           for robot in robots_list]
+
+        if self.patches:
+            robots = seeker.seek_patches(binary_img, color_img)
+        else:
+            robots = seeker.seek(binary_img, color_img, predictions)
         num_detected_robots = len(robots)
 
         k = 0
         for i in range(len(robots_list)):
+            variance = None
             if k < num_detected_robots and robots[k][ID] == i:
                 pos = self.pixel_to_real_world(robots[k][POS])
                 orientation = robots[k][ANGLE]
+                if robots[k][VARIANCE] is not None:
+                    variance = robots[k][VARIANCE] * np.array([self.conversion_factor_x ** 2,
+                                                               self.conversion_factor_y ** 2])
                 k += 1
             else:
                 pos, orientation = None, None
             
-            robots_list[i].update(i, pos, orientation)
+            robots_list[i].update(i, pos, orientation, variance=variance)
+
 
+    def set_color_thresholds(self, aux_params: dict) -> None:
+        """ Gives the seekers new color thresholds without resetting them, so
+            the things keep being tracked """
+        self.ball_seeker.set_color_thresholds(aux_params["ball"])
+        for team, seeker in (("yellow", self.yellow_team_seeker), ("blue", self.blue_team_seeker)):
+            if self.team_seekers[team] == "color":
+                seeker.set_color_thresholds(aux_params["color"], aux_params.get(team))
 
     def reset(self, aux_params=None) -> None:
         try:
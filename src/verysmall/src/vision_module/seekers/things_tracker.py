@@ -0,0 +1,231 @@
+import numpy as np
+import math
+import time
+
+# Same tuning of the cv2.KalmanFilter objects in the Things class
+PROCESS_NOISE = 1e-5
+MEASUREMENT_NOISE = 1e-1
+MAX_LOST_FRAMES = 60
+
+
+class ThingsTracker:
+    """ Batched version of the Things kalman filters. The states of all the
+        tracked things live in stacked numpy arrays, N x 6 for the position,
+        speed and acceleration and N x 3 for the orientation, so all of them
+        are predicted and corrected with a few vectorized operations per frame.
+
+        The seekers keep calling Things.update, which only stores the
+        measurement here. The step function runs the filters and writes the
+        results back in the Things objects. Unlike the cv2 filters, the
+        transition matrices are built with the real time elapsed since the
+        last update of each thing, measured in frame periods """
+
+    def __init__(self, things: list, frame_period: float = 1.0 / 120.0):
+        self.things = things
+        self.frame_period = frame_period
+
+        n = len(things)
+        self.n = n
+
+        # Filters states
+        self.state = np.zeros((n, 6))
+        self.error_cov = np.ones((n, 6, 6))
+        self.angular_state = np.zeros((n, 3))
+        self.angular_error_cov = np.ones((n, 3, 3))
+
+        self._process_cov = PROCESS_NOISE * np.eye(6)
+        self._default_measurement_cov = MEASUREMENT_NOISE * np.ones((2, 2))
+        self._angular_process_cov = PROCESS_NOISE * np.eye(3)
+
+        # Measurements of the current frame, nan when the thing was not seen
+        self.measured_pos = np.full((n, 2), np.nan)
+        self.measured_orientation = np.full(n, np.nan)
+        self.measured_id = np.full(n, -1)
+        self.updated = np.zeros(n, bool)
+
+        # Measurement noise of each thing in the current frame, the fixed
+        # one unless the seeker gave the variance of its position
+        self.measurement_cov = np.tile(self._default_measurement_cov, (n, 1, 1))
+
+        # Tracking info
+        self.last_update = np.full(n, np.nan)
+        self.lost_counter = np.zeros(n, np.int32)
+
+        # Filters outputs
+        self.pos = np.full((n, 2), np.nan)
+        self.orientation = np.full(n, np.nan)
+        self.ids = np.full(n, -1)
+
+        # Preallocated transition matrices, only the dt terms change
+        self._transition = np.tile(np.eye(6), (n, 1, 1))
+        self._angular_transition = np.tile(np.eye(3), (n, 1, 1))
+
+        for i, thing in enumerate(things):
+            thing.tracker = self
+            thing.index = i
+
+    def measure(self, index: int, id: int, pos, orientation=None, variance=None) -> None:
+        """ Stores the measurement of a thing for the next step """
+        self.updated[index] = True
+        self.measured_id[index] = id
+        if pos is not None and pos[0] is not None:
+            self.measured_pos[index] = pos
+        if variance is not None:
+            self.measurement_cov[index] = np.diag(variance)
+        if orientation is not None:
+            self.measured_orientation[index] = orientation
+
+    def reset(self, index: int) -> None:
+        self.last_update[index] = np.nan
+        self.pos[index] = np.nan
+        self.orientation[index] = np.nan
+
+    def _set_transitions(self, dt: np.ndarray) -> None:
+        half_dt2 = .5 * dt ** 2
+
+        f = self._transition
+        f[:, 0, 2] = f[:, 1, 3] = f[:, 2, 4] = f[:, 3, 5] = dt
+        f[:, 0, 4] = f[:, 1, 5] = half_dt2
+
+        fa = self._angular_transition
+        fa[:, 0, 1] = fa[:, 1, 2] = dt
+        fa[:, 0, 2] = half_dt2
+
+    def _predict(self, mask: np.ndarray) -> None:
+        # With so few things it is cheaper to predict all of them and keep
+        # only the masked results than to gather the masked rows
+        f = self._transition
+        state = (f @ self.state[..., None])[..., 0]
+        error_cov = f @ self.error_cov @ f.transpose(0, 2, 1) + self._process_cov
+        np.copyto(self.state, state, where=mask[:, None])
+        np.copyto(self.error_cov, error_cov, where=mask[:, None, None])
+
+    def _predict_angular(self, mask: np.ndarray) -> None:
+        f = self._angular_transition
+        state = (f @ self.angular_state[..., None])[..., 0]
+        error_cov = f @ self.angular_error_cov @ f.transpose(0, 2, 1) + self._angular_process_cov
+        np.copyto(self.angular_state, state, where=mask[:, None])
+        np.copyto(self.angular_error_cov, error_cov, where=mask[:, None, None])
+
+    def _correct(self, mask: np.ndarray) -> None:
+        p = self.error_cov
+
+        # The measurement matrix only selects x and y, so H P H^T and P H^T
+        # are just slices of P, and the 2 x 2 inverse has a closed form
+        s = p[:, :2, :2] + self.measurement_cov
+        det = s[:, 0, 0] * s[:, 1, 1] - s[:, 0, 1] * s[:, 1, 0]
+        det[~mask] = 1.
+        s_inv = np.empty_like(s)
+        s_inv[:, 0, 0] = s[:, 1, 1]
+        s_inv[:, 1, 1] = s[:, 0, 0]
+        s_inv[:, 0, 1] = -s[:, 0, 1]
+        s_inv[:, 1, 0] = -s[:, 1, 0]
+        s_inv /= det[:, None, None]
+
+        gain = p[:, :, :2] @ s_inv
+        # Rows without measurement become nan here, but they are not copied
+        innovation = self.measured_pos - self.state[:, :2]
+        state = self.state + (gain @ innovation[..., None])[..., 0]
+        error_cov = p - gain @ p[:, :2, :]
+        np.copyto(self.state, state, where=mask[:, None])
+        np.copyto(self.error_cov, error_cov, where=mask[:, None, None])
+
+    def _correct_angular(self, mask: np.ndarray) -> None:
+        p = self.angular_error_cov
+        gain = p[:, :, 0] / (p[:, 0, 0] + MEASUREMENT_NOISE)[:, None]
+        innovation = self.measured_orientation - self.angular_state[:, 0]
+        state = self.angular_state + gain * innovation[:, None]
+        error_cov = p - gain[:, :, None] * p[:, None, 0, :]
+        np.copyto(self.angular_state, state, where=mask[:, None])
+        np.copyto(self.angular_error_cov, error_cov, where=mask[:, None, None])
+
+    def step(self, now: float = None) -> None:
+        """ Runs the filters of all things with the measurements stored since
+            the last step and updates the Things objects """
+        if now is None:
+            now = time.time()
+
+        seen = ~np.isnan(self.measured_pos[:, 0])
+        has_orientation = ~np.isnan(self.measured_orientation)
+        started = ~np.isnan(self.last_update)
+
+        # Things seen for the first time just start their filters. Things
+        # without an update call in this frame are left as they are
+        starting = self.updated & ~started & seen
+        if starting.any():
+            self.state[starting] = 0.
+            self.state[starting, :2] = self.measured_pos[starting]
+            self.error_cov[starting] = 1.
+            self.angular_state[starting] = 0.
+            self.angular_state[starting, 0] = np.where(has_orientation[starting],
+                                                       self.measured_orientation[starting], 0.)
+            self.angular_error_cov[starting] = 1.
+            self.lost_counter[starting] = 0
+            self.pos[starting] = self.measured_pos[starting]
+            self.orientation[starting] = self.measured_orientation[starting]
+
+        running = self.updated & ~starting
+        if running.any():
+            dt = np.where(started, (now - self.last_update) / self.frame_period, 1.)
+            self._set_transitions(dt)
+
+            self._predict(running)
+            self._predict_angular(running)
+
+            correcting = running & seen & (self.lost_counter < MAX_LOST_FRAMES)
+            if correcting.any():
+                self._correct(correcting)
+                self.lost_counter[correcting] = 0
+
+            angular_correcting = correcting & has_orientation
+            if angular_correcting.any():
+                self._correct_angular(angular_correcting)
+
+            self.lost_counter[running & ~correcting] += 1
+
+            # The output is one step ahead of the corrected state
+            self._predict(running)
+            self.pos[running] = self.state[running, :2]
+
+            # Orientations measured near +-pi restart the angular filter, because
+            # of the wrap around. Missing orientations come from the filter
+            wrapping = running & has_orientation & \
+                       (np.abs(np.abs(self.measured_orientation) - math.pi) < 0.15)
+            self.angular_state[wrapping] = 0.
+            self.angular_state[wrapping, 0] = self.measured_orientation[wrapping]
+
+            self.orientation[running] = self.measured_orientation[running]
+            missing = running & ~has_orientation
+            if missing.any():
+                self._predict_angular(missing)
+                self.orientation[missing] = self.angular_state[missing, 0]
+
+        lost = self.updated & (self.lost_counter >= MAX_LOST_FRAMES)
+        tracked = self.updated & ~lost
+        self.ids[tracked] = self.measured_id[tracked]
+        self.last_update[tracked] = now
+        self.last_update[lost] = np.nan
+        self.pos[lost] = np.nan
+        self.orientation[lost] = np.nan
+
+        self._write_back(lost)
+
+        self.measured_pos[:] = np.nan
+        self.measured_orientation[:] = np.nan
+        self.measurement_cov[self.updated] = self._default_measurement_cov
+        self.updated[:] = False
+
+    def _write_back(self, lost: np.ndarray) -> None:
+        for i in np.flatnonzero(self.updated):
+            thing = self.things[i]
+            thing.lost_counter = self.lost_counter[i]
+            if lost[i]:
+                thing.pos = np.array([None, None])
+                thing.last_update = None
+                thing.orientation = None
+            else:
+                thing.id = self.ids[i]
+                thing.last_update = self.last_update[i]
+                thing.pos = self.pos[i].copy()
+                orientation = self.orientation[i]
+                thing.orientation = None if np.isnan(orientation) else orientation
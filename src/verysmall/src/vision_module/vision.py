@@ -5,17 +5,26 @@ import time
 import sys
 import pickle
 import os
+from collections import deque
 from time import sleep
+from threading import Thread
 
 from vision_module.camera_module.camera import Camera
 from vision_module.vision_utils.params_setter import ParamsSetter
 from vision_module.vision_utils.color_segmentation import ColorSegmentation
-from vision_module.seekers.things_seeker import HawkEye
+from vision_module.vision_utils.color_lut import ColorLUT
+from vision_module.vision_utils.frame_queue import FrameQueue
+from vision_module.vision_utils.latency_monitor import LatencyMonitor
+from vision_module.vision_utils.detection_pyramid import DetectionPyramid
+from vision_module.vision_utils.color_adapter import ColorAdapter
+from vision_module.vision_utils.recorder import VisionRecorder, NUM_ROWS
+from vision_module.seekers.things_seeker import HawkEye, ARUCO_TAGS
 from vision_module.seekers.things_seeker import Things
+from vision_module.seekers.things_tracker import ThingsTracker
 from vision_module import COLORS
 from verysmall.msg import game_topic
 from utils.json_handler import JsonHandler
-from ROS.ros_vision_publisher import RosVisionPublisher
+from ROS.ros_vision_publisher import RosVisionPublisher, new_things_state
 
 from vision_module.seekers.circular_color_tag_seeker import CircularColorTagSeeker
 
@@ -25,34 +34,123 @@ from vision_module.seekers.circular_color_tag_seeker import CircularColorTagSeek
 HEIGHT = 1
 
 
+def get_origin_and_factor(arena_vertices: np.ndarray):
+    """ Returns the (0,0) pos of the field in the arena image and the
+        conversion factors between pixel and centimeters in x and y """
+
+    # for x
+    x = np.sort(arena_vertices[:, 0])
+
+    # xo is the third smaller vertice element because the first two ones are
+    # the goal vertices
+    xo = np.mean(x[2:6])
+
+    y_sorted = np.sort(arena_vertices[:, 1])
+
+    upper_y = np.mean(y_sorted[:2])
+
+    # the yo origin is the most bottom vertice
+    yo = np.mean(y_sorted[-2:])
+    origin = np.array([xo, yo])
+
+    rightmost_x = np.mean(x[10:14])
+
+    # The height in pixels is the diff between yo and ymax
+    height_px = abs(yo - upper_y)
+    width_px = abs(xo - rightmost_x)
+
+    # now just calculate the pixel to cm factor
+    return origin, 150.0 / width_px, 130.0 / height_px
+
+
+def get_region_origin_and_factor(field_region, arena_size):
+    """ Same as get_origin_and_factor for a camera that sees only a part of
+        the field. field_region is the [x_min, y_min, x_max, y_max] rectangle
+        of the field, in centimeters, that the arena image spans """
+    x_min, y_min, x_max, y_max = field_region
+    w, h = arena_size
+    factor_x = (x_max - x_min) / float(w)
+    factor_y = (y_max - y_min) / float(h)
+
+    # The top left corner of the arena image is (x_min, y_max)
+    origin = np.array([-x_min / factor_x, y_max / factor_y])
+    return origin, factor_x, factor_y
+
+
+def get_max_decode_scale(warp_matrix: np.ndarray, arena_size, scales=(1, 2, 4, 8)) -> int:
+    """ Returns the largest decode scale that still keeps at least one frame
+        pixel for each arena image pixel, along both axes of the arena region.
+        warp_matrix is the full resolution matrix of the arena params file """
+    w, h = arena_size
+    corners = np.float64([[[0, 0]], [[w, 0]], [[w, h]], [[0, h]]])
+    frame_corners = cv2.perspectiveTransform(corners, np.linalg.inv(np.asarray(warp_matrix, np.float64)))
+    frame_corners = frame_corners.reshape(4, 2)
+
+    # Shortest side of the arena region in each axis
+    region_w = min(np.linalg.norm(frame_corners[1] - frame_corners[0]),
+                   np.linalg.norm(frame_corners[2] - frame_corners[3]))
+    region_h = min(np.linalg.norm(frame_corners[3] - frame_corners[0]),
+                   np.linalg.norm(frame_corners[2] - frame_corners[1]))
+
+    best = 1
+    for scale in scales:
+        if region_w / scale >= w and region_h / scale >= h:
+            best = scale
+    return best
+
+
 class Vision:
 
     def __init__(self, camera, num_blue_robots, num_yellow_robots,
-                 params_file_name="", colors_params="", method="", vision_owner: str = 'Player_One'):
+                 params_file_name="", colors_params="", method="", vision_owner: str = 'Player_One',
+                 fused_remap: bool = False, pipelined: bool = False,
+                 parallel_seekers: bool = False, color_tracking: bool = False,
+                 batched_tracking: bool = False, seekers: dict = None,
+                 detection_scale: int = 1, aruco_pose_3d: bool = False,
+                 aruco_tracking: bool = False, adaptive_colors: bool = False,
+                 ros_node: bool = True, ball_reacquisition: bool = False):
+        """ Without ros_node the vision neither starts a ROS node nor
+            publishes, the caller reads the things_state itself. It is how
+            the fused vision runs one vision for each camera """
 
         # This object will be responsible for publish the game state info
         # at the bus. Mercury is the gods messenger
-        self.mercury = RosVisionPublisher(True)
+        self.mercury = RosVisionPublisher(True) if ros_node else None
+
+        # Buffer with everything published in the vision topic. The lists
+        # used to unpack the info from Things objects are views of it, so the
+        # publisher converts the whole state at once
+        self.things_state = new_things_state()
 
-        # Lists used to unpack the info from Things objects and publish those
-        # infos in the vision topic
+        # Grab time of the frame being processed, published with the positions
+        self.frame_timestamp = 0.
+
+        # Time spent in each stage of the frame loop, for monitoring
+        self.latency = LatencyMonitor()
 
         # Ball info
-        self.ball_pos = np.array([[.0, .0]])
+        self.ball_pos = self.things_state["ball_pos"].reshape(1, 2)
         self.ball_speed = np.array([[.0, .0]])
 
         # Home team info
-        self.yellow_team_pos = np.array([[0.0, 0.0]] * 5)
-        self.yellow_team_orientation = np.array([0.0] * 5)
+        self.yellow_team_pos = self.things_state["yellow_team_pos"]
+        self.yellow_team_orientation = self.things_state["yellow_team_orientation"]
         self.yellow_team_speed = np.array([[0.0, 0.0]] * 5)
 
         # Adv team info
-        self.blue_team_pos = np.array([[0.0, 0.0]] * 5)
-        self.blue_team_orientation = np.array([0.0] * 5)
+        self.blue_team_pos = self.things_state["blue_team_pos"]
+        self.blue_team_orientation = self.things_state["blue_team_orientation"]
         self.blue_team_speed = np.array([[0.0, 0.0]] * 5)
 
+        # All the positions of the state, ball first, then the yellow and the
+        # blue slots, and all the orientations. Used by the batched tracker export
+        flat_state = self.things_state.reshape(1).view(np.float64)
+        self._state_pos = flat_state[:22].reshape(11, 2)
+        self._state_orientation = flat_state[22:32]
+
         # Subscribes to the game topic
-        rospy.Subscriber(vision_owner, game_topic, self.on_game_state_change)
+        if ros_node:
+            rospy.Subscriber(vision_owner, game_topic, self.on_game_state_change)
 
         self.game_state = None
 
@@ -63,16 +161,35 @@ class Vision:
 
         self.arena_vertices = []
         self.arena_size = ()
+        self.field_region = None
         self.arena_image = None
+        self.seek_image = None
         self.arena_mask = None
         self.raw_image = None
         self.warp_matrix = None
+        self.fused_remap = fused_remap
+        self.fused_map1 = None
+        self.fused_map2 = None
         self.pipeline = None
+        self.pipelined = pipelined
+        self.frames_queue = FrameQueue(maxlen=1)
         self.fps = 0
         self.last_time = None
         self.new_time = None
         self._colors_thresholds = {}
-        self.hawk_eye_extra_params = {}
+        self.color_lut = None
+        self.hawk_eye_extra_params = {"color_tracking": color_tracking,
+                                      "aruco_pose_3d": aruco_pose_3d,
+                                      "aruco_tracking": aruco_tracking,
+                                      "ball_reacquisition": ball_reacquisition}
+
+        # Thresholds adapted in the background, waiting to be swapped in by
+        # the frame loop
+        self.color_adapter = None
+        self._adapted_thresholds = deque(maxlen=1)
+
+        # Writes the frames and what was found in them, while recording
+        self.recorder = None
 
         # Super necessary to compute the robots positions
         self.origin = None
@@ -90,8 +207,24 @@ class Vision:
         # Object to store ball info
         self.ball = Things()
 
-        # seekers description
+        # Runs the kalman filters of all things at once, after the seekers
+        self.tracker = None
+        if batched_tracking:
+            self.tracker = ThingsTracker([self.ball] + self.yellow_team + self.blue_team)
+
+            # Maps each tracker row and thing id to its slot in the state
+            self._pos_base = np.array([0] + [1] * num_yellow_robots + [6] * num_blue_robots)
+            self._orientation_base = np.array([0] + [0] * num_yellow_robots + [5] * num_blue_robots)
+            self._has_orientation = np.array([False] + [True] * (num_yellow_robots + num_blue_robots))
+
+        # With a detection scale above 1 the colors are first segmented in the
+        # arena image downscaled by it, and then only around what was found
+        self.pyramid = DetectionPyramid(detection_scale) if detection_scale > 1 else None
+
+        # seekers description. When not given it comes from the game.json file
         self.seekers = {}
+        self.seekers_override = seekers
+        self.aruco_tags = ARUCO_TAGS
 
         if self.params_file_name != "":
             self.load_params()
@@ -101,16 +234,33 @@ class Vision:
             self.colors_params_file = colors_params
             self.load_colors_params()
             self.pipeline = self.color_seg_pipeline
+            self.segment = self.hsv_segment
+            self.color_calibrator = ColorSegmentation(camera, self.colors_params_file)
+        elif method == "lut_segmentation":
+            self.colors_params_file = colors_params
+            self.color_lut = ColorLUT()
+            self.load_colors_params()
+            self.pipeline = self.lut_seg_pipeline
+            self.segment = self.lut_segment
             self.color_calibrator = ColorSegmentation(camera, self.colors_params_file)
         else:
             print("Method not recognized!")
 
+        if self.pyramid is not None:
+            self.pipeline = self.pyramid_seg_pipeline
+
         self.params_setter = ParamsSetter(camera, params_file_name)
 
         self.set_origin_and_factor()
 
+        # When the fused remap is on, the camera must deliver the raw frames
+        # because the lens correction is already inside the fused maps
+        self.camera.set_lens_correction(not self.fused_remap)
+
         # Gets a initialization frame
         self.raw_image = camera.read()
+        if self.raw_image is None:
+            raise RuntimeError("the camera gave no initialization frame")
         self.warp_perspective()
 
         # The hawk eye object will be responsible to locate and identify all
@@ -118,7 +268,12 @@ class Vision:
         self.load_colors_hawkeye()
         self.hawk_eye = HawkEye(self.origin, self.conversion_factor_x, self.conversion_factor_y,
                                 self.seekers, self.num_yellow_robots, self.num_blue_robots,
-                                self.arena_image.shape, self.hawk_eye_extra_params)
+                                self.arena_image.shape, self.hawk_eye_extra_params,
+                                parallel=parallel_seekers, patches=self.pyramid is not None)
+
+        if adaptive_colors:
+            self.color_adapter = ColorAdapter(self._colors_thresholds, self.on_adapted_thresholds)
+            self.color_adapter.start()
 
     def on_game_state_change(self, data):
         self.game_state = data.game_state
@@ -132,6 +287,11 @@ class Vision:
         else:
             self.in_calibration_mode = not self.in_calibration_mode
 
+        # The calibration tools work over the lens corrected image, in the
+        # full resolution
+        self.camera.set_lens_correction(self.in_calibration_mode or not self.fused_remap)
+        self.camera.set_reduced_decode(not self.in_calibration_mode)
+
     def reset_all_things(self):
         # Used when the game state changes to playing
         self.ball.reset()
@@ -160,43 +320,48 @@ class Vision:
     def set_origin_and_factor(self):
         """ This function calculates de conversion factor between pixel to centimeters
             and finds the (0,0) pos of the field in the image """
+        if self.field_region is not None:
+            self.origin, self.conversion_factor_x, self.conversion_factor_y = \
+                get_region_origin_and_factor(self.field_region, self.arena_size)
+        else:
+            self.origin, self.conversion_factor_x, self.conversion_factor_y = \
+                get_origin_and_factor(self.arena_vertices)
 
-        # for x
-        x = np.sort(self.arena_vertices[:, 0])
-
-        # xo is the third smaller vertice element because the first two ones are
-        # the goal vertices
-        xo = np.mean(x[2:6])
-
-        y_sorted = np.sort(self.arena_vertices[:, 1])
-
-        upper_y = np.mean(y_sorted[:2])
-
-        # the yo origin is the most bottom vertice
-        yo = np.mean(y_sorted[-2:])
-        self.origin = np.array([xo, yo])
-
-        rightmost_x = np.mean(x[10:14])
-
-        # The height in pixels is the diff between yo and ymax
-        height_px = abs(yo - upper_y)
-        width_px = abs(xo - rightmost_x)
-
-        # now just calculate the pixel to cm factor
-
-        self.conversion_factor_x = 150.0 / width_px
-        self.conversion_factor_y = 130.0 / height_px
+    def update_field_conversion(self) -> None:
+        """ Recomputes the conversion to centimeters after the arena params
+            changed, for the hawk eye too """
+        self.set_origin_and_factor()
+        self.hawk_eye.field_origin = self.origin
+        self.hawk_eye.conversion_factor_x = self.conversion_factor_x
+        self.hawk_eye.conversion_factor_y = self.conversion_factor_y
 
     def load_params(self):
         """ Loads the warp matrix and the arena vertices from the arena parameters file"""
         params = JsonHandler.read(self.params_file_name)
-        self.seekers = JsonHandler.read("parameters/game.json")["seekers"]
+        game = JsonHandler.read("parameters/game.json")
+        if self.seekers_override is not None:
+            self.seekers = self.seekers_override
+        else:
+            self.seekers = game["seekers"]
+
+        # Marker id of each robot slot of the teams with the aruco seeker
+        self.aruco_tags = game.get("aruco_tags", ARUCO_TAGS)
         self.arena_vertices = np.array(params['arena_vertices'])
-        self.warp_matrix = np.asarray(params['warp_matrix']).astype("float32")
+
+        # The warp matrix is set over the full resolution frames, the scale
+        # matrix brings the reduced frames of the camera to them first
+        warp_matrix = np.asarray(params['warp_matrix']) @ self.camera.get_scale_matrix()
+        self.warp_matrix = warp_matrix.astype("float32")
         self.arena_size = (params['arena_size'][0], params['arena_size'][1])
 
+        # Only in the params of the cameras that see a part of the field
+        self.field_region = params.get('field_region')
+
         self.create_mask()
 
+        if self.fused_remap:
+            self.create_fused_maps()
+
     def load_colors_params(self):
         file1 = os.environ['ROS_ARARA_ROOT']+"src/" + self.colors_params_file
         if os.path.exists(file1):
@@ -209,6 +374,11 @@ class Vision:
         try:
             with open(filename, 'rb') as fp:
                 self._colors_thresholds = pickle.load(fp)
+                if self.color_lut is not None:
+                    self.color_lut.build(self._colors_thresholds)
+                if self.color_adapter is not None:
+                    self._adapted_thresholds.clear()
+                    self.color_adapter.reset(self._colors_thresholds)
                 self.load_colors_hawkeye()
                 try:
                     self.hawk_eye.reset(self.hawk_eye_extra_params)
@@ -218,15 +388,69 @@ class Vision:
             rospy.logfatal("Color params file load failed")
             rospy.logfatal(repr(e))
         
+    def on_adapted_thresholds(self, thresholds: dict) -> None:
+        """ Called from the color adapter thread. The new lookup table is
+            built right here, off the frame loop, and swapped at once at the
+            end of the build. The other users of the thresholds are swapped
+            by the frame loop between two frames """
+        if self.color_lut is not None:
+            self.color_lut.build(thresholds)
+        self._adapted_thresholds.append(thresholds)
+
+    def swap_colors_thresholds(self, thresholds: dict) -> None:
+        self._colors_thresholds = thresholds
+        self.load_colors_hawkeye()
+        self.hawk_eye.set_color_thresholds(self.hawk_eye_extra_params)
+
+    def sample_colors(self, arena_image: np.ndarray) -> None:
+        """ Hands the color adapter the pixel positions of the things seen in
+            the last frame, and the segmented arena image of that frame. The
+            robots of the color seeker also carry the secondary color of
+            their slot, next to their center """
+        to_pixel = self.hawk_eye.real_world_to_pixel
+        secondary_colors = sorted(set(self._colors_thresholds) - {"blue", "yellow", "orange"})
+
+        centers = {}
+        for color, things in (("orange", [self.ball]), ("yellow", self.yellow_team),
+                              ("blue", self.blue_team)):
+            for slot, thing in enumerate(things):
+                if thing.lost_counter != 0 or thing.pos[0] is None:
+                    continue
+                center = to_pixel(thing.pos)
+                centers.setdefault(color, []).append(center)
+                if color != "orange" and self.seekers[color] == "color" and \
+                        slot < len(secondary_colors):
+                    centers.setdefault(secondary_colors[slot], []).append(center)
+
+        # The HSV pipeline converts the arena image itself, the others keep it BGR
+        self.color_adapter.submit(arena_image, centers,
+                                  is_hsv=self.pipeline == self.color_seg_pipeline)
+
     def load_colors_hawkeye(self) -> None:
         thrs = self._colors_thresholds
-        self.hawk_eye_extra_params["ball"] = (thrs["orange"]["min"], 
-                                              thrs["orange"]["max"])
+
+        # With the lookup table the seekers threshold the label image, so
+        # each color range is just its label
+        if self.color_lut is not None:
+            self.hawk_eye_extra_params["ball"] = self.color_lut.bounds("orange")
+        else:
+            self.hawk_eye_extra_params["ball"] = (thrs["orange"]["min"],
+                                                  thrs["orange"]["max"])
+
+        # The color tag seeker weights the pixels of the team masks by them
+        for team in ("yellow", "blue"):
+            if self.color_lut is not None:
+                self.hawk_eye_extra_params[team] = self.color_lut.bounds(team)
+            else:
+                self.hawk_eye_extra_params[team] = (thrs[team]["min"], thrs[team]["max"])
 
         if "aruco" in self.seekers.values():
             self.hawk_eye_extra_params["aruco"] = (self.camera.camera_matrix, 
                                                    self.camera.dist_vector)
-        if "color" in self.seekers.values():
+            self.hawk_eye_extra_params["aruco_tags"] = self.aruco_tags
+        if "color" in self.seekers.values() and self.color_lut is not None:
+            self.hawk_eye_extra_params["color"] = self.color_lut.secondary_bounds()
+        elif "color" in self.seekers.values():
             primary_colors = {"blue", "yellow", "orange"}
             secondary_colors = set(self._colors_thresholds.keys()) - primary_colors
             secondary_colors = sorted(list(secondary_colors))
@@ -238,7 +462,36 @@ class Vision:
     def warp_perspective(self):
         """ Takes the real world arena returned by camera and transforms it
             to a perfect retangle """
-        self.arena_image = cv2.warpPerspective(self.raw_image, self.warp_matrix, self.arena_size)
+        if self.fused_map1 is not None:
+            self.arena_image = cv2.remap(self.raw_image, self.fused_map1, self.fused_map2,
+                                         cv2.INTER_LINEAR)
+        else:
+            self.arena_image = cv2.warpPerspective(self.raw_image, self.warp_matrix, self.arena_size)
+
+    def create_fused_maps(self):
+        """ Composes the lens correction maps of the camera with the warp matrix
+            in a single fixed point map. With it a raw frame goes straight to
+            the arena coordinates with only one remap """
+        w, h = self.arena_size
+
+        # For each arena pixel finds where it comes from in the corrected image
+        xs, ys = np.meshgrid(np.arange(w, dtype=np.float32), np.arange(h, dtype=np.float32))
+        arena_pts = np.dstack([xs, ys]).reshape(-1, 1, 2)
+        inv_warp = np.linalg.inv(self.warp_matrix.astype(np.float64))
+        src = cv2.perspectiveTransform(arena_pts, inv_warp).reshape(h, w, 2)
+        map_x, map_y = src[..., 0], src[..., 1]
+
+        # And then where that corrected pixel comes from in the raw frame
+        lens_x, lens_y = self.camera.get_lens_maps()
+        if lens_x is not None:
+            lens_x = np.asarray(lens_x, dtype=np.float32)
+            lens_y = np.asarray(lens_y, dtype=np.float32)
+            map_x, map_y = (cv2.remap(lens_x, map_x, map_y, cv2.INTER_LINEAR,
+                                      borderMode=cv2.BORDER_CONSTANT, borderValue=-1),
+                            cv2.remap(lens_y, map_x, map_y, cv2.INTER_LINEAR,
+                                      borderMode=cv2.BORDER_CONSTANT, borderValue=-1))
+
+        self.fused_map1, self.fused_map2 = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
 
     def create_mask(self):
         """ Creates the image where the mask will be stored """
@@ -251,6 +504,9 @@ class Vision:
             set_dark_border function """
         self.arena_mask = cv2.inRange(_arena_mask, COLORS.WHITE, COLORS.WHITE)
 
+        if self.pyramid is not None:
+            self.pyramid.set_arena_mask(self.arena_mask)
+
     def set_dark_border(self):
         """ Applies a bitwise operation between the arena image and the arena mask
             to get rid of the pixels behind the goal lines"""
@@ -265,6 +521,7 @@ class Vision:
     def color_seg_pipeline(self):
         """ Wait until the color parameters are used """
         self.arena_image = cv2.cvtColor(self.arena_image, cv2.COLOR_BGR2HSV)
+        self.seek_image = self.arena_image
 
         thr = self._colors_thresholds
         self.blue_seg = self.get_filter(self.arena_image, 
@@ -275,36 +532,231 @@ class Vision:
                                           thr["yellow"]["min"], 
                                           thr["yellow"]["max"])
 
+    def lut_seg_pipeline(self):
+        """ Labels the arena image with the colors lookup table, all the color
+            masks come from this single label image """
+        self.seek_image = self.color_lut.label(self.arena_image)
+        self.blue_seg = self.color_lut.mask("blue")
+        self.yellow_seg = self.color_lut.mask("yellow")
+
+    def hsv_segment(self, img: np.ndarray):
+        """ Returns the HSV image and the yellow and blue masks of a BGR image """
+        hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+        thr = self._colors_thresholds
+        return (hsv,
+                self.get_filter(hsv, thr["yellow"]["min"], thr["yellow"]["max"]),
+                self.get_filter(hsv, thr["blue"]["min"], thr["blue"]["max"]))
+
+    def lut_segment(self, img: np.ndarray):
+        """ Returns the label image and the yellow and blue masks of a BGR image """
+        labels = self.color_lut.label_patch(img)
+        return (labels,
+                cv2.compare(labels, self.color_lut.labels["yellow"], cv2.CMP_EQ),
+                cv2.compare(labels, self.color_lut.labels["blue"], cv2.CMP_EQ))
+
+    def pyramid_seg_pipeline(self):
+        """ Segments the downscaled arena image to find where the ball and the
+            robots are, and then segments the full resolution image only in
+            the patches around them. The seek image and the masks are lists of
+            (patch, offset) pairs, in the same order, where offset is the
+            (x, y) pixel of the patch top left corner in the arena image """
+        pyramid = self.pyramid
+        small_seek, small_yellow, small_blue = self.segment(pyramid.downscale(self.arena_image))
+
+        ball_min, ball_max = self.hawk_eye_extra_params["ball"]
+        coarse = cv2.inRange(small_seek, ball_min, ball_max)
+        cv2.bitwise_or(coarse, small_yellow, dst=coarse)
+        cv2.bitwise_or(coarse, small_blue, dst=coarse)
+
+        # New lists on every frame, so the pipelined mode needs no copies
+        self.seek_image, self.yellow_seg, self.blue_seg = [], [], []
+        for rows, cols in pyramid.get_regions(coarse):
+            seek, yellow, blue = self.segment(pyramid.get_patch(self.arena_image, (rows, cols)))
+            offset = np.array([cols.start, rows.start])
+            self.seek_image.append((seek, offset))
+            self.yellow_seg.append((yellow, offset))
+            self.blue_seg.append((blue, offset))
+
+    def get_bgr_arena_image(self) -> np.ndarray:
+        """ Returns the arena image in BGR, whatever the pipeline did with it """
+        if self.color_lut is not None or self.pyramid is not None:
+            return self.arena_image
+        return cv2.cvtColor(self.arena_image, cv2.COLOR_HSV2BGR)
+
+    def preprocess(self):
+        """ Takes a frame from the camera and runs it until the segmentation,
+            returning everything the seekers need, the frame grab time, the
+            camera frame itself, its JPEG buffer, when the camera has it, and
+            the arena image the colors were segmented from. Returns None when
+            the camera gives no frame, like a capture process that timed out """
+        raw_image = self.camera.read()
+        if raw_image is None:
+            return None
+
+        self.raw_image = raw_image
+        timestamp = self.camera.timestamp
+        t0 = time.time()
+        if timestamp is None:
+            timestamp = t0
+        self.latency.record("capture", t0 - timestamp)
+
+        self.warp_perspective()
+        # The detection pyramid applies the arena mask only where it looks
+        if self.pyramid is None:
+            self.set_dark_border()
+        t1 = time.time()
+        self.latency.record("warp", t1 - t0)
+
+        self.pipeline()
+        self.latency.record("segment", time.time() - t1)
+
+        return self.seek_image, self.yellow_seg, self.blue_seg, timestamp, self.raw_image, \
+            self.camera.encoded, self.arena_image
+
+    def preprocess_loop(self):
+        """ Used in the pipelined mode. Warps and segments the next frame while
+            the run thread is still seeking the current one. The heavy work here
+            is done by OpenCV calls, which release the GIL """
+        while not self.finish:
+            if self.game_on and not self.in_calibration_mode:
+                frame = self.preprocess()
+                if frame is None:
+                    continue
+
+                # The lookup table reuses its buffers on every frame, so the
+                # images must be copied before the next frame overwrites them
+                if self.color_lut is not None and self.pyramid is None:
+                    frame = tuple(img.copy() for img in frame[:3]) + frame[3:]
+
+                # Some sources reuse the camera frame too, and the recorder
+                # only copies it after the seekers
+                if self.recorder is not None:
+                    frame = frame[:4] + (frame[4].copy(),) + frame[5:]
+
+                self.frames_queue.put(frame)
+            else:
+                sleep(0.016)
+
+    def seek_things(self, seek_image, yellow_seg, blue_seg, timestamp):
+        t0 = time.time()
+        self.hawk_eye.seek_all(seek_image, yellow_seg, blue_seg,
+                               self.yellow_team, self.blue_team, self.ball)
+        t1 = time.time()
+        self.latency.record("seek", t1 - t0)
+
+        # The filters advance by the time between the frames grabs, not by
+        # the time between their processing
+        if self.tracker is not None:
+            self.tracker.step(timestamp)
+        self.latency.record("track", time.time() - t1)
+
+        self.frame_timestamp = timestamp
+
+    def process_frame(self, frame):
+        """ Seeks the things in a preprocessed frame and publishes them """
+        seek_image, yellow_seg, blue_seg, timestamp, raw_image, encoded, arena_image = frame
+
+        # In the pipelined mode the next frame may already be in preprocess,
+        # so the new thresholds only reach the seekers here, between frames
+        if self._adapted_thresholds:
+            self.swap_colors_thresholds(self._adapted_thresholds.pop())
+
+        self.seek_things(seek_image, yellow_seg, blue_seg, timestamp)
+
+        if self.color_adapter is not None:
+            self.sample_colors(arena_image)
+
+        t0 = time.time()
+        self.send_message(ball=True, yellow_team=True, blue_team=True)
+        t1 = time.time()
+        self.latency.record("publish", t1 - t0)
+
+        # Read once, recording may be stopped from another thread
+        recorder = self.recorder
+        if recorder is not None:
+            self.record_frame(recorder, raw_image, encoded)
+        self.latency.record("total", t1 - self.frame_timestamp)
+        self.update_fps()
+
     def run(self):
+        if self.pipelined:
+            preprocess_thread = Thread(target=self.preprocess_loop, args=())
+            preprocess_thread.daemon = True
+            preprocess_thread.start()
+
         while not self.finish:
 
             self.last_time = time.time()
             while self.game_on and not self.in_calibration_mode:
-                self.raw_image = self.camera.read()
-                self.warp_perspective()
-                self.set_dark_border()
-                self.pipeline()
-
-                self.hawk_eye.seek_yellow_team(self.yellow_seg, 
-                                               self.yellow_team, 
-                                               self.hawk_eye.yellow_team_seeker,
-                                               opt=self.arena_image)
-                
-                self.hawk_eye.seek_blue_team(self.blue_seg,
-                                             self.blue_team,
-                                             self.hawk_eye.blue_team_seeker,
-                                             opt=self.arena_image)
-
-                self.hawk_eye.seek_ball(self.arena_image, self.ball)
-
-                self.send_message(ball=True, yellow_team=True, blue_team=True)
-                self.update_fps()
+                if self.pipelined:
+                    frame = self.frames_queue.get(timeout=0.1)
+                else:
+                    frame = self.preprocess()
+                if frame is None:
+                    continue
+
+                self.process_frame(frame)
 
             if self.in_calibration_mode:
+                # Frames from before the calibration are useless after it
+                self.frames_queue.clear()
                 sleep(0.016)
 
+        if self.pipelined:
+            preprocess_thread.join(timeout=1.0)
+
+        self.stop_recording()
         self.camera.stop()
-        self.camera.capture.release()
+        self.camera.release()
+        if self.color_adapter is not None:
+            self.color_adapter.stop()
+
+    def start_recording(self, path: str, frame_format: str = "raw", **kwargs) -> None:
+        """ Starts writing every processed frame to a vision log, with the
+            detections, the kalman states and the published state. kwargs go
+            to the VisionRecorder """
+        self.stop_recording()
+        metadata = {"num_yellow_robots": self.num_yellow_robots,
+                    "num_blue_robots": self.num_blue_robots,
+                    "seekers": self.seekers,
+                    "arena_size": self.arena_size,
+                    "origin": self.origin,
+                    "conversion_factor_x": self.conversion_factor_x,
+                    "conversion_factor_y": self.conversion_factor_y}
+        self.recorder = VisionRecorder(path, metadata, frame_format, **kwargs)
+
+    def stop_recording(self) -> None:
+        """ Writes the frames still queued and closes the log """
+        recorder, self.recorder = self.recorder, None
+        if recorder is not None:
+            recorder.close()
+
+    def record_frame(self, recorder: VisionRecorder, raw_image: np.ndarray,
+                     encoded: np.ndarray = None) -> None:
+        """ Gives the recorder the camera frame and, for the ball and each
+            robot, its measurement in this frame and its filters states """
+        detections = np.full((NUM_ROWS, 3), np.nan)
+        kalman = np.zeros((NUM_ROWS, 9))
+        rows = [0] + [1 + k for k in range(self.num_yellow_robots)] + \
+               [6 + k for k in range(self.num_blue_robots)]
+        things = [self.ball] + self.yellow_team + self.blue_team
+
+        for i, (row, thing) in enumerate(zip(rows, things)):
+            if thing.measured_pos is not None and thing.measured_pos[0] is not None:
+                detections[row, :2] = thing.measured_pos
+            if thing.measured_orientation is not None:
+                detections[row, 2] = thing.measured_orientation
+            thing.measured_pos = thing.measured_orientation = None
+
+            if self.tracker is not None:
+                kalman[row, :6] = self.tracker.state[i]
+                kalman[row, 6:] = self.tracker.angular_state[i]
+            else:
+                kalman[row, :6] = thing.kalman.statePost.ravel()
+                kalman[row, 6:] = thing.angular_kalman.statePost.ravel()
+
+        recorder.record(raw_image, self.frame_timestamp, self.things_state,
+                        detections, kalman, encoded)
 
     def unpack_things_to_lists(self, things, positions_list, orientations_list):
         """ Auxiliary  function created to not duplify code in the send_message
@@ -316,31 +768,44 @@ class Vision:
                 positions_list[id] = thing.pos
                 orientations_list[id] = thing.orientation
 
+    def export_tracker_state(self) -> None:
+        """ Writes the batched tracker outputs straight into the state buffer,
+            the same way unpack_things_to_lists does for the Things """
+        tracker = self.tracker
+        exported = tracker.ids >= 0
+        self._state_pos[self._pos_base[exported] + tracker.ids[exported]] = tracker.pos[exported]
+
+        # The ball has no orientation
+        exported &= self._has_orientation
+        self._state_orientation[self._orientation_base[exported] + tracker.ids[exported]] = \
+            tracker.orientation[exported]
+
     def send_message(self, ball: bool = False,
                      yellow_team: bool = False,
                      blue_team: bool = False) -> None:
         """ This function will return the message in the right format to be
             published in the ROS vision bus """
 
-        if ball:
-            self.unpack_things_to_lists([self.ball], self.ball_pos, [[]])
+        if self.tracker is not None:
+            self.export_tracker_state()
+        else:
+            if ball:
+                self.unpack_things_to_lists([self.ball], self.ball_pos, [[]])
 
-        if yellow_team:
-            self.unpack_things_to_lists(self.yellow_team, self.yellow_team_pos,
-                                        self.yellow_team_orientation)
+            if yellow_team:
+                self.unpack_things_to_lists(self.yellow_team, self.yellow_team_pos,
+                                            self.yellow_team_orientation)
 
-        if blue_team:
-            self.unpack_things_to_lists(self.blue_team, self.blue_team_pos,
-                                        self.blue_team_orientation)
+            if blue_team:
+                self.unpack_things_to_lists(self.blue_team, self.blue_team_pos,
+                                            self.blue_team_orientation)
 
-        self.mercury.publish(self.ball_pos[0], self.yellow_team_pos,
-                             self.yellow_team_orientation, self.blue_team_pos,
-                             self.blue_team_orientation, self.fps)
+        self.things_state["vision_fps"] = self.fps
+        if self.mercury is not None:
+            self.mercury.publish_state(self.things_state, self.frame_timestamp)
 
 
 if __name__ == "__main__":
-    from threading import Thread
-
     num_yellow_robots = 1
     num_blue_robots = 1
     home_tag = "aruco"
@@ -364,10 +829,9 @@ if __name__ == "__main__":
     show = False
 
     while True:
-        arena = v.arena_image
         key = cv2.waitKey(1) & 0xFF
         if show:
-            cv2.imshow('vision', cv2.cvtColor(arena, cv2.COLOR_HSV2BGR))
+            cv2.imshow('vision', v.get_bgr_arena_image())
             cv2.imshow('segs', np.hstack([v.blue_seg, v.yellow_seg, v.ball_seg]))
         if key == ord('q'):  # exit
             v.pause()
@@ -0,0 +1,232 @@
+#!/usr/bin/python3
+""" Runs the Vision over rendered or recorded frames, without the camera, and
+    reports the FPS and the cost of each stage of the frame loop for each
+    seekers configuration. With the synthetic arena it also reports the
+    distance between the published positions and the ground truth.
+
+    Like the vision node it needs a running roscore, and it must be run from
+    the src directory:
+
+        python3 -m vision_module.vision_benchmark --frames 600
+        python3 -m vision_module.vision_benchmark --replay ~/match_frames --seekers kmeans
+        python3 -m vision_module.vision_benchmark --replay ~/match.vlog --seekers kmeans
+
+    With --capture_process the frames are rendered or replayed in a capture
+    process and handed over through shared memory, as with the
+    --capture_process mode of the vision node. The ground truth stays in the
+    capture process, so there are no errors in this mode.
+
+    With --record each seekers configuration is recorded to a vision log,
+    named after the given path and the configuration, and its size, the
+    frames dropped by the recorder and the time to seek frames in it are
+    reported.
+"""
+from argparse import ArgumentParser
+from functools import partial
+import math
+import os
+import pickle
+import time
+import numpy as np
+
+from vision_module.vision import Vision
+from vision_module.camera_module.frame_source import ReplaySource
+from vision_module.camera_module.synthetic_arena import SyntheticArenaSource
+from vision_module.camera_module.shared_frames import CaptureProcess
+from vision_module.vision_utils.recorder import VisionLog, LogSource, LOG_EXTENSION
+from vision_module.seekers.things_seeker import ARUCO_TAGS
+from utils.json_handler import JsonHandler
+
+ARENA_PARAMS = "parameters/ARENA.json"
+COLORS_PARAMS = "parameters/COLORS.bin"
+GAME_PARAMS = "parameters/game.json"
+
+SEEKERS_CONFIGS = {"kmeans": {"yellow": "kmeans", "blue": "kmeans"},
+                   "color": {"yellow": "color", "blue": "color"},
+                   "aruco": {"yellow": "aruco", "blue": "kmeans"}}
+
+
+def get_errors(vision: Vision, ground_truth: dict) -> tuple:
+    """ Returns the position errors, in cm, and the orientation errors, in
+        radians, of the published state. The seekers ids do not always follow
+        the synthetic slots, so each true robot is compared with the closest
+        published robot of its team """
+    state = vision.things_state
+    pos_errors = [np.linalg.norm(state["ball_pos"] - ground_truth["ball"])]
+    orientation_errors = []
+
+    for team, num_robots in (("yellow", vision.num_yellow_robots), ("blue", vision.num_blue_robots)):
+        positions = state[team + "_team_pos"][:num_robots]
+        orientations = state[team + "_team_orientation"][:num_robots]
+        for pos, orientation in ground_truth[team]:
+            distances = np.linalg.norm(positions - pos, axis=1)
+            closest = np.argmin(distances)
+            pos_errors.append(distances[closest])
+
+            if vision.seekers[team] != "kmeans":
+                diff = orientations[closest] - orientation
+                orientation_errors.append(abs(math.atan2(math.sin(diff), math.cos(diff))))
+
+    return pos_errors, orientation_errors
+
+
+def run_benchmark(vision: Vision, source, num_frames: int, warmup: int = 30) -> dict:
+    """ Feeds the vision with the source frames and returns the results. The
+        first frames are not measured, the filters and seekers are still
+        converging there """
+    pos_errors, orientation_errors, ball_errors = [], [], []
+    processed = 0
+
+    t0 = None
+    while processed < warmup + num_frames:
+        if processed == warmup:
+            vision.latency.reset()
+            t0 = time.time()
+
+        frame = vision.preprocess()
+        if frame is None:
+            continue
+        vision.process_frame(frame)
+        processed += 1
+
+        if processed > warmup and isinstance(source, SyntheticArenaSource):
+            errors = get_errors(vision, source.ground_truth)
+            pos_errors.extend(errors[0])
+            orientation_errors.extend(errors[1])
+            ball_errors.append(vision.things_state["ball_pos"] - source.ground_truth["ball"])
+
+    elapsed = time.time() - t0 if t0 is not None else 0.
+    measured = max(processed - warmup, 0)
+
+    # The jitter is the part of the ball error that changes from a frame to
+    # the next, the lag of the filter is in the mean error
+    ball_errors = np.array(ball_errors).reshape(-1, 2)
+    ball_jitter = None
+    if ball_errors.shape[0] > 1:
+        ball_jitter = math.sqrt(np.nanmean((np.diff(ball_errors, axis=0) ** 2).sum(axis=1)))
+
+    return {"frames": measured,
+            "fps": measured / elapsed if elapsed > 0 else 0.,
+            "latency": vision.latency.report(),
+            "pos_error": np.mean(pos_errors) if pos_errors else None,
+            "orientation_error": np.mean(orientation_errors) if orientation_errors else None,
+            "ball_error": np.nanmean(np.linalg.norm(ball_errors, axis=1)) if ball_errors.size else None,
+            "ball_jitter": ball_jitter}
+
+
+def print_log_report(path: str, dropped: int) -> None:
+    """ Reports the size of a vision log and the time to get its frames
+        at random indexes and times """
+    log = VisionLog(path)
+    n = len(log)
+    rng = np.random.default_rng(0)
+    indexes = rng.integers(0, n, 200)
+    times = rng.uniform(log.record(0)["timestamp"], log.record(n - 1)["timestamp"], 200)
+
+    t0 = time.perf_counter()
+    for index in indexes:
+        log.frame(int(index))
+    t1 = time.perf_counter()
+    for t in times:
+        log.frame(log.index_at(t))
+    t2 = time.perf_counter()
+
+    print("log: %s, %d frames, %.1f MB, %d dropped" % (path, n, os.path.getsize(path) / 2 ** 20, dropped))
+    print("log seek: %.3f ms by index, %.3f ms by time" % (1000 * (t1 - t0) / len(indexes),
+                                                           1000 * (t2 - t1) / len(times)))
+    log.close()
+
+
+def main():
+    parser = ArgumentParser(description="Vision benchmark")
+    parser.add_argument("--frames", type=int, default=600, help="number of measured frames")
+    parser.add_argument("--seekers", nargs="+", choices=SEEKERS_CONFIGS.keys(),
+                        default=list(SEEKERS_CONFIGS.keys()), help="seekers configurations")
+    parser.add_argument("--method", default="color_segmentation",
+                        choices=["color_segmentation", "lut_segmentation"])
+    parser.add_argument("--yellow", type=int, default=4, help="number of yellow robots")
+    parser.add_argument("--blue", type=int, default=3, help="number of blue robots")
+    parser.add_argument("--replay", default="", help="video file or images directory to replay "
+                                                    "instead of the synthetic arena")
+    parser.add_argument("--realtime", action="store_true", help="replays at the original frame rate")
+    parser.add_argument("--fused_remap", action="store_true")
+    parser.add_argument("--parallel_seekers", action="store_true")
+    parser.add_argument("--color_tracking", action="store_true")
+    parser.add_argument("--batched_tracking", action="store_true")
+    parser.add_argument("--aruco_pose_3d", action="store_true")
+    parser.add_argument("--aruco_tracking", action="store_true")
+    parser.add_argument("--adaptive_colors", action="store_true")
+    parser.add_argument("--capture_process", action="store_true",
+                        help="renders or replays the frames in a capture process")
+    parser.add_argument("--detection_scale", type=int, default=1,
+                        help="downscale of the detection pyramid, 1 turns it off")
+    parser.add_argument("--ball_reacquisition", action="store_true")
+    parser.add_argument("--record", default="", help="vision log path, without the extension")
+    parser.add_argument("--record_format", choices=("raw", "jpeg"), default="raw")
+    args = parser.parse_args()
+
+    arena_params = JsonHandler.read(ARENA_PARAMS)
+    aruco_tags = JsonHandler.read(GAME_PARAMS).get("aruco_tags", ARUCO_TAGS)
+    with open(COLORS_PARAMS, "rb") as fp:
+        colors_thresholds = pickle.load(fp)
+
+    for name in args.seekers:
+        seekers = SEEKERS_CONFIGS[name]
+        if args.replay.endswith(LOG_EXTENSION):
+            make_source = partial(LogSource, args.replay, realtime=args.realtime, loop=True)
+        elif args.replay:
+            make_source = partial(ReplaySource, args.replay, realtime=args.realtime, loop=True)
+        else:
+            make_source = partial(SyntheticArenaSource, arena_params, colors_thresholds, seekers,
+                                  args.yellow, args.blue, aruco_tags=aruco_tags)
+
+        capture = None
+        if args.capture_process:
+            capture = CaptureProcess(make_source)
+            capture.start()
+            source = capture.get_source()
+        else:
+            source = make_source()
+
+        vision = Vision(source, args.blue, args.yellow, ARENA_PARAMS, COLORS_PARAMS,
+                        method=args.method, fused_remap=args.fused_remap,
+                        parallel_seekers=args.parallel_seekers,
+                        color_tracking=args.color_tracking,
+                        batched_tracking=args.batched_tracking, seekers=seekers,
+                        detection_scale=args.detection_scale,
+                        aruco_pose_3d=args.aruco_pose_3d,
+                        aruco_tracking=args.aruco_tracking,
+                        adaptive_colors=args.adaptive_colors,
+                        ball_reacquisition=args.ball_reacquisition)
+        vision.last_time = time.time()
+
+        log_path = recorder = None
+        if args.record:
+            log_path = "%s_%s%s" % (args.record, name, LOG_EXTENSION)
+            vision.start_recording(log_path, args.record_format)
+            recorder = vision.recorder
+
+        results = run_benchmark(vision, source, args.frames)
+        vision.stop_recording()
+
+        print("=== seekers: %s, method: %s ===" % (name, args.method))
+        print("frames: %d, fps: %.1f" % (results["frames"], results["fps"]))
+        if results["pos_error"] is not None:
+            print("mean position error: %.2f cm" % results["pos_error"])
+        if results["orientation_error"] is not None:
+            print("mean orientation error: %.3f rad" % results["orientation_error"])
+        if results["ball_error"] is not None:
+            print("ball error: %.3f cm, jitter: %.3f cm" % (results["ball_error"], results["ball_jitter"]))
+        if log_path is not None:
+            print_log_report(log_path, recorder.dropped)
+        print("stage latencies (ms)")
+        print(results["latency"])
+        print()
+
+        source.release()
+        if capture is not None:
+            capture.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,15 @@
 #!/usr/bin/python3
 import rospy
 import sys
+import os
 import cv2
-from time import time
+from functools import partial
+from time import time, strftime
 from enum import Enum
 from threading import Thread
 
 from vision_module.camera_module.camera import Camera
+from vision_module.camera_module.shared_frames import CaptureProcess
 from vision_module.vision import Vision
 from ROS.ros_vision_publisher import RosVisionService
 from utils.model import Model
@@ -20,6 +23,8 @@ class VisionOperations(Enum):
     SHOW = 1
     CROPPER = 2
     COLOR_CALIBRATION = 3
+    LATENCY_REPORT = 4
+    RECORD = 5
 
 
 class VisionNode:
@@ -27,9 +32,11 @@ class VisionNode:
     A node for spinning the Vision
     """
 
-    def __init__(self, vision_owner: str = 'Player_One'):
+    def __init__(self, vision_owner: str = 'Player_One', capture_process: bool = False):
         """
         :param color: int
+        :param capture_process: captures and decodes the frames in another
+            process, which hands them over through shared memory
         """
         self.team_colors = ['blue', 'yellow']
         self.yellow_robots = 4
@@ -48,7 +55,14 @@ class VisionNode:
             model = Model()
             _, device = CameraLoader(model.game_opt['camera']).get_index()
 
-        self.camera = Camera(device, "parameters/CAMERA_ELP-USBFHD01M-SFV.bin", threading=False)
+        self.capture = None
+        if capture_process:
+            self.capture = CaptureProcess(partial(Camera, device, "parameters/CAMERA_ELP-USBFHD01M-SFV.bin",
+                                                  threading=False))
+            self.capture.start()
+            self.camera = self.capture.get_source()
+        else:
+            self.camera = Camera(device, "parameters/CAMERA_ELP-USBFHD01M-SFV.bin", threading=False)
 
         self.vision = Vision(self.camera, self.blue_robots, self.yellow_robots,
                              arena_params, colors_params, method="color_segmentation", vision_owner=vision_owner)
@@ -74,17 +88,21 @@ class VisionNode:
 
 if __name__ == "__main__":
 
+    capture_process = "--capture_process" in sys.argv
+    if capture_process:
+        sys.argv.remove("--capture_process")
+
     try:
         owner_name = sys.argv[2]
     except IndexError:
         owner_name = 1
 
-    vision_node = VisionNode(owner_name)
+    vision_node = VisionNode(owner_name, capture_process)
     rate = rospy.Rate(1)  # 1hz
 
     while not rospy.is_shutdown():
         if vision_node.show:
-            cv2.imshow('vision', cv2.cvtColor(vision_node.vision.arena_image, cv2.COLOR_HSV2BGR))
+            cv2.imshow('vision', vision_node.vision.get_bgr_arena_image())
             key = cv2.waitKey(1) & 0xFF
             if key == ord('q'):
                 rate = rospy.Rate(1)  # 1hz
@@ -113,8 +131,29 @@ if __name__ == "__main__":
                     vision_node.vision.load_colors_params()
                     vision_node.vision.toggle_calibration(False)
 
+            elif vision_node.state_changed == VisionOperations.LATENCY_REPORT.value:
+                # Logs the latency of each stage since the last report, in ms
+                rospy.loginfo("Vision latency (ms)\n" + vision_node.vision.latency.report())
+                vision_node.vision.latency.reset()
+
+            elif vision_node.state_changed == VisionOperations.RECORD.value:
+                # Starts or stops recording the match to a new vision log. The
+                # raw frames would take about 100 MB/s
+                if vision_node.vision.recorder is None:
+                    os.makedirs("logs", exist_ok=True)
+                    log_path = os.path.join("logs", strftime("vision_%Y%m%d_%H%M%S.vlog"))
+                    vision_node.vision.start_recording(log_path, "jpeg")
+                    rospy.loginfo("Vision recording to " + log_path)
+                else:
+                    dropped = vision_node.vision.recorder.dropped
+                    vision_node.vision.stop_recording()
+                    rospy.loginfo("Vision recording stopped, %d frames dropped" % dropped)
+
             vision_node.state_changed = 0
         rate.sleep()
 
     vision_node.vision.stop()
+    if vision_node.capture is not None:
+        vision_node.thread.join(timeout=1.0)
+        vision_node.capture.stop()
     cv2.destroyAllWindows()
@@ -0,0 +1,74 @@
+from typing import List, NamedTuple, Tuple
+import cv2
+import numpy as np
+
+
+class Blobs(NamedTuple):
+    """ The connected blobs of a binary image, one row per blob. The centroids
+        are (x, y) floats and the boxes are (x, y, width, height) ints, in the
+        pixels of the image """
+    areas: np.ndarray
+    centroids: np.ndarray
+    boxes: np.ndarray
+
+    def __len__(self) -> int:
+        return self.areas.shape[0]
+
+    def select(self, selection) -> "Blobs":
+        """ Returns the blobs picked by a boolean mask or an index array """
+        return Blobs(self.areas[selection], self.centroids[selection], self.boxes[selection])
+
+    def by_area(self) -> "Blobs":
+        """ Returns the blobs sorted from the largest to the smallest """
+        return self.select(np.argsort(-self.areas, kind="stable"))
+
+    def radii(self) -> np.ndarray:
+        """ Half of the larger side of the bounding box of each blob, which
+            is the radius of the round blobs """
+        return np.maximum(self.boxes[:, 2], self.boxes[:, 3]) / 2.
+
+
+EMPTY_BLOBS = Blobs(np.empty(0, np.int32), np.empty((0, 2)), np.empty((0, 4), np.int32))
+
+
+def get_blobs(binary_img: np.ndarray, min_area: int = 1) -> Blobs:
+    """ Finds all the 8-connected blobs of the binary image in a single pass.
+        The blobs smaller than min_area pixels are dropped """
+    # The labeling also accumulates the stats of the background, so it only
+    # runs over the bounding box of the set pixels
+    x, y, w, h = cv2.boundingRect(binary_img)
+    if w == 0 or h == 0:
+        return EMPTY_BLOBS
+
+    # Each 2x2 block of pixels holds at most one 8-connected blob, and the
+    # 16 bits labels are faster when they are enough
+    ltype = cv2.CV_16U if ((w + 1) // 2) * ((h + 1) // 2) < 2 ** 16 else cv2.CV_32S
+    n, _, stats, centroids = cv2.connectedComponentsWithStats(binary_img[y:y + h, x:x + w],
+                                                              connectivity=8, ltype=ltype)
+
+    # The label 0 is the background
+    areas = stats[1:n, cv2.CC_STAT_AREA]
+    boxes = stats[1:n, :4]
+    boxes[:, :2] += (x, y)
+    blobs = Blobs(areas, centroids[1:n] + (x, y), boxes)
+    if min_area > 1:
+        blobs = blobs.select(areas >= min_area)
+
+    return blobs
+
+
+def get_patches_blobs(patches: List[Tuple[np.ndarray, np.ndarray]]) -> Tuple[Blobs, np.ndarray]:
+    """ Finds the blobs of the (binary patch, offset) pairs of the detection
+        pyramid, in the pixels of the full image. Also returns the index of
+        the patch of each blob """
+    all_blobs = [get_blobs(patch) for patch, _ in patches]
+    if not all_blobs:
+        return EMPTY_BLOBS, np.empty(0, np.intp)
+
+    offsets = [offset for _, offset in patches]
+    blobs = Blobs(np.concatenate([blobs.areas for blobs in all_blobs]),
+                  np.concatenate([blobs.centroids + offset for blobs, offset in zip(all_blobs, offsets)]),
+                  np.concatenate([blobs.boxes + np.append(offset, (0, 0)).astype(blobs.boxes.dtype)
+                                  for blobs, offset in zip(all_blobs, offsets)]))
+    owners = np.repeat(np.arange(len(all_blobs)), [len(blobs) for blobs in all_blobs])
+    return blobs, owners
@@ -0,0 +1,158 @@
+from typing import Callable, Dict, List
+from threading import Thread
+import time
+import cv2
+import numpy as np
+
+from vision_module.vision_utils.frame_queue import FrameQueue
+
+# Upper limits of the OpenCV HSV channels for 8 bits images
+HSV_MAX = np.array([179, 255, 255])
+
+
+class ColorAdapter:
+    """ Follows the lighting drift along a match by adjusting the HSV
+        thresholds of some colors with the pixels around the things that were
+        found in the last frames.
+
+        The frame loop only cuts small patches around the things and hands
+        them over with submit. A background thread picks, in each patch, the
+        pixels a bit beyond the current thresholds of the thing color, and
+        every period moves each threshold towards the robust range of these
+        pixels, by at most max_step. The new thresholds go to on_update as a
+        new dict, the old one is never changed in place """
+
+    def __init__(self, thresholds: Dict[str, dict], on_update: Callable[[Dict[str, dict]], None],
+                 colors: List[str] = None, patch_radius: int = 6,
+                 slack=(4, 24, 24), margin=(2, 8, 8), max_step: int = 2,
+                 min_pixels: int = 200, max_pixels: int = 20000, period: float = 2.0):
+        """ colors are the adapted colors, all the colors of the thresholds
+            when not given. slack is how far beyond the thresholds a pixel may be to be
+            sampled, and margin is how far beyond the 5th and 95th
+            percentiles of the samples the thresholds are placed, both for
+            each HSV channel. The hue ranges are narrow and close to each
+            other, so they get the smallest values """
+        self.thresholds = thresholds
+        self.on_update = on_update
+        self.colors = list(thresholds) if colors is None else [c for c in colors if c in thresholds]
+        self.patch_radius = patch_radius
+        self.slack = np.array(slack)
+        self.margin = np.array(margin)
+        self.max_step = max_step
+        self.min_pixels = min_pixels
+        self.max_pixels = max_pixels
+        self.period = period
+
+        self.updates = 0
+
+        self._patches = FrameQueue(maxlen=8)
+        self._samples = {c: [] for c in self.colors}
+        self._num_samples = {c: 0 for c in self.colors}
+        self._running = False
+        self._thread = None
+
+    def start(self) -> None:
+        self._running = True
+        self._thread = Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout=1.0)
+
+    def reset(self, thresholds: Dict[str, dict]) -> None:
+        """ Restarts from new thresholds, after a manual calibration """
+        self.thresholds = thresholds
+        self._patches.clear()
+        self._samples = {c: [] for c in self.colors}
+        self._num_samples = {c: 0 for c in self.colors}
+
+    def submit(self, img: np.ndarray, centers: Dict[str, List[np.ndarray]],
+               is_hsv: bool = True) -> None:
+        """ Called by the frame loop with the pixel centers of the things of
+            each color found in the image. Only copies the patches around
+            them, the image may be overwritten after this returns """
+        r = self.patch_radius
+        h, w = img.shape[:2]
+
+        patches = {}
+        for color, points in centers.items():
+            if color not in self._samples:
+                continue
+            for x, y in points:
+                x, y = int(x), int(y)
+                if r <= x < w - r and r <= y < h - r:
+                    patches.setdefault(color, []).append(img[y - r:y + r + 1, x - r:x + r + 1].copy())
+
+        if patches:
+            self._patches.put((patches, is_hsv))
+
+    def _loop(self) -> None:
+        last_adaptation = time.time()
+        while self._running:
+            item = self._patches.get(timeout=0.1)
+            if item is not None:
+                self.accumulate(*item)
+
+            if time.time() - last_adaptation >= self.period:
+                last_adaptation = time.time()
+                self.adapt()
+
+    def accumulate(self, patches: Dict[str, List[np.ndarray]], is_hsv: bool) -> None:
+        """ Keeps the pixels of the patches that are near the thresholds of
+            their color. Only the newest max_pixels of each color are kept """
+        for color, color_patches in patches.items():
+            thresholds = self.thresholds[color]
+            low = np.clip(thresholds["min"].astype(int) - self.slack, 0, HSV_MAX).astype(np.uint8)
+            high = np.clip(thresholds["max"].astype(int) + self.slack, 0, HSV_MAX).astype(np.uint8)
+
+            for patch in color_patches:
+                hsv = patch if is_hsv else cv2.cvtColor(patch, cv2.COLOR_BGR2HSV)
+                pixels = hsv[cv2.inRange(hsv, low, high) != 0]
+                if pixels.size:
+                    self._samples[color].append(pixels)
+                    self._num_samples[color] += pixels.shape[0]
+
+            while self._num_samples[color] > self.max_pixels:
+                self._num_samples[color] -= self._samples[color].pop(0).shape[0]
+
+    def adapt(self) -> bool:
+        """ Moves the thresholds of the colors with enough samples and clears
+            the samples. Returns whether any threshold changed """
+        new_thresholds = None
+        for color in self.colors:
+            if self._num_samples[color] < self.min_pixels:
+                continue
+
+            pixels = np.concatenate(self._samples[color])
+            self._samples[color] = []
+            self._num_samples[color] = 0
+
+            low, high = np.percentile(pixels, (5, 95), axis=0)
+            current_min = self.thresholds[color]["min"].astype(int)
+            current_max = self.thresholds[color]["max"].astype(int)
+
+            new_min = current_min + np.clip(np.round(low - self.margin) - current_min,
+                                            -self.max_step, self.max_step).astype(int)
+            new_max = current_max + np.clip(np.round(high + self.margin) - current_max,
+                                            -self.max_step, self.max_step).astype(int)
+            new_min = np.clip(new_min, 0, HSV_MAX)
+            new_max = np.clip(np.maximum(new_max, new_min), 0, HSV_MAX)
+
+            if np.array_equal(new_min, current_min) and np.array_equal(new_max, current_max):
+                continue
+
+            if new_thresholds is None:
+                new_thresholds = dict(self.thresholds)
+            dtype = self.thresholds[color]["min"].dtype
+            new_thresholds[color] = dict(self.thresholds[color],
+                                         min=new_min.astype(dtype), max=new_max.astype(dtype))
+
+        if new_thresholds is None:
+            return False
+
+        self.thresholds = new_thresholds
+        self.updates += 1
+        self.on_update(new_thresholds)
+        return True
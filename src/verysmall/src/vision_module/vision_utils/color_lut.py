@@ -0,0 +1,107 @@
+from typing import Dict, List
+import cv2
+import numpy as np
+
+BACKGROUND = 0
+
+# When the HSV thresholds of two colors overlap the pixel gets the label of
+# the first color in this list
+PRIORITY = ["orange", "yellow", "blue"]
+
+
+class ColorLUT:
+    """ This class builds a lookup table that maps every BGR value straight to
+        a color label, using the HSV thresholds from COLORS.bin. With it the
+        whole arena image is labeled in one pass, without the HSV conversion
+        and without one inRange per color """
+
+    def __init__(self, thresholds: Dict[str, dict] = None):
+        self.colors = []
+        self.labels = {}
+
+        # One entry for each of the 2^24 BGR values, indexed by b | g << 8 | r << 16
+        self._lut = np.zeros(1 << 24, np.uint8)
+
+        # Buffers reused between frames, allocated on the first frame
+        self._packed = None
+        self._label_image = None
+        self._masks = {}
+
+        if thresholds is not None:
+            self.build(thresholds)
+
+    def build(self, thresholds: Dict[str, dict]) -> None:
+        """ Fills the lookup table with the labels of the thresholds dict, which
+            has the same format of the COLORS.bin file """
+        primary = [c for c in PRIORITY if c in thresholds]
+        secondary = sorted(set(thresholds.keys()) - set(primary))
+        self.colors = primary + secondary
+        self.labels = {c: i + 1 for i, c in enumerate(self.colors)}
+
+        lut = np.zeros(1 << 24, np.uint8)
+
+        # All the (g, r) combinations, the blue value is swept one plane a time
+        # so the HSV conversion never needs the whole 2^24 colors cube in memory
+        g, r = np.meshgrid(np.arange(256, dtype=np.uint8), np.arange(256, dtype=np.uint8))
+        plane = np.empty((256, 256, 3), np.uint8)
+        plane[..., 1] = g
+        plane[..., 2] = r
+
+        for b in range(256):
+            plane[..., 0] = b
+            hsv = cv2.cvtColor(plane, cv2.COLOR_BGR2HSV)
+            labels = np.zeros((256, 256), np.uint8)
+
+            # Reversed so the colors with higher priority are written last
+            for color in reversed(self.colors):
+                in_range = cv2.inRange(hsv, np.uint8(thresholds[color]["min"]),
+                                       np.uint8(thresholds[color]["max"]))
+                labels[in_range != 0] = self.labels[color]
+
+            # plane[i, j] has r = i and g = j, so the flattened plane is already
+            # ordered by r << 8 | g
+            lut[b::256] = labels.reshape(-1)
+
+        # Swaps the reference at once, a frame being labeled keeps the old table
+        self._lut = lut
+
+    def label(self, img: np.ndarray) -> np.ndarray:
+        """ Returns a single channel image where each pixel has the label of its
+            color, or BACKGROUND """
+        h, w = img.shape[:2]
+        if self._packed is None or self._packed.shape[:2] != (h, w):
+            self._packed = np.zeros((h, w, 4), np.uint8)
+            self._label_image = np.empty((h, w), np.uint8)
+            self._masks = {}
+
+        # The alpha byte stays zero, so each pixel read as a little endian
+        # uint32 is exactly its index in the table
+        cv2.mixChannels([img], [self._packed], [0, 0, 1, 1, 2, 2])
+        np.take(self._lut, self._packed.view(np.uint32)[..., 0], out=self._label_image)
+
+        return self._label_image
+
+    def label_patch(self, img: np.ndarray) -> np.ndarray:
+        """ Same as label, but with a new output image. Used for the small
+            patches, whose sizes change all the time """
+        packed = np.zeros(img.shape[:2] + (4,), np.uint8)
+        cv2.mixChannels([img], [packed], [0, 0, 1, 1, 2, 2])
+        return np.take(self._lut, packed.view(np.uint32)[..., 0])
+
+    def mask(self, color: str) -> np.ndarray:
+        """ Returns the binary mask of a color from the last labeled image """
+        if color not in self._masks:
+            self._masks[color] = np.empty_like(self._label_image)
+
+        return cv2.compare(self._label_image, self.labels[color], cv2.CMP_EQ,
+                           dst=self._masks[color])
+
+    def bounds(self, color: str):
+        """ Returns the (min, max) pair that selects a color with inRange
+            over the label image, so the seekers can work on it the same way
+            they work on the HSV image """
+        label = np.uint8([self.labels[color]])
+        return label, label
+
+    def secondary_bounds(self) -> List[tuple]:
+        return [self.bounds(c) for c in self.colors if c not in PRIORITY]
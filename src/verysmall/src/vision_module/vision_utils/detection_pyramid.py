@@ -0,0 +1,77 @@
+from typing import List, Tuple
+import cv2
+import numpy as np
+
+from vision_module.vision_utils.blobs import get_blobs
+
+
+class DetectionPyramid:
+    """ Finds where the things are in a downscaled copy of the arena image, so
+        the full resolution work is done only in small patches around them.
+        The copy is taken with the nearest neighbour, which keeps the original
+        colors of the pixels, so the same color thresholds work on both
+        resolutions. Any blob wider than the scale shows up in the copy """
+
+    def __init__(self, scale: int = 2, margin: int = 24):
+        """ margin is how far, in full resolution pixels, the patch goes
+            beyond the blobs found in the downscaled image """
+        self.scale = scale
+        self.margin = margin
+
+        self.arena_mask = None
+        self.small_mask = None
+        self.shape = None
+        self.small_size = None
+
+    def set_arena_mask(self, arena_mask: np.ndarray) -> None:
+        """ The arena mask replaces the set_dark_border of the full image. It
+            is applied in the downscaled image and in each patch """
+        self.arena_mask = arena_mask
+        self.shape = arena_mask.shape[:2]
+        h, w = self.shape
+        self.small_size = (-(-w // self.scale), -(-h // self.scale))
+        self.small_mask = cv2.resize(arena_mask, self.small_size, interpolation=cv2.INTER_NEAREST)
+
+    def downscale(self, img: np.ndarray) -> np.ndarray:
+        small = cv2.resize(img, self.small_size, interpolation=cv2.INTER_NEAREST)
+        return cv2.bitwise_and(small, small, mask=self.small_mask)
+
+    def get_patch(self, img: np.ndarray, region: Tuple[slice, slice]) -> np.ndarray:
+        patch = img[region]
+        return cv2.bitwise_and(patch, patch, mask=self.arena_mask[region])
+
+    def get_regions(self, coarse_mask: np.ndarray) -> List[Tuple[slice, slice]]:
+        """ Returns the full resolution (rows, cols) slices of the patches
+            around the blobs of the downscaled binary image. The patches that
+            overlap are merged, so no pixel is segmented twice """
+        h, w = self.shape
+        s = self.scale
+        m = self.margin
+        x, y, bw, bh = get_blobs(coarse_mask).boxes.T
+        boxes = np.stack([np.maximum(x * s - m, 0),
+                          np.maximum(y * s - m, 0),
+                          np.minimum((x + bw) * s + m, w),
+                          np.minimum((y + bh) * s + m, h)], axis=1).tolist()
+
+        return [(slice(y0, y1), slice(x0, x1)) for x0, y0, x1, y1 in merge_boxes(boxes)]
+
+
+def merge_boxes(boxes: List[list]) -> List[list]:
+    """ Merges the overlapping [x0, y0, x1, y1] boxes until none overlaps """
+    merged = []
+    for box in boxes:
+        # A grown box may now overlap boxes merged before, so it is taken out
+        # and checked against all of them again
+        i = 0
+        while i < len(merged):
+            other = merged[i]
+            if box[0] < other[2] and other[0] < box[2] and box[1] < other[3] and other[1] < box[3]:
+                box = [min(box[0], other[0]), min(box[1], other[1]),
+                       max(box[2], other[2]), max(box[3], other[3])]
+                del merged[i]
+                i = 0
+            else:
+                i += 1
+        merged.append(box)
+
+    return merged
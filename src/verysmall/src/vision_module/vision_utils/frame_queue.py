@@ -0,0 +1,37 @@
+from collections import deque
+from threading import Condition
+
+
+class FrameQueue:
+    """ Bounded queue used to hand frames from one vision stage to the next.
+        When it is full the oldest frame is dropped, so a slow consumer always
+        gets the newest frame instead of accumulating latency """
+
+    def __init__(self, maxlen: int = 1):
+        self.buffer = deque(maxlen=maxlen)
+        self.dropped = 0
+        self._condition = Condition()
+
+    def put(self, item) -> None:
+        with self._condition:
+            if len(self.buffer) == self.buffer.maxlen:
+                self.dropped += 1
+            self.buffer.append(item)
+            self._condition.notify()
+
+    def get(self, timeout: float = None):
+        """ Returns the oldest frame in the queue, or None if nothing arrives
+            before the timeout """
+        with self._condition:
+            if not self.buffer:
+                self._condition.wait(timeout)
+            if not self.buffer:
+                return None
+            return self.buffer.popleft()
+
+    def clear(self) -> None:
+        with self._condition:
+            self.buffer.clear()
+
+    def __len__(self) -> int:
+        return len(self.buffer)
@@ -106,6 +106,8 @@ if __name__ == '__main__':
         params = {}
         params['matrix_x'] = mapx
         params['matrix_y'] = mapy
+        # Fixed point copy of the maps, which the camera remaps with
+        params['fixed_map1'], params['fixed_map2'] = cv2.convertMaps(mapx, mapy, cv2.CV_16SC2)
         params['cam_matrix'] = mtx
         params['dist_vector'] = dist
         params['default_frame_width'] = args.frame_width
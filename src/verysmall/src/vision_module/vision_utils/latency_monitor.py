@@ -0,0 +1,70 @@
+from typing import Dict
+import numpy as np
+
+# Stages of the vision frame loop, in order. The total is the time between
+# the frame grab and the end of its publication
+STAGES = ("capture", "warp", "segment", "seek", "track", "publish", "total")
+
+
+class LatencyMonitor:
+    """ Keeps one latency histogram per stage of the vision loop. The bins
+        have a fixed width, so recording a sample is just an increment and
+        the memory does not grow with the number of frames. Samples longer
+        than the last bin are counted in it """
+
+    def __init__(self, stages=STAGES, bin_width: float = 0.0005, max_latency: float = 0.1):
+        self.stages = stages
+        self.bin_width = bin_width
+        self.num_bins = int(round(max_latency / bin_width)) + 1
+
+        self.histograms = {s: np.zeros(self.num_bins, np.int64) for s in stages}
+        self.totals = {s: 0. for s in stages}
+        self.maximums = {s: 0. for s in stages}
+
+    def record(self, stage: str, seconds: float) -> None:
+        # Each stage is recorded by a single thread, so no lock is needed
+        # even in the pipelined mode. A grab timestamp slightly ahead of the
+        # clock gives a negative time, counted in the first bin
+        index = max(0, min(int(seconds / self.bin_width), self.num_bins - 1))
+        self.histograms[stage][index] += 1
+        self.totals[stage] += seconds
+        if seconds > self.maximums[stage]:
+            self.maximums[stage] = seconds
+
+    def percentile(self, stage: str, q: float) -> float:
+        """ Returns the q-th percentile of a stage in seconds, with the
+            resolution of the bins """
+        histogram = self.histograms[stage]
+        count = histogram.sum()
+        if count == 0:
+            return 0.
+
+        index = np.searchsorted(np.cumsum(histogram), q / 100. * count)
+        return min((index + 1) * self.bin_width, self.maximums[stage])
+
+    def summary(self) -> Dict[str, dict]:
+        """ Returns the count, mean, median, 90th and 99th percentiles and the
+            maximum of each stage, in milliseconds """
+        summary = {}
+        for stage in self.stages:
+            count = int(self.histograms[stage].sum())
+            summary[stage] = {"count": count,
+                              "mean": 1000. * self.totals[stage] / max(count, 1),
+                              "p50": 1000. * self.percentile(stage, 50),
+                              "p90": 1000. * self.percentile(stage, 90),
+                              "p99": 1000. * self.percentile(stage, 99),
+                              "max": 1000. * self.maximums[stage]}
+        return summary
+
+    def report(self) -> str:
+        lines = ["%-8s %7s %7s %7s %7s %7s %7s" % ("stage", "count", "mean", "p50", "p90", "p99", "max")]
+        for stage, s in self.summary().items():
+            lines.append("%-8s %7d %7.2f %7.2f %7.2f %7.2f %7.2f" %
+                         (stage, s["count"], s["mean"], s["p50"], s["p90"], s["p99"], s["max"]))
+        return "\n".join(lines)
+
+    def reset(self) -> None:
+        for stage in self.stages:
+            self.histograms[stage][:] = 0
+            self.totals[stage] = 0.
+            self.maximums[stage] = 0.
@@ -10,7 +10,10 @@ from utils.json_handler import JsonHandler
 
 class ParamsSetter:
 
-    def __init__(self, cam, params_file):
+    def __init__(self, cam, params_file, field_region=None):
+        """ field_region is the [x_min, y_min, x_max, y_max] rectangle of the
+            field, in centimeters, seen by a camera that does not see the
+            whole field. It is saved with the warp matrix """
         # modes definitions
         self.NO_MODE     = -1
         self.ADD_MODE    = 0
@@ -23,6 +26,7 @@ class ParamsSetter:
 
         self.cam = cam
         self.params_file = params_file
+        self.field_region = field_region
 
         self.value_min = None
         self.matrix_transform = None
@@ -210,6 +214,8 @@ class ParamsSetter:
             params['arena_size'] = self.arena_size
         if self.vertices_points != []:
             params['arena_vertices'] = self.vertices_points
+        if self.field_region is not None:
+            params['field_region'] = list(self.field_region)
         if not(self.value_min is None):
             params['value_min'] = self.value_min.tolist()
 
@@ -313,6 +319,12 @@ def makeArgParser() -> ArgumentParser:
                         type=str,
                         default="../../parameters/ARENA.json",
                         help="color params file to store the color thresholds")
+    parser.add_argument("--field_region",
+                        type=float,
+                        nargs=4,
+                        default=None,
+                        metavar=("X_MIN", "Y_MIN", "X_MAX", "Y_MAX"),
+                        help="part of the field seen by the camera, in cm, for the fused vision")
     return parser
 
 
@@ -321,5 +333,5 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
     cam = Camera(args.device, args.camera_params_file)
-    setter = ParamsSetter(cam, args.arena_params_file)
+    setter = ParamsSetter(cam, args.arena_params_file, args.field_region)
     setter.run()
@@ -0,0 +1,130 @@
+from typing import List, Optional, Tuple
+import math
+import numpy as np
+
+from vision_module.vision_utils.detection_pyramid import merge_boxes
+
+
+class ReacquisitionMap:
+    """ Keeps, for a short time after a thing is lost, a probability map of
+        where it may be, so the seeker looks in a few small regions instead
+        of the whole image.
+
+        The map is a mixture of a few parts, each one kept as a box and the
+        probability inside it. The thing keeps moving with its last speed from
+        where it was lost, stopping at the arena bounds, with an uncertainty
+        that starts at its size and grows with the time. A robot near that
+        path may be hiding it, so each one adds the probability of the path
+        passing by it. The regions are ranked by their probability per pixel,
+        so the small likely ones, like a robot holding the thing, are scanned
+        first.
+
+        After the horizon the map is dropped and the seeker goes back to
+        scanning the whole image. Before it, the whole image is still scanned
+        every full_scan_period frames that find nothing, for the things that
+        reappear away from the map, like after a kick under a robot """
+
+    def __init__(self, img_shape, horizon: float = 1.0, spread: float = 100.,
+                 speed_spread: float = .3, sigmas: float = 2., max_half_size: float = 64.,
+                 full_scan_period: int = 8):
+        """ The distances are in pixels and the times in seconds. spread is
+            how fast the uncertainty grows even for a stopped thing and
+            speed_spread the part of the speed added to it. The moving part
+            covers sigmas deviations around the predicted position, up to a
+            box of max_half_size """
+        self.img_shape = img_shape[:2]
+        self.horizon = horizon
+        self.spread = spread
+        self.speed_spread = speed_spread
+        self.sigmas = sigmas
+        self.max_half_size = max_half_size
+        self.full_scan_period = full_scan_period
+
+        # Probability of a 2D gaussian inside the square of sigmas deviations
+        self.mass = math.erf(sigmas / math.sqrt(2.)) ** 2
+
+        self.pos = None
+        self.speed = None
+        self.size = None
+        self.lost_time = None
+        self.scans = 0
+
+    @property
+    def active(self) -> bool:
+        return self.pos is not None
+
+    def lose(self, pos, speed, size, now: float) -> None:
+        """ Starts the map of a thing lost at the time now """
+        self.pos = np.asarray(pos, np.float64)
+        self.speed = np.zeros(2) if speed is None or np.any(speed == None) \
+            else np.asarray(speed, np.float64)
+        self.size = float(size) if size is not None else 16.
+        self.lost_time = now
+        self.scans = 0
+
+    def clear(self) -> None:
+        self.pos = None
+        self.speed = None
+        self.lost_time = None
+        self.scans = 0
+
+    def expired(self, now: float) -> bool:
+        return self.lost_time is None or now - self.lost_time > self.horizon
+
+    def full_scan_due(self) -> bool:
+        """ Counts a frame whose regions found nothing and tells whether the
+            whole image must be scanned in it """
+        self.scans += 1
+        return self.scans % self.full_scan_period == 0
+
+    def box(self, center, half: float) -> list:
+        """ [x0, y0, x1, y1] box of the half size around center, grown by the
+            size of the thing and clipped to the image """
+        h, w = self.img_shape
+        half += self.size
+        return [max(int(center[0] - half), 0), max(int(center[1] - half), 0),
+                min(int(center[0] + half) + 1, w), min(int(center[1] + half) + 1, h)]
+
+    def get_parts(self, now: float, occluders: Optional[np.ndarray] = None,
+                  occluder_radius: float = 0.) -> List[Tuple[float, list]]:
+        """ Returns the parts of the map at the time now, as (probability,
+            box) pairs. The probabilities are not normalized """
+        dt = now - self.lost_time
+        h, w = self.img_shape
+        predicted = np.clip(self.pos + self.speed * dt, 0, (w - 1, h - 1))
+        sigma = self.size + (self.spread + self.speed_spread * math.hypot(*self.speed)) * dt
+
+        parts = [(self.mass, self.box(predicted, min(self.sigmas * sigma, self.max_half_size)))]
+
+        if occluders is not None and len(occluders):
+            # Distance of each robot to the path from the lost position to
+            # the predicted one
+            occluders = np.asarray(occluders, np.float64).reshape(-1, 2)
+            path = predicted - self.pos
+            length2 = max(path @ path, 1e-9)
+            t = np.clip((occluders - self.pos) @ path / length2, 0., 1.)
+            path_distances = np.linalg.norm(self.pos + t[:, np.newaxis] * path - occluders, axis=1)
+            weights = np.exp(-path_distances ** 2 / (2 * sigma ** 2))
+
+            # Only the robots close enough to the path may be hiding the thing
+            for center, weight in zip(occluders, weights):
+                if weight > 1e-3:
+                    parts.append((float(weight), self.box(center, occluder_radius)))
+
+        return parts
+
+    def get_regions(self, now: float, occluders: Optional[np.ndarray] = None,
+                    occluder_radius: float = 0.) -> List[Tuple[slice, slice]]:
+        """ Returns the (rows, cols) slices of the regions to scan, the most
+            probable per pixel first. Overlapping parts become one region """
+        parts = self.get_parts(now, occluders, occluder_radius)
+        boxes = merge_boxes([box for _, box in parts])
+
+        def density(box):
+            x0, y0, x1, y1 = box
+            inside = sum(p for p, (a0, b0, a1, b1) in parts
+                         if x0 <= a0 and y0 <= b0 and a1 <= x1 and b1 <= y1)
+            return inside / max((x1 - x0) * (y1 - y0), 1)
+
+        boxes.sort(key=density, reverse=True)
+        return [(slice(y0, y1), slice(x0, x1)) for x0, y0, x1, y1 in boxes]
@@ -0,0 +1,316 @@
+from threading import Thread
+from typing import Optional
+import json
+import time
+import cv2
+import numpy as np
+
+from vision_module.camera_module.frame_source import FrameSource
+from vision_module.vision_utils.frame_queue import FrameQueue
+from ROS.ros_vision_publisher import THINGS_STATE
+
+LOG_EXTENSION = ".vlog"
+MAGIC = b"VSLOG\x00\x00\x01"
+CHUNK_MAGIC = b"VSCHUNK\x00"
+VERSION = 1
+
+# Frame formats. The jpeg frames are encoded by the writer thread, unless
+# the camera gives the buffer they were decoded from
+RAW = "raw"
+JPEG = "jpeg"
+
+# Everything in the file starts at a multiple of it, so the raw frames can
+# be used straight from the memory map
+ALIGNMENT = 64
+
+# Rows of the detections and kalman states: the ball, then the yellow and
+# the blue Things, in the order of their lists
+NUM_ROWS = 11
+
+FILE_HEADER = np.dtype([("magic", "S8"),
+                        ("version", "<u4"),
+                        ("frame_format", "S8"),
+                        ("metadata_size", "<u4")])
+
+CHUNK_HEADER = np.dtype([("magic", "S8"),
+                         ("count", "<i8"),
+                         ("first_index", "<i8"),
+                         ("first_time", "<f8"),
+                         ("last_time", "<f8"),
+                         ("dropped", "<i8"),
+                         ("size", "<i8")])
+
+# One for each frame. offset and size locate the frame in the file. The
+# detections are the x, y, orientation measured in the frame, nan when the
+# thing was not found, and kalman has the position filter state followed by
+# the orientation filter state
+RECORD = np.dtype([("index", "<i8"),
+                   ("timestamp", "<f8"),
+                   ("offset", "<i8"),
+                   ("size", "<i8"),
+                   ("shape", "<i4", (3,)),
+                   ("state", THINGS_STATE),
+                   ("detections", "<f8", (NUM_ROWS, 3)),
+                   ("kalman", "<f8", (NUM_ROWS, 9))])
+
+
+def aligned(size: int) -> int:
+    return -(-size // ALIGNMENT) * ALIGNMENT
+
+
+class VisionRecorder:
+    """ Writes what the vision sees, frame by frame, to an append only log.
+
+        The log is a file header with the metadata, followed by chunks. Each
+        chunk has a header, the table of its records and then its frames, all
+        aligned, so the whole file can be memory mapped and a frame or a
+        record is a view of the map. Chunks are only written when complete,
+        so a log cut by a crash loses at most its last chunk.
+
+        record only copies the frame and queues it. The encoding and the
+        writes run in a background thread. The queue holds at most
+        max_pending frames and the chunk being filled at most chunk_bytes, so
+        the memory is bounded. When the disk is slower than the vision the
+        oldest queued frames are dropped and counted, the vision loop never
+        waits for the recorder """
+
+    def __init__(self, path: str, metadata: dict = None, frame_format: str = RAW,
+                 jpeg_quality: int = 90, chunk_frames: int = 64, chunk_bytes: int = 16 * 2 ** 20,
+                 max_pending: int = 32):
+        if frame_format not in (RAW, JPEG):
+            raise ValueError("frame_format must be %r or %r" % (RAW, JPEG))
+
+        self.path = path
+        self.frame_format = frame_format
+        self.jpeg_quality = jpeg_quality
+        self.chunk_frames = chunk_frames
+        self.chunk_bytes = chunk_bytes
+
+        # The numpy values of the metadata are stored as lists and numbers
+        self.file = open(path, "wb")
+        metadata = json.dumps(metadata or {}, default=lambda value: value.tolist()).encode()
+        header = np.zeros((), FILE_HEADER)
+        header["magic"] = MAGIC
+        header["version"] = VERSION
+        header["frame_format"] = frame_format.encode()
+        header["metadata_size"] = len(metadata)
+        self._write(header.tobytes())
+        self._write(metadata)
+        self.position = aligned(FILE_HEADER.itemsize) + aligned(len(metadata))
+
+        self.queue = FrameQueue(maxlen=max_pending)
+        self.count = 0
+        self._reported_drops = 0
+        self._chunk = []
+        self._chunk_size = 0
+        self._closing = False
+        self.thread = Thread(target=self._write_loop, args=())
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def dropped(self) -> int:
+        return self.queue.dropped
+
+    def record(self, frame: np.ndarray, timestamp: float, state: np.ndarray,
+               detections: np.ndarray, kalman: np.ndarray, encoded: np.ndarray = None) -> None:
+        """ Queues a frame and what the vision found in it. encoded is the
+            jpeg buffer the frame was decoded from, written as it is in the
+            jpeg format """
+        if self.frame_format == JPEG and encoded is not None:
+            data = encoded
+        else:
+            data, encoded = frame.copy(), None
+        self.queue.put((data, encoded is not None, frame.shape, timestamp,
+                        state.copy(), detections, kalman))
+
+    def _write(self, data) -> None:
+        """ Writes data and pads it to the alignment """
+        data = memoryview(data).cast("B")
+        self.file.write(data)
+        self.file.write(bytes(aligned(len(data)) - len(data)))
+
+    def _write_loop(self) -> None:
+        while True:
+            item = self.queue.get(timeout=0.1)
+            if item is None:
+                if self._closing:
+                    break
+                continue
+
+            data, encoded, shape, timestamp, state, detections, kalman = item
+            if self.frame_format == JPEG and not encoded:
+                _, data = cv2.imencode(".jpg", data, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+
+            self._chunk.append((data, shape, timestamp, state, detections, kalman))
+            self._chunk_size += data.nbytes
+            if len(self._chunk) >= self.chunk_frames or self._chunk_size >= self.chunk_bytes:
+                self._write_chunk()
+
+        self._write_chunk()
+
+    def _write_chunk(self) -> None:
+        if not self._chunk:
+            return
+
+        n = len(self._chunk)
+        table = np.zeros(n, RECORD)
+        offset = self.position + aligned(CHUNK_HEADER.itemsize) + aligned(table.nbytes)
+        for i, (data, shape, timestamp, state, detections, kalman) in enumerate(self._chunk):
+            record = table[i]
+            record["index"] = self.count + i
+            record["timestamp"] = timestamp
+            record["offset"] = offset
+            record["size"] = data.nbytes
+            record["shape"] = tuple(shape) + (0,) * (3 - len(shape))
+            record["state"] = state
+            record["detections"] = detections
+            record["kalman"] = kalman
+            offset += aligned(data.nbytes)
+
+        dropped = self.queue.dropped
+        header = np.zeros((), CHUNK_HEADER)
+        header["magic"] = CHUNK_MAGIC
+        header["count"] = n
+        header["first_index"] = self.count
+        header["first_time"] = table["timestamp"][0]
+        header["last_time"] = table["timestamp"][-1]
+        header["dropped"] = dropped - self._reported_drops
+        header["size"] = offset - self.position
+
+        self._write(header.tobytes())
+        self._write(table.tobytes())
+        for data, *_ in self._chunk:
+            self._write(np.ascontiguousarray(data))
+        self.file.flush()
+
+        self.position = offset
+        self.count += n
+        self._reported_drops = dropped
+        self._chunk = []
+        self._chunk_size = 0
+
+    def close(self) -> None:
+        """ Writes everything still queued and closes the file """
+        self._closing = True
+        self.thread.join()
+        self.file.close()
+
+
+class VisionLog:
+    """ Reads a log written by a VisionRecorder. The file is memory mapped and
+        only the chunk headers are read on opening, so a record or a frame
+        anywhere in a long match costs the same. The raw frames are read only
+        views of the map, the jpeg frames are decoded """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.map = np.memmap(path, np.uint8, "r")
+
+        header = np.ndarray((), FILE_HEADER, buffer=self.map)
+        if header["magic"] != MAGIC:
+            raise ValueError("%s is not a vision log" % path)
+        self.frame_format = header["frame_format"].item().decode()
+        start = aligned(FILE_HEADER.itemsize)
+        metadata_size = int(header["metadata_size"])
+        self.metadata = json.loads(self.map[start:start + metadata_size].tobytes().decode() or "{}")
+
+        # A chunk cut at the end of the file was being written when the
+        # recording stopped and is left out
+        self.tables = []
+        first_indexes, first_times, self.dropped = [], [], 0
+        position = start + aligned(metadata_size)
+        while position + CHUNK_HEADER.itemsize <= self.map.size:
+            chunk = np.ndarray((), CHUNK_HEADER, buffer=self.map, offset=position)
+            if chunk["magic"] != CHUNK_MAGIC or position + chunk["size"] > self.map.size:
+                break
+            table_offset = position + aligned(CHUNK_HEADER.itemsize)
+            self.tables.append(np.ndarray(int(chunk["count"]), RECORD, buffer=self.map,
+                                          offset=table_offset))
+            first_indexes.append(int(chunk["first_index"]))
+            first_times.append(float(chunk["first_time"]))
+            self.dropped += int(chunk["dropped"])
+            position += int(chunk["size"])
+
+        self.first_indexes = np.array(first_indexes, np.int64)
+        self.first_times = np.array(first_times)
+        self.count = first_indexes[-1] + len(self.tables[-1]) if self.tables else 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def record(self, index: int) -> np.ndarray:
+        """ Returns the record of the frame index, with its timestamp, the
+            published state, the detections and the kalman states """
+        if not 0 <= index < self.count:
+            raise IndexError("frame %d out of a log of %d frames" % (index, self.count))
+        chunk = int(np.searchsorted(self.first_indexes, index, "right")) - 1
+        return self.tables[chunk][index - self.first_indexes[chunk]]
+
+    def frame(self, index: int) -> np.ndarray:
+        record = self.record(index)
+        data = self.map[record["offset"]:record["offset"] + record["size"]]
+        if self.frame_format == JPEG:
+            return cv2.imdecode(data, cv2.IMREAD_UNCHANGED)
+        return data.reshape(tuple(int(d) for d in record["shape"] if d > 0))
+
+    def index_at(self, timestamp: float) -> int:
+        """ Returns the index of the last frame grabbed until timestamp, or
+            of the first frame when the log starts after it. An empty log
+            gives 0, the same as its length """
+        if self.count == 0:
+            return 0
+        chunk = max(int(np.searchsorted(self.first_times, timestamp, "right")) - 1, 0)
+        times = self.tables[chunk]["timestamp"]
+        return int(self.first_indexes[chunk]) + max(int(np.searchsorted(times, timestamp, "right")) - 1, 0)
+
+    def close(self) -> None:
+        # The map is closed when the last view of it is gone
+        self.tables = []
+        self.map = None
+
+
+class LogSource(FrameSource):
+    """ Replays the frames of a vision log, with their original timestamps.
+        In the realtime mode each frame is delivered only when its time
+        arrives, relative to the first frame """
+
+    def __init__(self, path: str, realtime: bool = True, loop: bool = False, start: float = None):
+        """ start is the timestamp of the first frame to replay """
+        super().__init__()
+
+        self.log = VisionLog(path)
+        self.realtime = realtime
+        self.loop = loop
+        self.first = self.log.index_at(start) if start is not None else 0
+        self.index = self.first
+        self.finished = False
+        self._start = None
+
+    def read(self) -> Optional[np.ndarray]:
+        """ Returns the next frame, or None when the log is over """
+        if self.index >= len(self.log) and self.loop:
+            self.index = self.first
+            self._start = None
+        if self.index >= len(self.log):
+            self.finished = True
+            return None
+
+        frame_time = float(self.log.record(self.index)["timestamp"])
+        frame = self.log.frame(self.index)
+        self.index += 1
+
+        if self._start is None:
+            self._start = (time.time(), frame_time)
+        if self.realtime:
+            self.timestamp = self._start[0] + frame_time - self._start[1]
+            delay = self.timestamp - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        else:
+            self.timestamp = time.time()
+
+        return frame
+
+    def release(self) -> None:
+        self.log.close()
@@ -0,0 +1,67 @@
+from typing import Optional, Tuple
+import math
+import cv2
+import numpy as np
+
+KERNEL = np.ones((3, 3), np.uint8)
+
+# Variance of the coverage of a pixel on the border of a binary blob, which
+# may be anything from empty to full
+EDGE_VARIANCE = 1. / 12.
+
+
+def refine_centroid(mask: np.ndarray, box, img: Optional[np.ndarray] = None,
+                    color_thrs=None, expected_size: Optional[float] = None,
+                    ramp: float = 48.) -> Tuple[np.ndarray, np.ndarray]:
+    """ Returns the intensity weighted centroid of the blob of the binary
+        mask inside the (x, y, width, height) box, and the (x, y) variances of
+        this centroid, both in pixels.
+
+        With the color image and the thresholds of the mask each pixel around
+        the blob weights how close its color is to the thresholds, from 1
+        inside them to 0 at ramp levels beyond them, so the mixed pixels of
+        the border count by how much of the thing they hold. Otherwise the
+        blob pixels weight 1.
+
+        The variance adds up the uncertain weights of the border pixels, and
+        when expected_size is given, the error of a blob smaller than a
+        circle of that diameter, which has a part cut or hidden """
+    x, y, w, h = (int(v) for v in box)
+    height, width = mask.shape[:2]
+    x0, y0 = max(x - 1, 0), max(y - 1, 0)
+    x1, y1 = min(x + w + 1, width), min(y + h + 1, height)
+
+    blob = mask[y0:y1, x0:x1]
+    support = cv2.dilate(blob, KERNEL)
+    edge = (support != 0) & (cv2.erode(blob, KERNEL) == 0)
+
+    if img is not None and img.ndim == 3 and color_thrs is not None:
+        patch = img[y0:y1, x0:x1].astype(np.int16)
+        low = np.asarray(color_thrs[0], np.int16)
+        high = np.asarray(color_thrs[1], np.int16)
+        beyond = np.maximum(low - patch, patch - high).max(axis=2)
+        weights = np.clip(1. - beyond / ramp, 0., 1.)
+        weights[support == 0] = 0.
+    else:
+        weights = (blob != 0).astype(np.float64)
+
+    total = weights.sum()
+    xs = np.arange(x0, x1, dtype=np.float64)
+    ys = np.arange(y0, y1, dtype=np.float64)
+    centroid = np.array([weights.sum(axis=0) @ xs, weights.sum(axis=1) @ ys]) / total
+
+    # Each weight is uncertain by w (1 - w), the mixed pixels, and the
+    # border pixels of a hard mask by the coverage quantization
+    weight_variance = weights * (1. - weights) + EDGE_VARIANCE * edge
+    dx2 = (xs - centroid[0]) ** 2
+    dy2 = (ys - centroid[1]) ** 2
+    variance = np.array([weight_variance.sum(axis=0) @ dx2,
+                         weight_variance.sum(axis=1) @ dy2]) / total ** 2
+
+    if expected_size is not None and expected_size > 0:
+        # A missing part of the circle moves the centroid up to a radius
+        radius = expected_size / 2.
+        missing = max(0., 1. - total / (math.pi * radius ** 2))
+        variance += (radius * missing) ** 2 / 3.
+
+    return centroid, variance
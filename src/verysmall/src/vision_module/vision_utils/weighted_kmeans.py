@@ -0,0 +1,80 @@
+from typing import Optional
+import numpy as np
+
+
+class WeightedKMeans:
+    """ Lloyd's k-means for a few weighted points and a small fixed k, made
+        to be run on every frame warm started from the centers of the
+        previous one. All the distances of an iteration are computed at once,
+        so the cost is a handful of numpy calls per iteration """
+
+    def __init__(self, n_clusters: int, max_iter: int = 30, tol: float = 1e-2):
+        """ The iterations stop when no center moves more than tol """
+        self.n_clusters = n_clusters
+        self.max_iter = max_iter
+        self.tol = tol
+
+        self.cluster_centers_ = None
+        self.labels_ = None
+        self.n_iter_ = 0
+
+    def init_centers(self, points: np.ndarray, weights: np.ndarray) -> np.ndarray:
+        """ Deterministic k-means++: starts at the heaviest point and takes
+            as each next center the point with the largest weighted squared
+            distance to the centers already taken """
+        centers = np.empty((self.n_clusters, 2))
+        centers[0] = points[np.argmax(weights)]
+        min_distances = ((points - centers[0]) ** 2).sum(axis=1)
+
+        for k in range(1, self.n_clusters):
+            centers[k] = points[np.argmax(weights * min_distances)]
+            np.minimum(min_distances, ((points - centers[k]) ** 2).sum(axis=1), out=min_distances)
+
+        return centers
+
+    def fit(self, points: np.ndarray, weights: Optional[np.ndarray] = None,
+            init: Optional[np.ndarray] = None) -> "WeightedKMeans":
+        """ points is a (n, 2) array with n >= n_clusters. Without init the
+            centers are seeded by init_centers. A center left without points
+            takes the points farthest from their centers """
+        points = np.asarray(points, np.float64)
+        if weights is None:
+            weights = np.ones(points.shape[0])
+        else:
+            weights = np.asarray(weights, np.float64)
+
+        if init is None:
+            centers = self.init_centers(points, weights)
+        else:
+            centers = np.array(init, np.float64)
+
+        k = self.n_clusters
+        for self.n_iter_ in range(1, self.max_iter + 1):
+            # (n, k) squared distances of all the points to all the centers
+            distances = ((points[:, np.newaxis, :] - centers[np.newaxis]) ** 2).sum(axis=2)
+            labels = distances.argmin(axis=1)
+
+            mass = np.bincount(labels, weights, minlength=k)
+            empty = np.flatnonzero(mass == 0)
+            if empty.size > 0:
+                # When two things split, the warm start may leave a center
+                # between them and another one with no points. The empty
+                # centers take the points farthest from their centers
+                spread = weights * distances[np.arange(labels.size), labels]
+                labels[np.argsort(-spread)[:empty.size]] = empty
+                mass = np.bincount(labels, weights, minlength=k)
+
+            moved = mass > 0
+            new_centers = centers.copy()
+            new_centers[moved, 0] = np.bincount(labels, weights * points[:, 0], minlength=k)[moved]
+            new_centers[moved, 1] = np.bincount(labels, weights * points[:, 1], minlength=k)[moved]
+            new_centers[moved] /= mass[moved, np.newaxis]
+
+            shift = ((new_centers - centers) ** 2).sum(axis=1).max()
+            centers = new_centers
+            if shift <= self.tol ** 2:
+                break
+
+        self.cluster_centers_ = centers
+        self.labels_ = labels
+        return self
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+import os
+import sys
+import unittest
+import warnings
+from unittest import mock
+import numpy as np
+
+# The modules are imported as the nodes import them, from the src directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from vision_module.fused_vision import VisionFuser, get_state_views
+from ROS.ros_vision_publisher import RosVisionPublisher, new_things_state
+
+
+class TestFusedState(unittest.TestCase):
+
+    def setUp(self):
+        seekers = {"yellow": "color", "blue": "aruco"}
+        self.fuser = VisionFuser(1, seekers, 3, 3, hold_time=.5)
+
+        # One camera frame with the ball and the first yellow robot
+        state = new_things_state()
+        pos, _ = get_state_views(state)
+        pos[0] = (75., 65.)
+        pos[1] = (30., 40.)
+        state["yellow_team_orientation"][0] = 1.
+        seen = np.zeros(11, bool)
+        seen[[0, 1]] = True
+        self.fuser.update(0, 10., state, seen)
+
+    def test_lost_slot_is_published_as_zero(self):
+        self.fuser.fuse(10.)
+
+        # Past the hold time nothing is seen anymore
+        state = self.fuser.fuse(11.)
+        self.assertTrue(np.isfinite(state.reshape(1).view(np.float64)).all())
+
+        publisher = RosVisionPublisher()
+        publisher.pub = mock.Mock()
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            publisher.publish_state(state, self.fuser.timestamp)
+
+        msg = publisher.pub.publish.call_args[0][0]
+        self.assertEqual(list(msg.ball_pos), [0, 0])
+        self.assertEqual(list(msg.yellow_team_pos[:2]), [0, 0])
+        self.assertEqual(msg.yellow_team_orientation[0], 0)
+
+    def test_seen_slot_is_published(self):
+        state = self.fuser.fuse(10.)
+
+        publisher = RosVisionPublisher()
+        publisher.pub = mock.Mock()
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            publisher.publish_state(state, self.fuser.timestamp)
+
+        msg = publisher.pub.publish.call_args[0][0]
+        self.assertEqual(list(msg.ball_pos), [7500, 6500])
+        self.assertEqual(list(msg.yellow_team_pos[:2]), [3000, 4000])
+        self.assertEqual(msg.yellow_team_orientation[0], 10000)
+        self.assertEqual(list(msg.blue_team_pos), [0] * 10)
+
+
+if __name__ == "__main__":
+    unittest.main()